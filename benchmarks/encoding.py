@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+'''Compares scan.encode()/decode() against JSON and BSON documents.
+
+Usage: ./benchmarks/encoding.py <storage_url> [<max_scans>]
+
+The scans are read from any storage backend (see common.storage). One JSON
+object per format is printed so the results can be compared between runs.
+'''
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import common.scan as scan
+import common.storage as storage
+
+# bson ships with pymongo, which not every machine has
+try:
+    import bson
+except ImportError:
+    bson = None
+
+MAX_SCANS = 1000
+REPEAT = 5
+
+def json_encode(full_scan):
+    return json.dumps(full_scan.document()).encode('utf-8')
+
+def json_decode(data):
+    doc = json.loads(data)
+    return scan.scan_factory(doc['gsm'], doc['gps_before'], doc['gps_after'],
+                             doc['sensor_name'], doc['high_quality'])
+
+def bson_encode(full_scan):
+    return bson.BSON.encode(full_scan.document())
+
+def bson_decode(data):
+    doc = bson.BSON(data).decode()
+    return scan.scan_factory(doc['gsm'], doc['gps_before'], doc['gps_after'],
+                             doc['sensor_name'], doc['high_quality'])
+
+def best_time(func, items):
+    '''Returns the fastest of REPEAT passes of func over items (in sec)'''
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def run(scans):
+    formats = [('binary', scan.encode, scan.decode),
+               ('json', json_encode, json_decode)]
+    if bson is not None:
+        formats.append(('bson', bson_encode, bson_decode))
+
+    results = []
+    for (name, encode, decode) in formats:
+        encoded = [encode(s) for s in scans]
+
+        encode_time = best_time(encode, scans)
+        decode_time = best_time(decode, encoded)
+
+        results.append({'format' : name,
+                        'scans' : len(scans),
+                        'bytes_per_scan' : sum(len(e) for e in encoded) / len(scans),
+                        'encode_us_per_scan' : encode_time / len(scans) * 1e6,
+                        'decode_us_per_scan' : decode_time / len(scans) * 1e6})
+
+    return results
+
+def main(url, max_scans=MAX_SCANS):
+    backend = storage.open_backend(url)
+
+    scans = []
+    for (full_scan, _, _) in backend.iter_scans():
+        scans.append(full_scan)
+        if len(scans) >= max_scans:
+            break
+    backend.close()
+
+    if len(scans) == 0:
+        print("No scans found in " + url)
+        sys.exit(-1)
+
+    for result in run(scans):
+        print(json.dumps(result))
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [2, 3]:
+        print("Usage: ./benchmarks/encoding.py <storage_url> [<max_scans>]")
+        sys.exit(-1)
+
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) == 3 else MAX_SCANS)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+'''Writes the benchmark corpus (a modem log, see common.capture).
+
+Usage: ./benchmarks/make_corpus.py [<output> [<rounds>]]
+
+The corpus is synthesized with sensor.fake_gsm, not recorded from a modem:
+one at#csurv reply for each of the FREQUENCY_SPLIT ranges GsmScanner walks
+through, for a number of rounds. The replies are laid out the way the
+Telit modem sends them (echo, survey start, measurements, survey end). A
+recorded modem log from survey.py (MODEM_LOG_PATH) can be passed to
+pipeline.py in its place.
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sensor.fake_gsm as fake_gsm
+import sensor.gsm as gsm
+import common.capture as capture
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus', 'csurv.jsonl')
+ROUNDS = 4
+# When the first scan starts (seconds since the epoch) and how long each takes
+START_TIME = 1488628862.0
+SCAN_TIME = 10.0
+
+def survey_blob(measurements, freq_low, freq_high, round_index):
+    '''The modem's whole reply to at#csurv=freq_low,freq_high'''
+    blob = gsm.AT_COMMANDS['surv_channel_range'].format(freq_low, freq_high) + "\r\r\n"
+    blob += fake_gsm.SURVEY_START
+
+    for arfcn in sorted(measurements):
+        if freq_low <= arfcn <= freq_high:
+            texts = measurements[arfcn]
+            blob += texts[round_index % len(texts)]
+
+    return blob + fake_gsm.SURVEY_END
+
+def main(path=CORPUS_PATH, rounds=ROUNDS):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    # Different measurements each round so the blobs are not all the same
+    timestamp = START_TIME
+    with open(path, 'w') as log_file:
+        for round_index in range(rounds):
+            measurements = fake_gsm.synthesize_measurements(seed=round_index)
+
+            for (freq_low, freq_high) in gsm.FREQUENCY_SPLIT:
+                modem_data = {'data_blob' : survey_blob(measurements, freq_low, freq_high, round_index),
+                              'freq_low' : freq_low,
+                              'freq_high' : freq_high}
+                capture.write_modem_record(log_file, modem_data, timestamp, timestamp + SCAN_TIME)
+                timestamp += SCAN_TIME
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3:
+        print("Usage: ./benchmarks/make_corpus.py [<output> [<rounds>]]")
+        sys.exit(-1)
+
+    main(sys.argv[1] if len(sys.argv) > 1 else CORPUS_PATH,
+         int(sys.argv[2]) if len(sys.argv) > 2 else ROUNDS)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+'''Times each step a scan goes through, from the modem's text to storage.
+
+Usage: ./benchmarks/pipeline.py [<corpus> [<mongo_url> [<postgres_url>]]]
+
+The corpus is a modem log (see common.capture), benchmarks/corpus/csurv.jsonl
+by default (see make_corpus.py). The steps are:
+
+    parse        Telit_Modem_Parser().parse_scan() on each blob
+    document     Scan.document()
+    scan_factory scan_factory() on those documents, eagerly and lazily
+    sqlite       write_batch() into an in-memory SQLite database
+    mongo        mongo_db.Database.insert_sensor_point(), one scan at a time
+    postgres     postgres_db.Database.insert_scans() on the whole corpus
+
+The Mongo and Postgres steps only run when their URL is given and the
+database can be reached. They really insert the scans, so point them at a
+scratch database. One JSON object per step is printed so the results can
+be compared between runs.
+'''
+import json
+import os
+import sys
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sensor.gps as gps
+import sensor.fake_gpsd as fake_gpsd
+import common.capture as capture
+import common.scan as scan
+import common.storage as storage
+import common.utils as utils
+
+from common.parse import Telit_Modem_Parser
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus', 'csurv.jsonl')
+# The in-memory steps are run this many times and the fastest is kept
+REPEAT = 5
+
+def best_time(func, items):
+    '''Returns the fastest of REPEAT passes of func over items (in sec)'''
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def result(step, n_scans, elapsed, **extra):
+    '''The JSON object printed for a step'''
+    res = {'step' : step,
+           'scans' : n_scans,
+           'us_per_scan' : elapsed / n_scans * 1e6,
+           'scans_per_sec' : n_scans / max(elapsed, 1e-9)}
+    res.update(extra)
+    return res
+
+def skipped(step, reason):
+    return {'step' : step, 'skipped' : reason}
+
+def load_corpus(path):
+    '''Reads the records of a modem log along with made up GPS fixes for them'''
+    records = list(capture.read_modem_log(path))
+    if len(records) == 0:
+        raise Exception("There are no scans in " + path)
+
+    # The corpus has no GPS so fixes are made up along a straight track
+    track = fake_gpsd.SynthesizedTrack()
+    track.start = records[0]['start']
+    for record in records:
+        record['gps_before'] = gps.format_gps_data(track.tpv(record['start']))
+        record['gps_after'] = gps.format_gps_data(track.tpv(record['end']))
+
+    return records
+
+def parse(record):
+    gsm_scan = Telit_Modem_Parser().parse_scan(record['data_blob'])
+    gsm_scan.set_freq_range(record['freq_low'], record['freq_high'])
+
+    return scan.Scan(gsm_scan, scan.Gps_Scan(record['gps_before']),
+                     scan.Gps_Scan(record['gps_after']), utils.get_sensor_name())
+
+def from_document(doc, lazy=False):
+    return scan.scan_factory(doc['gsm'], doc['gps_before'], doc['gps_after'],
+                             doc['sensor_name'], doc['high_quality'], lazy=lazy)
+
+def time_store(step, url, store):
+    '''Times store(backend, scans) on a backend, or says why it was skipped'''
+    if url is None:
+        return skipped(step, "no url given")
+
+    try:
+        backend = storage.open_backend(url)
+        start = time.perf_counter()
+        n_scans = store(backend)
+        # Anything batched has to be written out to count
+        backend.close()
+        elapsed = time.perf_counter() - start
+    except Exception as e:
+        # Most likely the driver is not installed or the server is not up
+        traceback.print_exc(file=sys.stderr)
+        return skipped(step, str(e))
+
+    return result(step, n_scans, elapsed)
+
+def run(records, mongo_url=None, postgres_url=None):
+    scans = [parse(record) for record in records]
+    docs = [full_scan.document() for full_scan in scans]
+    n_scans = len(scans)
+    n_measurements = sum(len(full_scan.get_gsm().gsm_measurements) for full_scan in scans)
+
+    results = [result('parse', n_scans, best_time(parse, records),
+                      measurements_per_scan=n_measurements / n_scans,
+                      blob_bytes_per_scan=sum(len(r['data_blob']) for r in records) / n_scans),
+               result('document', n_scans, best_time(lambda s: s.document(), scans)),
+               result('scan_factory', n_scans, best_time(from_document, docs)),
+               result('scan_factory_lazy', n_scans,
+                      best_time(lambda doc: from_document(doc, lazy=True), docs))]
+
+    def write_batch(backend):
+        backend.write_batch([(full_scan, utils.generate_unique_id(), storage.VERSION) \
+                                for full_scan in scans])
+        return n_scans
+    results.append(time_store('sqlite', "sqlite://:memory:", write_batch))
+
+    def insert_sensor_point(backend):
+        for full_scan in scans:
+            backend.insert_sensor_point(full_scan)
+        return n_scans
+    results.append(time_store('mongo', mongo_url, insert_sensor_point))
+
+    def insert_scans(backend):
+        backend.insert_scans([(full_scan, utils.generate_unique_id(), storage.VERSION) \
+                                for full_scan in scans])
+        return n_scans
+    results.append(time_store('postgres', postgres_url, insert_scans))
+
+    return results
+
+def main(corpus_path=CORPUS_PATH, mongo_url=None, postgres_url=None):
+    records = load_corpus(corpus_path)
+
+    for res in run(records, mongo_url, postgres_url):
+        print(json.dumps(res))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 4:
+        print("Usage: ./benchmarks/pipeline.py [<corpus> [<mongo_url> [<postgres_url>]]]")
+        sys.exit(-1)
+
+    main(sys.argv[1] if len(sys.argv) > 1 else CORPUS_PATH,
+         sys.argv[2] if len(sys.argv) > 2 else None,
+         sys.argv[3] if len(sys.argv) > 3 else None)
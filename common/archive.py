@@ -0,0 +1,372 @@
+import datetime
+import glob
+import mmap
+import os
+import struct
+import uuid as uuid_module
+import zlib
+
+import common.utils as utils
+import common.scan as scan
+import common.compress as compress
+
+# Every segment starts with this so we know how to read it
+SEGMENT_MAGIC = b'SGARCH\x01\x00'
+# ...and ends with the offset of its footer followed by this
+FOOTER_MAGIC = b'SGAFOOT\x01'
+FOOTER_OFFSET = struct.Struct('<Q')
+TRAILER_SIZE = FOOTER_OFFSET.size + len(FOOTER_MAGIC)
+SEGMENT_SUFFIX = '.sga'
+# A segment being written has this on the end until it is finished
+PARTIAL_SUFFIX = '.partial'
+# Number of scans compressed together. Bigger blocks compress better but
+# a reader has to decompress a whole block to get at any scan in it.
+BLOCK_SCANS = 64
+# Number of scans in a segment before a new one is started
+SEGMENT_SCANS = 10000
+
+def scan_time(full_scan):
+    '''The GPS time of a scan, or '' if it does not have one'''
+    time = full_scan.get_gps_before().get_time()
+    return time if time is not None else ''
+
+class Segment():
+    ''' A finished, read only segment file.
+
+    The layout is
+
+        SEGMENT_MAGIC
+        block, block, ...          each one zlib compressed records
+        footer                     the index of the blocks
+        footer offset, FOOTER_MAGIC
+
+    Each record in a block is the uuid, the version and the scan packed
+    with scan.encode(). The footer has, for every block, its byte range,
+    the range of GPS times in it, the sensors that took its scans and the
+    uuids of its scans. Only the footer is read when the segment is
+    opened, so finding a time window never decompresses anything else.
+    '''
+
+    def __init__(self, path):
+        '''Maps the segment file and reads its footer
+
+        Args:
+            path (String): The path to the segment file
+        '''
+        self.path = path
+
+        # Mapping the file lets the OS page in just the blocks that are read
+        with open(path, 'rb') as segment:
+            self.data = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC or \
+                self.data[-len(FOOTER_MAGIC):] != FOOTER_MAGIC:
+            self.data.close()
+            raise Exception("Not a finished archive segment: " + path)
+
+        (pos,) = FOOTER_OFFSET.unpack_from(self.data, len(self.data) - TRAILER_SIZE)
+        self.blocks = []
+
+        (n_blocks, pos) = scan.read_varint(self.data, pos)
+        for _ in range(n_blocks):
+            block = {}
+            (block['offset'], pos) = scan.read_varint(self.data, pos)
+            (block['length'], pos) = scan.read_varint(self.data, pos)
+            (block['start'], pos) = scan.read_str(self.data, pos)
+            (block['end'], pos) = scan.read_str(self.data, pos)
+
+            (n_sensors, pos) = scan.read_varint(self.data, pos)
+            block['sensors'] = set()
+            for _ in range(n_sensors):
+                (sensor_name, pos) = scan.read_str(self.data, pos)
+                block['sensors'].add(sensor_name)
+
+            (n_uuids, pos) = scan.read_varint(self.data, pos)
+            block['uuids'] = []
+            for _ in range(n_uuids):
+                (uuid, pos) = scan.read_str(self.data, pos)
+                block['uuids'].append(uuid)
+
+            self.blocks.append(block)
+
+        # The time range of the whole segment, ignoring scans without a time
+        times = [block['start'] for block in self.blocks if block['start'] != ''] + \
+                [block['end'] for block in self.blocks if block['end'] != '']
+        self.start = min(times) if len(times) > 0 else None
+        self.end = max(times) if len(times) > 0 else None
+
+    def get_uuids(self):
+        '''Return all of the uuids in the segment as a list'''
+        return [uuid for block in self.blocks for uuid in block['uuids']]
+
+    def find_blocks(self, start=None, end=None, sensor_name=None):
+        '''Returns the blocks that could hold scans matching the filters
+
+        Args:
+            start (String): Only scans taken at or after this GPS time
+            end (String): Only scans taken before this GPS time
+            sensor_name (String): Only scans from this sensor
+        '''
+        blocks = []
+        for block in self.blocks:
+            if sensor_name is not None and sensor_name not in block['sensors']:
+                continue
+
+            # Blocks where no scan has a time only match when there is no window
+            if start is not None or end is not None:
+                if block['end'] == '':
+                    continue
+                if start is not None and block['end'] < start:
+                    continue
+                if end is not None and block['start'] >= end:
+                    continue
+
+            blocks.append(block)
+
+        return blocks
+
+    def iter_records(self, blocks):
+        '''Yields (uuid, version, encoded_scan) for every record in the blocks'''
+        for block in blocks:
+            data = zlib.decompress(self.data[block['offset']:block['offset'] + block['length']])
+
+            pos = 0
+            while pos < len(data):
+                (uuid, pos) = scan.read_str(data, pos)
+                (version, pos) = scan.read_varint(data, pos)
+                (length, pos) = scan.read_varint(data, pos)
+
+                yield (uuid, version, data[pos:pos + length])
+                pos += length
+
+    def close(self):
+        self.data.close()
+
+class SegmentWriter():
+    ''' Builds a new segment file.
+
+    The blocks are written out as they fill up so only the index is kept
+    in memory. The file keeps PARTIAL_SUFFIX until finish() writes the
+    footer, so readers never see a segment that is still being written.
+    '''
+
+    def __init__(self, directory):
+        '''Starts a new segment in the archive directory'''
+        # The names sort in the order the segments were made
+        name = '{:%Y%m%dT%H%M%S%f}-{}{}'.format(datetime.datetime.utcnow(),
+                                             uuid_module.uuid4().hex[:8], SEGMENT_SUFFIX)
+        self.path = os.path.join(directory, name)
+        self.segment = open(self.path + PARTIAL_SUFFIX, 'wb')
+        self.segment.write(SEGMENT_MAGIC)
+
+        self.blocks = []
+        self.n_scans = 0
+        self.new_block()
+
+    def new_block(self):
+        self.records = bytearray()
+        self.block = {'start' : None, 'end' : None, 'sensors' : set(), 'uuids' : []}
+
+    def add(self, full_scan, uuid, version):
+        '''Adds a scan to the segment'''
+        # The whole block is compressed so the blobs are not compressed twice
+        encoded = scan.encode(full_scan, compression=None)
+
+        scan.write_str(self.records, uuid)
+        scan.write_varint(self.records, version)
+        scan.write_varint(self.records, len(encoded))
+        self.records += encoded
+
+        time = scan_time(full_scan)
+        if time != '':
+            if self.block['start'] is None or time < self.block['start']:
+                self.block['start'] = time
+            if self.block['end'] is None or time > self.block['end']:
+                self.block['end'] = time
+
+        sensor_name = full_scan.get_sensor_name()
+        if sensor_name is not None:
+            self.block['sensors'].add(sensor_name)
+
+        self.block['uuids'].append(uuid)
+        self.n_scans += 1
+
+        if len(self.block['uuids']) >= BLOCK_SCANS:
+            self.write_block()
+
+    def write_block(self):
+        if len(self.block['uuids']) == 0:
+            return
+
+        data = zlib.compress(bytes(self.records), compress.ZLIB_LEVEL)
+
+        self.block['offset'] = self.segment.tell()
+        self.block['length'] = len(data)
+        self.segment.write(data)
+
+        self.blocks.append(self.block)
+        self.new_block()
+
+    def finish(self):
+        '''Writes the footer and makes the segment visible to readers'''
+        self.write_block()
+
+        footer = bytearray()
+        scan.write_varint(footer, len(self.blocks))
+        for block in self.blocks:
+            scan.write_varint(footer, block['offset'])
+            scan.write_varint(footer, block['length'])
+            scan.write_str(footer, block['start'] or '')
+            scan.write_str(footer, block['end'] or '')
+
+            scan.write_varint(footer, len(block['sensors']))
+            for sensor_name in sorted(block['sensors']):
+                scan.write_str(footer, sensor_name)
+
+            scan.write_varint(footer, len(block['uuids']))
+            for uuid in block['uuids']:
+                scan.write_str(footer, uuid)
+
+        footer_offset = self.segment.tell()
+        self.segment.write(footer)
+        self.segment.write(FOOTER_OFFSET.pack(footer_offset) + FOOTER_MAGIC)
+
+        # Make sure the segment is actually on disk before it is renamed
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.segment.close()
+
+        os.rename(self.path + PARTIAL_SUFFIX, self.path)
+
+class Database():
+    ''' A cold archive of scans in immutable, compressed segment files.
+
+    New scans are written to a new segment, which is finished when it
+    holds SEGMENT_SCANS scans or when flush() or close() is called. Until
+    then the scans are not safely on disk (see pending_uuids()). Finished
+    segments are never changed again so they are safe to copy, back up or
+    move to slow storage.
+    '''
+
+    # The raw blobs are kept, so a copy into this backend should include them
+    stores_blobs = True
+
+    def __init__(self, path):
+        '''Opens the archive directory (it is created if needed)
+
+        Args:
+            path (String): The directory holding the segment files
+        '''
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        for partial in glob.glob(os.path.join(path, '*' + SEGMENT_SUFFIX + PARTIAL_SUFFIX)):
+            utils.log("Ignoring unfinished archive segment " + partial)
+
+        self.writer = None
+
+    def segment_paths(self):
+        '''The finished segments, oldest first'''
+        return sorted(glob.glob(os.path.join(self.path, '*' + SEGMENT_SUFFIX)))
+
+    def write_batch(self, scan_uuids):
+        '''Adds a list of (scan, uuid, version) to the archive'''
+        utils.log("Trying to write to the DB...")
+        for (full_scan, uuid, version) in scan_uuids:
+            if self.writer is None:
+                self.writer = SegmentWriter(self.path)
+
+            self.writer.add(full_scan, uuid, version)
+
+            if self.writer.n_scans >= SEGMENT_SCANS:
+                self.writer.finish()
+                self.writer = None
+        utils.log("Done writing to DB.")
+
+    def pending_uuids(self):
+        '''The uuids of the scans in the unfinished segment
+
+        These are lost if the process dies before the segment is finished,
+        so storage.stream does not mark them exported.
+        '''
+        if self.writer is None:
+            return []
+
+        return [uuid for block in self.writer.blocks for uuid in block['uuids']] + \
+                    self.writer.block['uuids']
+
+    def flush(self):
+        '''Finishes the segment being written so its scans are on disk'''
+        if self.writer is not None:
+            self.writer.finish()
+            self.writer = None
+
+    def get_scans(self, start=None, end=None, sensor_name=None):
+        '''Yields (scan, uuid, version) for the scans matching the filters
+
+        Only the blocks whose index matches are decompressed.
+
+        Args:
+            start (String): Only scans taken at or after this GPS time
+            end (String): Only scans taken before this GPS time
+            sensor_name (String): Only scans from this sensor
+        '''
+        for path in self.segment_paths():
+            segment = Segment(path)
+
+            # Skip the whole segment without touching its blocks if we can
+            if (start is not None or end is not None) and segment.start is None:
+                segment.close()
+                continue
+            if (start is not None and segment.end < start) or \
+                    (end is not None and segment.start >= end):
+                segment.close()
+                continue
+
+            blocks = segment.find_blocks(start, end, sensor_name)
+            for (uuid, version, encoded) in segment.iter_records(blocks):
+                full_scan = scan.decode(encoded)
+
+                # The index only narrows it down to blocks
+                time = scan_time(full_scan)
+                if start is not None and (time == '' or time < start):
+                    continue
+                if end is not None and (time == '' or time >= end):
+                    continue
+                if sensor_name is not None and full_scan.get_sensor_name() != sensor_name:
+                    continue
+
+                yield (full_scan, uuid, version)
+
+            segment.close()
+
+    def iter_scans(self, since=None, include_blobs=True):
+        '''Yields (scan, uuid, version) for scans taken at or after since
+
+        Args:
+            since (String): GPS time formatted like GpsScanner.scan() does it.
+                If None then every scan is returned.
+            include_blobs (bool): Unused, the blobs are packed in with the
+                rest of the scan so they are always read
+        '''
+        return self.get_scans(start=since)
+
+    def get_uuids(self):
+        '''Return all of the uuids of the Scans as a list'''
+        uuids = []
+        for path in self.segment_paths():
+            # The uuids are in the footer so nothing is decompressed
+            segment = Segment(path)
+            uuids += segment.get_uuids()
+            segment.close()
+
+        return uuids + self.pending_uuids()
+
+    def migrate_unique_ids(self):
+        # Segments are immutable so old ids are left as they are. They are
+        # compacted anyway when the scans are copied out with storage.stream.
+        utils.log("Archive segments are not migrated: " + self.path)
+
+    def close(self):
+        '''Finishes the segment being written, if there is one'''
+        self.flush()
@@ -0,0 +1,155 @@
+'''Recorded sensor input, so it can be replayed without the hardware.
+
+A modem log has one JSON object per line for each GsmScanner.scan():
+
+    {"start": 1488628862.1, "end": 1488628870.4, "freq_low": 0,
+     "freq_high": 127, "data_blob": "...",
+     "read_times": [[512, 1488628862.6], [1024, 1488628863.1], ...]}
+
+start and end are the sensor clock (seconds since the epoch) when the
+modem scan began and finished. read_times says when each part of the
+data_blob came in: the length of the blob so far and the time of the
+read, on the same clock. Older logs do not have it. A GPS log is what `gpspipe -w` prints,
+i.e. one gpsd JSON report per line. Only the TPV reports are used.
+'''
+import calendar
+import collections
+import datetime
+import json
+
+import common.utils as utils
+
+# How many of the latest fixes a GpsLog keeps for interpolation, like
+# sensor.gps.TRACK_SIZE
+TRACK_SIZE = 1200
+
+def write_modem_record(log_file, modem_data, start, end, read_times=None):
+    '''Appends one GsmScanner.scan() result to an open modem log
+
+    Args:
+        log_file (file): The modem log, opened for appending text
+        modem_data (dict): What GsmScanner.scan() returned
+        start (float): When the scan began (seconds since the epoch)
+        end (float): When the scan finished (seconds since the epoch)
+        read_times (list): (length of the blob so far, seconds since the
+            epoch) for each read of the modem
+    '''
+    record = {'start' : start,
+              'end' : end,
+              'freq_low' : modem_data['freq_low'],
+              'freq_high' : modem_data['freq_high'],
+              'data_blob' : modem_data['data_blob']}
+    if read_times is not None:
+        record['read_times'] = read_times
+
+    log_file.write(json.dumps(record) + "\n")
+    log_file.flush()
+
+def read_modem_log(path):
+    '''Yields each record of a modem log in order'''
+    with open(path) as log_file:
+        for line in log_file:
+            if line.strip() != '':
+                yield json.loads(line)
+
+def tpv_timestamp(tpv):
+    '''The time of a TPV report in seconds since the epoch, or None'''
+    if 'time' not in tpv:
+        return None
+
+    # gpsd times look like 2017-03-04T12:01:02.000Z
+    gps_time = utils.parse_gps_time(tpv['time'].replace('T', ' ').rstrip('Z'))
+    if gps_time is None:
+        return None
+
+    return calendar.timegm(gps_time.timetuple()) + gps_time.microsecond / 1e6
+
+def has_position(tpv):
+    '''True if a TPV report has a 2D or 3D fix'''
+    # Mode 2 is a 2D fix and mode 3 a 3D fix
+    mode = tpv.get('mode', None)
+    return mode is not None and mode >= 2 and \
+            tpv.get('lat', None) is not None and tpv.get('lon', None) is not None
+
+def gpsd_time(timestamp):
+    '''Formats seconds since the epoch like gpsd does, e.g. 2017-03-04T12:01:02.000Z'''
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def read_tpv_log(path):
+    '''Yields (timestamp, tpv) for each timed TPV report in a GPS log'''
+    with open(path) as log_file:
+        for line in log_file:
+            try:
+                report = json.loads(line)
+            except ValueError:
+                # gpspipe can cut off the last line
+                continue
+
+            if report.get('class', None) != 'TPV':
+                continue
+
+            timestamp = tpv_timestamp(report)
+            if timestamp is not None:
+                yield (timestamp, report)
+
+class GpsLog():
+    ''' Looks up the GPS fix at a given time in a GPS log.
+
+    The log is read as it is needed, so the lookups have to be made in
+    time order (which they are when replaying a modem log).
+    '''
+
+    def __init__(self, path, fresh, track_size=TRACK_SIZE):
+        '''
+        Args:
+            path (String): The GPS log
+            fresh (float): The oldest (in sec) a fix can be and still be used
+            track_size (int): How many fixes get_track() keeps
+        '''
+        self.reports = read_tpv_log(path)
+        self.fresh = fresh
+        self.current = None
+        # (timestamp, tpv) read from the log but later than the last lookup
+        self.ahead = collections.deque()
+
+        # The fixes with a position that have been read, and their times
+        self.track_times = collections.deque(maxlen=track_size)
+        self.track = collections.deque(maxlen=track_size)
+
+    def read_next(self):
+        '''Reads the next report onto self.ahead, or returns False at the end'''
+        report = next(self.reports, None)
+        if report is None:
+            return False
+
+        self.ahead.append(report)
+        if has_position(report[1]):
+            self.track_times.append(report[0])
+            self.track.append(report[1])
+
+        return True
+
+    def get(self, timestamp):
+        '''The latest TPV report at or before timestamp, or None if it is stale'''
+        while len(self.ahead) > 0 or self.read_next():
+            if self.ahead[0][0] > timestamp:
+                break
+            self.current = self.ahead.popleft()
+
+        if self.current is None or timestamp - self.current[0] > self.fresh:
+            return None
+
+        return self.current[1]
+
+    def get_track(self, timestamp):
+        '''The latest fixes with a position, up to the first one after timestamp
+
+        Return:
+            (deque, deque): The times and the TPV reports, in time order
+                (see sensor.gps.interpolate_track())
+        '''
+        while len(self.track_times) == 0 or self.track_times[-1] <= timestamp:
+            if not self.read_next():
+                break
+
+        return (self.track_times, self.track)
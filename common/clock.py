@@ -0,0 +1,196 @@
+'''Clocks that the sensor code reads the time from and sleeps on.
+
+Everything that waits takes a clock (REAL_CLOCK by default), so the same
+code can run against a VirtualClock. Virtual time only moves forward when
+every thread taking part is asleep, and then it jumps straight to the
+earliest wake up time. A day of survey runs in as long as the actual work
+takes (see simulate.py).
+'''
+import heapq
+import threading
+import time
+
+# How long (real sec) the driver waits for things to settle before it
+# moves virtual time forward. This gives I/O that is already in flight
+# (e.g. a command on its way to an emulator) a chance to wake its reader.
+SETTLE_TIME = 0.001
+
+class Clock():
+    ''' The real clock.'''
+
+    def time(self):
+        '''Seconds since the epoch'''
+        return time.time()
+
+    def monotonic(self):
+        '''Seconds from an arbitrary start that never go backwards'''
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def register(self):
+        pass
+
+    def unregister(self):
+        pass
+
+    def busy(self):
+        '''Marks the calling thread as doing work for the length of a with block
+
+        This only matters for a VirtualClock.
+        '''
+        return NoParticipation()
+
+class NoParticipation():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+REAL_CLOCK = Clock()
+
+class Participation():
+    ''' Keeps virtual time still while a thread does some work.'''
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def __enter__(self):
+        self.clock.register()
+        return self
+
+    def __exit__(self, *args):
+        self.clock.unregister()
+        return False
+
+class VirtualClock():
+    ''' A clock where time passes only when everyone is waiting for it.
+
+    A thread takes part once it calls sleep() (or register()), and from
+    then on virtual time will not move while it is awake. A thread that
+    only works now and then (like an emulator waiting on a pty) should
+    use busy() around the work instead, so that it does not hold time
+    still while it is idle. Call start() to run the driver thread that
+    moves the time forward.
+    '''
+
+    def __init__(self, start=None, settle_time=SETTLE_TIME):
+        '''
+        Args:
+            start (float): The virtual time to start at (seconds since the
+                epoch). Now by default.
+            settle_time (float): See SETTLE_TIME
+        '''
+        self.now = start if start is not None else time.time()
+        self.start_time = self.now
+        self.settle_time = settle_time
+
+        self.condition = threading.Condition()
+        # The ident of every thread taking part -> the number of busy()
+        # blocks it is in (0 for one that joined by sleeping)
+        self.participants = {}
+        self.n_sleeping = 0
+        # (wake up time, sequence number) for each sleeping thread
+        self.deadlines = []
+        self.sequence = 0
+
+        self.running = False
+        self.driver = None
+
+    def time(self):
+        with self.condition:
+            return self.now
+
+    def monotonic(self):
+        with self.condition:
+            return self.now - self.start_time
+
+    def register(self):
+        '''Makes the calling thread take part until unregister()'''
+        ident = threading.get_ident()
+        with self.condition:
+            self.participants[ident] = self.participants.get(ident, 0) + 1
+
+    def unregister(self):
+        ident = threading.get_ident()
+        with self.condition:
+            if ident in self.participants:
+                self.participants[ident] -= 1
+                if self.participants[ident] <= 0:
+                    del self.participants[ident]
+            self.condition.notify_all()
+
+    def busy(self):
+        return Participation(self)
+
+    def sleep(self, seconds):
+        ident = threading.get_ident()
+        with self.condition:
+            if ident not in self.participants:
+                self.participants[ident] = 0
+
+            deadline = self.now + max(seconds, 0)
+            entry = (deadline, self.sequence)
+            self.sequence += 1
+            heapq.heappush(self.deadlines, entry)
+            self.n_sleeping += 1
+            self.condition.notify_all()
+
+            while self.now < deadline:
+                self.condition.wait()
+
+            self.n_sleeping -= 1
+            self.deadlines.remove(entry)
+            heapq.heapify(self.deadlines)
+
+    def quiet(self):
+        '''True when every thread taking part is asleep
+
+        A thread that has been woken up but has not run yet still has its
+        (past) deadline in the heap, so it does not count as asleep.
+        '''
+        return len(self.participants) > 0 and self.n_sleeping >= len(self.participants) \
+                and len(self.deadlines) > 0 and self.deadlines[0][0] > self.now
+
+    def advance(self):
+        '''Moves time to the next wake up once everyone is asleep
+
+        Return:
+            (bool): False if it was stopped before time could move
+        '''
+        while True:
+            with self.condition:
+                while self.running and not self.quiet():
+                    self.condition.wait(self.settle_time)
+                if not self.running:
+                    return False
+
+                sequence = self.sequence
+
+            # Let anything in flight land, then check nothing changed
+            time.sleep(self.settle_time)
+
+            with self.condition:
+                if self.quiet() and self.sequence == sequence:
+                    self.now = max(self.now, self.deadlines[0][0])
+                    self.condition.notify_all()
+                    return True
+
+    def run(self):
+        while self.advance():
+            pass
+
+    def start(self):
+        '''Starts the thread that moves virtual time forward'''
+        self.running = True
+        self.driver = threading.Thread(target=self.run)
+        self.driver.daemon = True
+        self.driver.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.driver.join()
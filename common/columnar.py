@@ -0,0 +1,306 @@
+'''Columnar (Parquet or Arrow IPC) export of scans.
+
+The scans are split into four tables, written under the output directory
+and partitioned by the date of the scan:
+
+    scans/date=2017-03-04/part-....parquet          one row per scan
+    measurements/date=2017-03-04/part-....parquet   one row per measurement,
+                                                    with its own gps_ columns
+    bcch/date=2017-03-04/part-....parquet           one row per bcch measurement
+    neighbors/date=2017-03-04/part-....parquet      one row per neighbor list entry
+
+Every table has the scan_id (and, below scans, the index of the measurement
+in its scan) so they can be joined back together. The raw blobs are not
+exported.
+'''
+import collections
+import datetime
+import os
+
+# pyarrow is optional. It is only needed to export.
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import common.utils as utils
+import common.scan as scan
+
+# Rows buffered per table and partition before they are written out as one
+# row group (Parquet) or record batch (Arrow)
+ROW_GROUP_SIZE = 65536
+# Most partitions that can have open files and buffers at once. The least
+# recently used one is closed when another is needed, which bounds memory.
+MAX_OPEN_PARTITIONS = 4
+# The file extension for each output format
+FORMATS = {'parquet' : '.parquet', 'arrow' : '.arrows'}
+PARQUET_COMPRESSION = 'zstd'
+# Scans are logged every this many
+LOG_INTERVAL = 10000
+
+# The GPS fields are doubles except for these
+GPS_INT_FIELDS = ['mode']
+# The bcch fields are ints except for these
+BCCH_FLOAT_FIELDS = ['ber']
+BCCH_STRING_FIELDS = ['cell_status']
+
+def build_gps_columns(prefix):
+    '''The columns for a GPS point, named prefix + field'''
+    columns = []
+    for field in scan.GPS_FIELDS:
+        if field == 'time':
+            field_type = pyarrow.timestamp('ms')
+        elif field in GPS_INT_FIELDS:
+            field_type = pyarrow.int32()
+        else:
+            field_type = pyarrow.float64()
+        columns.append((prefix + field, field_type))
+
+    return columns
+
+def add_gps(row, prefix, gps_data):
+    '''Fills in the columns made by build_gps_columns(prefix)'''
+    for (field, value) in gps_data.items():
+        if field == 'time':
+            value = utils.parse_gps_time(value)
+        row[prefix + field] = value
+
+def build_schemas():
+    '''The pyarrow schema of each table'''
+    # Strings with only a few distinct values are dictionary encoded
+    category = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    time = pyarrow.timestamp('ms')
+
+    gps_columns = build_gps_columns('gps_before_') + build_gps_columns('gps_after_')
+
+    bcch_columns = []
+    for field in scan.BCCH_FIELDS:
+        if field in BCCH_FLOAT_FIELDS:
+            field_type = pyarrow.float64()
+        elif field in BCCH_STRING_FIELDS:
+            field_type = category
+        else:
+            field_type = pyarrow.int32()
+        bcch_columns.append((field, field_type))
+
+    # The columns every table starts with
+    key_columns = [('scan_id', pyarrow.string()),
+                   ('time', time),
+                   ('sensor_name', category)]
+    measurement_key_columns = key_columns + [('measurement', pyarrow.int32())]
+
+    return {'scans' : pyarrow.schema(key_columns +
+                                     [('version', pyarrow.int32()),
+                                      ('high_quality', pyarrow.bool_()),
+                                      ('error', pyarrow.bool_()),
+                                      ('jammed', pyarrow.bool_()),
+                                      ('freq_low', pyarrow.int32()),
+                                      ('freq_high', pyarrow.int32()),
+                                      ('lat', pyarrow.float64()),
+                                      ('lon', pyarrow.float64())] +
+                                     gps_columns),
+            'measurements' : pyarrow.schema(measurement_key_columns +
+                                            [('arfcn', pyarrow.int32()),
+                                             ('rx_lev', pyarrow.int32()),
+                                             ('bcch', pyarrow.bool_())] +
+                                            # Where the measurement itself was taken
+                                            # (see survey.locate_measurements)
+                                            build_gps_columns('gps_')),
+            'bcch' : pyarrow.schema(measurement_key_columns +
+                                    [('arfcn', pyarrow.int32()),
+                                     ('num_arfcn', pyarrow.int32()),
+                                     ('num_channels', pyarrow.int32())] +
+                                    bcch_columns),
+            'neighbors' : pyarrow.schema(measurement_key_columns +
+                                         [('list', category),
+                                          ('position', pyarrow.int32()),
+                                          ('value', pyarrow.int32())])}
+
+class Exporter():
+    ''' Streams scans into partitioned columnar files.
+
+    Rows are buffered column by column and written out a row group at a
+    time, so memory use depends on ROW_GROUP_SIZE and MAX_OPEN_PARTITIONS
+    and not on the number of scans. Call close() when done, the files are
+    not valid until then.
+    '''
+
+    def __init__(self, path, output_format='parquet', row_group_size=ROW_GROUP_SIZE):
+        '''Sets up the export into a directory (it is created if needed)
+
+        Args:
+            path (String): The output directory
+            output_format (String): 'parquet' or 'arrow' (the Arrow IPC stream format)
+            row_group_size (int): Rows per row group / record batch
+        '''
+        if pyarrow is None:
+            raise Exception("The pyarrow package is needed for columnar export")
+        if output_format not in FORMATS:
+            raise Exception("Unknown export format: " + str(output_format))
+
+        self.path = path
+        self.output_format = output_format
+        self.row_group_size = row_group_size
+        self.schemas = build_schemas()
+
+        # Keeps the files from different exports into the same directory apart
+        self.run_id = '{:%Y%m%dT%H%M%S}'.format(datetime.datetime.utcnow())
+        self.n_files = 0
+
+        # (table, partition) -> {'writer' : ..., 'columns' : {name : [values]}}
+        self.partitions = collections.OrderedDict()
+
+    def get_partition(self, table, partition):
+        '''The buffers and writer for one table and partition, opened if needed'''
+        key = (table, partition)
+        if key in self.partitions:
+            self.partitions.move_to_end(key)
+            return self.partitions[key]
+
+        while len(self.partitions) >= MAX_OPEN_PARTITIONS * len(self.schemas):
+            self.close_partition(next(iter(self.partitions)))
+
+        directory = os.path.join(self.path, table, 'date=' + partition)
+        os.makedirs(directory, exist_ok=True)
+
+        file_path = os.path.join(directory, 'part-{}-{:05d}{}'.format(
+                                self.run_id, self.n_files, FORMATS[self.output_format]))
+        self.n_files += 1
+
+        schema = self.schemas[table]
+        if self.output_format == 'parquet':
+            writer = pyarrow.parquet.ParquetWriter(file_path, schema,
+                                                   compression=PARQUET_COMPRESSION)
+        else:
+            # The stream format (unlike the file format) allows each record
+            # batch to have its own dictionaries
+            writer = pyarrow.ipc.new_stream(file_path, schema)
+
+        self.partitions[key] = {'writer' : writer,
+                                'columns' : {name : [] for name in schema.names}}
+
+        return self.partitions[key]
+
+    def add_row(self, table, partition, row):
+        '''Buffers a row, writing out the buffer once it is full'''
+        buffers = self.get_partition(table, partition)
+
+        columns = buffers['columns']
+        for name in columns:
+            columns[name].append(row.get(name, None))
+
+        if len(columns['scan_id']) >= self.row_group_size:
+            self.write_buffer(buffers, self.schemas[table])
+
+    def write_buffer(self, buffers, schema):
+        columns = buffers['columns']
+        if len(columns['scan_id']) == 0:
+            return
+
+        table = pyarrow.Table.from_pydict(columns, schema=schema)
+        buffers['writer'].write_table(table)
+
+        for name in columns:
+            columns[name] = []
+
+    def close_partition(self, key):
+        buffers = self.partitions.pop(key)
+        self.write_buffer(buffers, self.schemas[key[0]])
+        buffers['writer'].close()
+
+    def add_scan(self, full_scan, uuid, version):
+        '''Adds the rows for one scan to each of the tables'''
+        gps_before = full_scan.get_gps_before()
+        gps_after = full_scan.get_gps_after()
+        gsm = full_scan.get_gsm()
+
+        time = utils.parse_gps_time(gps_before.get_time())
+        partition = '{:%Y-%m-%d}'.format(time) if time is not None else 'unknown'
+
+        key = {'scan_id' : uuid,
+               'time' : time,
+               'sensor_name' : full_scan.get_sensor_name()}
+
+        row = dict(key)
+        (freq_low, freq_high) = gsm.get_freq_range()
+        location = full_scan.get_location()
+        row.update({'version' : version,
+                    'high_quality' : full_scan.get_high_quality(),
+                    'error' : gsm.get_error(),
+                    'jammed' : gsm.get_jammed(),
+                    'freq_low' : freq_low,
+                    'freq_high' : freq_high,
+                    'lat' : location[0] if location is not None else None,
+                    'lon' : location[1] if location is not None else None})
+
+        add_gps(row, 'gps_before_', gps_before.get_gps_data())
+        add_gps(row, 'gps_after_', gps_after.get_gps_data())
+
+        self.add_row('scans', partition, row)
+
+        for (i, measurement) in enumerate(gsm.measurement_cursor()):
+            doc = measurement.document()
+
+            meas_key = dict(key)
+            meas_key['measurement'] = i
+
+            row = dict(meas_key)
+            row.update({'arfcn' : doc['arfcn'],
+                        'rx_lev' : doc['rx_lev'],
+                        'bcch' : 'bcch' in doc})
+            if 'gps' in doc:
+                add_gps(row, 'gps_', doc['gps'])
+            self.add_row('measurements', partition, row)
+
+            if 'bcch' not in doc:
+                continue
+
+            bcch = doc['bcch']
+            row = dict(meas_key)
+            row['arfcn'] = doc['arfcn']
+            row.update(bcch)
+            self.add_row('bcch', partition, row)
+
+            for (list_name, values) in [('arfcn', bcch['arfcns']),
+                                        ('channel', bcch['channels'])]:
+                for (position, value) in enumerate(values):
+                    row = dict(meas_key)
+                    row.update({'list' : list_name,
+                                'position' : position,
+                                'value' : value})
+                    self.add_row('neighbors', partition, row)
+
+    def close(self):
+        '''Writes out everything still buffered and finishes the files'''
+        while len(self.partitions) > 0:
+            self.close_partition(next(iter(self.partitions)))
+
+def export(source, path, output_format='parquet', since=None, row_group_size=ROW_GROUP_SIZE):
+    '''Exports every scan in a storage backend
+
+    Args:
+        source: The backend to read from (see common.storage)
+        path (String): The output directory
+        output_format (String): 'parquet' or 'arrow'
+        since (String): Only export scans taken at or after this GPS time
+        row_group_size (int): Rows per row group / record batch
+
+    Return:
+        int: The number of scans that were exported
+    '''
+    exporter = Exporter(path, output_format, row_group_size)
+
+    n_scans = 0
+    for (full_scan, uuid, version) in source.iter_scans(since=since, include_blobs=False):
+        exporter.add_scan(full_scan, uuid, version)
+        n_scans += 1
+
+        if n_scans % LOG_INTERVAL == 0:
+            utils.log("Exported {:d} scans".format(n_scans))
+
+    exporter.close()
+    utils.log("Exported {:d} scans to {}".format(n_scans, path))
+
+    return n_scans
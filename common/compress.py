@@ -0,0 +1,144 @@
+import os
+import zlib
+
+# zstd is optional. Without it everything falls back on zlib.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 10
+# Size of a trained zstd dictionary (in bytes)
+DICT_SIZE = 16 * 1024
+# Where the trained zstd dictionary is kept by default
+DICT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blob.dict')
+
+# The zstd dictionaries that have been loaded, keyed by their dict id
+dictionaries = {}
+
+def load_dictionary(path=DICT_PATH):
+    '''Loads a trained zstd dictionary so it can be used for (de)compression
+
+    Args:
+        path (String): The dictionary file made by train_dictionary()
+
+    Return:
+        (int): The id of the dictionary
+    '''
+    if zstandard is None:
+        raise Exception("The zstandard package is needed for zstd dictionaries")
+
+    with open(path, 'rb') as f:
+        zdict = zstandard.ZstdCompressionDict(f.read())
+
+    dictionaries[zdict.dict_id()] = zdict
+
+    return zdict.dict_id()
+
+def train_dictionary(blobs, size=DICT_SIZE):
+    '''Trains a zstd dictionary on a sample of raw modem blobs
+
+    The #CSURV text repeats the same field names over and over so a
+    dictionary lets even a single short scan compress well.
+
+    Args:
+        blobs (list of String): Sample scan blobs
+        size (int): The size of the dictionary in bytes
+
+    Return:
+        (bytes): The dictionary, ready to be written to a file
+    '''
+    if zstandard is None:
+        raise Exception("The zstandard package is needed for zstd dictionaries")
+
+    samples = [blob.encode('utf-8') for blob in blobs]
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+def compress(text, method='zlib', dict_id=None):
+    '''Compresses a raw blob
+
+    Args:
+        text (String): The blob
+        method (String): Either 'zlib' or 'zstd'
+        dict_id (int): A loaded zstd dictionary to use (optional)
+
+    Return:
+        (bytes): The compressed blob
+    '''
+    raw = text.encode('utf-8')
+
+    if method == 'zlib':
+        return zlib.compress(raw, ZLIB_LEVEL)
+    elif method == 'zstd':
+        if zstandard is None:
+            raise Exception("The zstandard package is needed for zstd compression")
+        zdict = dictionaries[dict_id] if dict_id is not None else None
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zdict).compress(raw)
+
+    raise Exception("Unknown blob compression: " + str(method))
+
+def decompress(data, method='zlib', dict_id=None):
+    '''Undoes compress()'''
+    if method == 'zlib':
+        raw = zlib.decompress(data)
+    elif method == 'zstd':
+        if zstandard is None:
+            raise Exception("The zstandard package is needed for zstd compression")
+        if dict_id is not None and dict_id not in dictionaries:
+            raise Exception("The zstd dictionary {} has not been loaded".format(dict_id))
+        zdict = dictionaries[dict_id] if dict_id is not None else None
+        raw = zstandard.ZstdDecompressor(dict_data=zdict).decompress(data)
+    else:
+        raise Exception("Unknown blob compression: " + str(method))
+
+    return raw.decode('utf-8')
+
+def compress_gsm_document(gsm, method='zlib', dict_id=None):
+    '''Compresses the blobs of a Gsm_Scan.document() in place
+
+    The method used is recorded in 'blob_encoding' (and 'blob_dict' for a
+    zstd dictionary). Documents without 'blob_encoding' are uncompressed,
+    which is how all of the older documents look.
+    '''
+    if gsm.get('scan_blob', None) is not None:
+        gsm['scan_blob'] = compress(gsm['scan_blob'], method, dict_id)
+
+    for meas in gsm['measurements']:
+        if meas.get('measurement_blob', None) is not None:
+            meas['measurement_blob'] = compress(meas['measurement_blob'], method, dict_id)
+
+    gsm['blob_encoding'] = method
+    if dict_id is not None:
+        gsm['blob_dict'] = dict_id
+
+    return gsm
+
+def decompress_gsm_document(gsm):
+    '''Returns a copy of a gsm document with its blobs decompressed
+
+    Documents that were never compressed are returned as they are.
+    '''
+    if 'blob_encoding' not in gsm:
+        return gsm
+
+    method = gsm['blob_encoding']
+    dict_id = gsm.get('blob_dict', None)
+
+    # Copy so that the caller's document is left alone
+    gsm = dict(gsm)
+    del gsm['blob_encoding']
+    gsm.pop('blob_dict', None)
+
+    if gsm.get('scan_blob', None) is not None:
+        gsm['scan_blob'] = decompress(gsm['scan_blob'], method, dict_id)
+
+    measurements = []
+    for meas in gsm['measurements']:
+        if meas.get('measurement_blob', None) is not None:
+            meas = dict(meas)
+            meas['measurement_blob'] = decompress(meas['measurement_blob'], method, dict_id)
+        measurements.append(meas)
+    gsm['measurements'] = measurements
+
+    return gsm
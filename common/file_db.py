@@ -0,0 +1,123 @@
+import mmap
+import os
+
+import common.utils as utils
+import common.scan as scan
+
+# Every spool file starts with this so we know how to read it
+SPOOL_MAGIC = b'SGSPOOL\x01'
+
+class Database():
+    ''' A flat, append only spool file of scans.
+
+    Each record is a varint length followed by the uuid, the version and
+    the scan packed with scan.encode(). This needs nothing installed on
+    the sensor and is easy to copy around, so it is handy for moving scans
+    between machines.
+    '''
+
+    # The raw blobs are kept, so a copy into this backend should include them
+    stores_blobs = True
+
+    def __init__(self, path):
+        '''Opens the spool file for appending (it is created if needed)
+
+        Args:
+            path (String): The path to the spool file
+        '''
+        self.path = path
+        self.spool = open(path, 'ab')
+
+        if self.spool.tell() == 0:
+            self.spool.write(SPOOL_MAGIC)
+            self.spool.flush()
+
+    def write_batch(self, scan_uuids):
+        '''Appends a list of (scan, uuid, version) to the spool'''
+        utils.log("Trying to write to the DB...")
+        buf = bytearray()
+        for (full_scan, uuid, version) in scan_uuids:
+            record = bytearray()
+            scan.write_str(record, uuid)
+            scan.write_varint(record, version)
+            record += scan.encode(full_scan)
+
+            scan.write_varint(buf, len(record))
+            buf += record
+
+        self.spool.write(buf)
+
+        # Make sure the batch is actually on disk before we return
+        self.spool.flush()
+        os.fsync(self.spool.fileno())
+        utils.log("Done writing to DB.")
+
+    def iter_records(self):
+        '''Yields (uuid, version, encoded_scan) for every record in the spool'''
+        self.spool.flush()
+
+        # Mapping the file lets the OS page it in as we go rather than
+        # reading the whole spool into memory
+        with open(self.path, 'rb') as spool:
+            data = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if data[:len(SPOOL_MAGIC)] != SPOOL_MAGIC:
+            data.close()
+            raise Exception("Not a scan spool file: " + self.path)
+
+        pos = len(SPOOL_MAGIC)
+        while pos < len(data):
+            try:
+                (length, start) = scan.read_varint(data, pos)
+            except IndexError:
+                length = None
+
+            # A crash in the middle of a write can leave a partial record
+            # at the end of the file
+            if length is None or start + length > len(data):
+                utils.log("Skipping truncated record at the end of " + self.path)
+                break
+
+            (uuid, record_pos) = scan.read_str(data, start)
+            (version, record_pos) = scan.read_varint(data, record_pos)
+            pos = start + length
+
+            yield (uuid, version, data[record_pos:pos])
+
+        data.close()
+
+    def iter_scans(self, since=None, include_blobs=True):
+        '''Yields (scan, uuid, version) for scans taken at or after since
+
+        Args:
+            since (String): GPS time formatted like GpsScanner.scan() does it.
+                If None then every scan is returned.
+            include_blobs (bool): Unused, the blobs are packed in with the
+                rest of the scan so they are always read
+        '''
+        for (uuid, version, encoded) in self.iter_records():
+            full_scan = scan.decode(encoded)
+
+            if since is not None:
+                time = full_scan.get_gps_before().get_time()
+                if time is None or time < since:
+                    continue
+
+            yield (full_scan, uuid, version)
+
+    def get_uuids(self):
+        '''Return all of the uuids of the Scans as a list'''
+        # No need to decode the scans themselves
+        return [uuid for (uuid, _, _) in self.iter_records()]
+
+    def migrate_unique_ids(self):
+        # The spool is append only so old ids are left as they are. They are
+        # compacted anyway when the scans are copied out with storage.stream.
+        utils.log("Spool files are not migrated: " + self.path)
+
+    def flush(self):
+        # write_batch() already syncs every batch to disk
+        pass
+
+    def close(self):
+        self.spool.close()
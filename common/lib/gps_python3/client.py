@@ -151,7 +151,7 @@ class GPSJson:
 
     def unpack(self, buf):
         try:
-            self.data = DictWrapper(json.loads(buf.strip(), encoding="ascii"))
+            self.data = DictWrapper(json.loads(buf.strip()))
         except ValueError as e:
             raise JsonError(buf, e.args[0])
         # Should be done for any other array-valued subobjects, too.
@@ -0,0 +1,255 @@
+'''Leveled logging that stays off the scan loop's back.
+
+A call only puts a record (time, level, message, args, fields) on a ring
+buffer. A background thread formats the records and writes them out in
+batches, with one flush per batch, so a slow SD card costs the survey
+nothing. Formatting is lazy:
+
+    logger.info("Reading arfcn range: ({}, {})", freq_low, freq_high)
+
+only calls format() if the record is written. Records below the level
+are dropped straight away. The output is the usual
+
+    2017-03-04 12:01:02: Reading arfcn range: (0, 127)
+
+or one JSON object per line with LOG_FORMAT = 'json'. If the writer falls
+so far behind that the ring buffer fills, the oldest records are dropped
+and a count of them is logged. ERROR records are written out right away.
+'''
+import atexit
+import collections
+import datetime
+import json
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG : 'DEBUG', INFO : 'INFO', WARNING : 'WARNING', ERROR : 'ERROR'}
+
+# Records below this level are not logged
+LOG_LEVEL = INFO
+# 'text' or 'json'
+LOG_FORMAT = 'text'
+# How many records can wait for the writer before the oldest are dropped
+RING_SIZE = 10000
+# How often (in sec) the writer wakes up to write what has been logged
+FLUSH_INTERVAL = 0.5
+
+# The fields of a gpsd report in the order (and with the descriptions)
+# they are logged in text
+GPS_FIELDS = [('ept', "estimated time stamp error"),
+              ('lat', "latitude"),
+              ('lon', "longitude"),
+              ('alt', "altitude"),
+              ('epx', "estimated error in longitude (m)"),
+              ('epy', "estimated error in latitude (m)"),
+              ('epv', "estimated vertical error (m)"),
+              ('track', "course over ground (deg from true N)"),
+              ('speed', "speed over ground (m/s)"),
+              ('climb', "climb (+) or sink (-) (m/s)"),
+              ('epd', "direction error (deg)"),
+              ('eps', "speed error (m/s)"),
+              ('epc', "climb/sink error (m/s)")]
+
+def gps_lines(gps_data):
+    '''The multi-line text form of a gpsd report'''
+    lines = ["  {} - {}: {}".format(key, description, gps_data.get(key, None)) \
+                for (key, description) in GPS_FIELDS]
+    lines.append("  mode (what kind of fix): " + str(gps_data.get('mode', None)))
+    lines.append("  time: " + str(gps_data.get('time', None)))
+
+    return ":\n" + "\n".join(lines)
+
+def json_default(value):
+    # bytes and anything else json does not know are logged as text
+    return repr(value) if isinstance(value, bytes) else str(value)
+
+class Logger():
+    ''' Queues records and writes them from a background thread.'''
+
+    def __init__(self, stream=None, level=LOG_LEVEL, fmt=LOG_FORMAT, ring_size=RING_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        '''
+        Args:
+            stream (file): Where the records go. sys.stdout (whatever it is
+                at the time of writing) by default.
+            level (int): Records below this level are dropped
+            fmt (String): 'text' or 'json'
+            ring_size (int): See RING_SIZE
+            flush_interval (float): See FLUSH_INTERVAL
+        '''
+        self.stream = stream
+        self.level = level
+        self.fmt = fmt
+        self.flush_interval = flush_interval
+
+        # deque appends and pops are atomic so the loggers need no lock
+        self.records = collections.deque(maxlen=ring_size)
+        self.n_dropped = 0
+
+        # Only one thread writes at a time so the lines are in order
+        self.write_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+
+    def log(self, level, message, *args, raw=False, **fields):
+        '''Queues a record
+
+        Args:
+            level (int): DEBUG, INFO, WARNING or ERROR
+            message: The message. It is formatted with args (str.format)
+                when it is written, if there are any.
+            raw (bool): Write the message alone, with no timestamp
+            fields: Extra values for the record. They are keys of the JSON
+                object or key=value pairs after the message in text.
+                A gps_data field is written out as a gpsd report.
+        '''
+        if level < self.level:
+            return
+
+        if len(self.records) == self.records.maxlen:
+            self.n_dropped += 1
+        self.records.append((time.time(), level, message, args, raw, fields))
+
+        if self.writer is None:
+            self.start_writer()
+
+        if level >= ERROR:
+            self.wake.set()
+
+    def debug(self, message, *args, **fields):
+        self.log(DEBUG, message, *args, **fields)
+
+    def info(self, message, *args, **fields):
+        self.log(INFO, message, *args, **fields)
+
+    def warning(self, message, *args, **fields):
+        self.log(WARNING, message, *args, **fields)
+
+    def error(self, message, *args, **fields):
+        self.log(ERROR, message, *args, **fields)
+
+    def start_writer(self):
+        with self.writer_lock:
+            if self.writer is not None:
+                return
+
+            self.writer = threading.Thread(target=self.run)
+            self.writer.daemon = True
+            self.writer.start()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def format_text(self, record):
+        (timestamp, level, message, args, raw, fields) = record
+
+        text = str(message)
+        if len(args) > 0:
+            text = text.format(*args)
+
+        gps_data = None
+        for (key, value) in fields.items():
+            if key == 'gps_data':
+                gps_data = value
+            else:
+                text += " {}={}".format(key, value)
+
+        if gps_data is not None:
+            text += gps_lines(gps_data)
+
+        if raw:
+            return text
+
+        when = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        if level == INFO:
+            return when + ": " + text
+        return when + ": " + LEVEL_NAMES.get(level, str(level)) + ": " + text
+
+    def format_json(self, record):
+        (timestamp, level, message, args, raw, fields) = record
+
+        text = str(message)
+        if len(args) > 0:
+            text = text.format(*args)
+
+        doc = {'time' : timestamp,
+               'level' : LEVEL_NAMES.get(level, str(level)),
+               'message' : text}
+        doc.update(fields)
+
+        return json.dumps(doc, default=json_default)
+
+    def flush(self):
+        '''Writes out everything that has been logged so far'''
+        with self.write_lock:
+            if len(self.records) == 0:
+                return
+
+            format_record = self.format_json if self.fmt == 'json' else self.format_text
+
+            lines = []
+            if self.n_dropped > 0:
+                lines.append(format_record((time.time(), WARNING,
+                                            "Dropped {:d} log records", (self.n_dropped,),
+                                            False, {})))
+                self.n_dropped = 0
+
+            while len(self.records) > 0:
+                try:
+                    record = self.records.popleft()
+                except IndexError:
+                    break
+
+                try:
+                    lines.append(format_record(record))
+                except Exception as e:
+                    # A bad format string should not take the logger down
+                    lines.append("Could not format log record {!r}: {}".format(record[2], e))
+
+            stream = self.stream if self.stream is not None else sys.stdout
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+
+# The logger the module level functions (and utils.log) use
+LOGGER = Logger()
+
+# Nothing logged should be lost when the program exits
+atexit.register(LOGGER.flush)
+
+def configure(level=None, fmt=None, stream=None):
+    '''Changes the level, format or stream of the module level logger'''
+    if level is not None:
+        LOGGER.level = level
+    if fmt is not None:
+        if fmt not in ['text', 'json']:
+            raise Exception("Unknown log format: " + str(fmt))
+        LOGGER.fmt = fmt
+    if stream is not None:
+        LOGGER.stream = stream
+
+def log(level, message, *args, **fields):
+    LOGGER.log(level, message, *args, **fields)
+
+def debug(message, *args, **fields):
+    LOGGER.log(DEBUG, message, *args, **fields)
+
+def info(message, *args, **fields):
+    LOGGER.log(INFO, message, *args, **fields)
+
+def warning(message, *args, **fields):
+    LOGGER.log(WARNING, message, *args, **fields)
+
+def error(message, *args, **fields):
+    LOGGER.log(ERROR, message, *args, **fields)
+
+def flush():
+    LOGGER.flush()
@@ -0,0 +1,271 @@
+'''Counters and latency histograms for the survey loop.
+
+The sensor code records into the module level registry:
+
+    with metrics.timer('gsm_command_seconds', split='0-127'):
+        ...
+    metrics.observe('measurements_per_scan', n)
+    metrics.increment('scan_errors_total')
+
+Nothing is exposed until survey.py asks for it: serve() answers
+Prometheus text format on http://<host>:<port>/metrics and StatsWriter
+writes the same numbers to a JSON file every so often. Recording is a
+dict lookup and a bisect under a lock, cheap next to a modem read.
+'''
+import bisect
+import http.server
+import json
+import os
+import threading
+import time
+
+import common.utils as utils
+
+# Upper bounds (in sec) of the latency buckets. The modem can take up to
+# MODEM_TIMELIMIT (2 min) on a command so the top end goes well past that.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 25, 60, 120, 300)
+# Upper bounds of the buckets for plain counts (e.g. measurements per scan)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# How often (in sec) StatsWriter writes the stats file
+STATS_INTERVAL = 10
+# Where serve() listens by default
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
+# What each metric is, for the # HELP lines. Metrics that are not listed
+# here still work, they just have no help text.
+HELP = {'gps_scan_seconds' : "Time to take a snapshot of the GPS fix",
+        'gsm_command_seconds' : "Time for an AT command to finish, by FREQUENCY_SPLIT range",
+        'gsm_read_polls' : "Reads of the modem before an AT command finished",
+        'gsm_decode_errors_total' : "Modem replies that were not valid UTF-8",
+        'gsm_timeouts_total' : "AT commands that hit MODEM_TIMELIMIT",
+        'gsm_retries_total' : "Times the modem was cleared after bad data to try again",
+        'parse_seconds' : "Time to parse the modem output into a Gsm_Scan",
+        'measurements_per_scan' : "Measurements parsed out of each scan",
+        'db_write_seconds' : "Time to write a scan to storage",
+        'db_write_retries_total' : "Failed database writes that were tried again",
+        'scan_seconds' : "Time for a whole scan iteration",
+        'scans_total' : "Scans completed",
+        'scan_errors_total' : "Scans that failed with an exception"}
+
+class Histogram():
+    ''' Counts observations into cumulative buckets, like Prometheus does.'''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # The last one is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        '''(upper bound, observations at or below it) for each bucket'''
+        total = 0
+        res = []
+        for (bound, n) in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            res.append((bound, total))
+        return res
+
+    def quantile(self, q):
+        '''Estimates a quantile as the upper bound of the bucket it falls in'''
+        if self.count == 0:
+            return None
+
+        for (bound, total) in self.cumulative():
+            if total >= q * self.count:
+                return bound
+
+    def document(self):
+        return {'count' : self.count,
+                'sum' : self.sum,
+                'p50' : self.quantile(0.5),
+                'p90' : self.quantile(0.9),
+                'p99' : self.quantile(0.99),
+                'buckets' : [[format_value(bound), total] for (bound, total) in self.cumulative()]}
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+def label_key(labels):
+    '''Makes a dict of labels hashable (and always in the same order)'''
+    return tuple(sorted((name, str(value)) for (name, value) in labels.items()))
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for (name, value) in pairs) + '}'
+
+class Registry():
+    ''' All of the counters and histograms, by name and labels.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> label key -> value (a number for counters, a Histogram otherwise)
+        self.counters = {}
+        self.histograms = {}
+        self.start = time.time()
+
+    def increment(self, name, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = label_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def render(self):
+        '''Everything in the Prometheus text format'''
+        lines = []
+        with self.lock:
+            for (name, series) in sorted(self.counters.items()):
+                if name in HELP:
+                    lines.append('# HELP {} {}'.format(name, HELP[name]))
+                lines.append('# TYPE {} counter'.format(name))
+                for (key, value) in sorted(series.items()):
+                    lines.append('{}{} {}'.format(name, format_labels(key), value))
+
+            for (name, series) in sorted(self.histograms.items()):
+                if name in HELP:
+                    lines.append('# HELP {} {}'.format(name, HELP[name]))
+                lines.append('# TYPE {} histogram'.format(name))
+                for (key, hist) in sorted(series.items()):
+                    for (bound, total) in hist.cumulative():
+                        lines.append('{}_bucket{} {:d}'.format(name,
+                                        format_labels(key, [('le', format_value(bound))]), total))
+                    lines.append('{}_sum{} {!r}'.format(name, format_labels(key), hist.sum))
+                    lines.append('{}_count{} {:d}'.format(name, format_labels(key), hist.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def document(self):
+        '''Everything as a dict that can be dumped as JSON'''
+        with self.lock:
+            doc = {'time' : time.time(),
+                   'uptime' : time.time() - self.start,
+                   'counters' : {},
+                   'histograms' : {}}
+
+            for (name, series) in self.counters.items():
+                doc['counters'][name] = [{'labels' : dict(key), 'value' : value} \
+                                            for (key, value) in sorted(series.items())]
+
+            for (name, series) in self.histograms.items():
+                doc['histograms'][name] = [dict(hist.document(), labels=dict(key)) \
+                                              for (key, hist) in sorted(series.items())]
+
+        return doc
+
+class Timer():
+    ''' Observes how long (in sec) a with block takes.'''
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+        self.registry.observe(self.name, self.elapsed, **self.labels)
+        return False
+
+# The registry the module level functions record into
+REGISTRY = Registry()
+
+def increment(name, amount=1, **labels):
+    REGISTRY.increment(name, amount, **labels)
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    REGISTRY.observe(name, value, buckets, **labels)
+
+def timer(name, **labels):
+    return Timer(REGISTRY, name, labels)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would drown out the survey log
+        pass
+
+def serve(port=METRICS_PORT, host=METRICS_HOST, registry=REGISTRY):
+    '''Serves the metrics over HTTP from a background thread
+
+    Return:
+        (HTTPServer): Call shutdown() on it to stop
+    '''
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    utils.log("Serving metrics on http://{}:{:d}/metrics".format(host, server.server_address[1]))
+
+    return server
+
+def write_stats(path, registry=REGISTRY):
+    '''Writes the metrics to a JSON file
+
+    The file is replaced in one go so a reader never sees half of it.
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(registry.document(), f, indent=1)
+    os.replace(tmp_path, path)
+
+class StatsWriter(threading.Thread):
+    ''' Writes the stats file every STATS_INTERVAL seconds.'''
+
+    def __init__(self, path, interval=STATS_INTERVAL, registry=REGISTRY):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+
+        self.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            write_stats(self.path, self.registry)
+
+    def stop(self):
+        '''Stops and writes the file one last time'''
+        self.stopped.set()
+        self.join()
+        write_stats(self.path, self.registry)
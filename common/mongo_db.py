@@ -1,25 +1,132 @@
 from pprint import pprint
 import pymongo
+import pymongo.errors
+import bson
+import bson.codec_options
+import bson.raw_bson
 import time
-import sys
+import uuid
 import traceback
-import os
-import base64
 import datetime
 
 import common.utils as utils
 import common.scan as scan
+import common.compress as compress
+import common.metrics as metrics
+import common.logger as logger
 
 DB_INSERT_TIMEOUT = 1
 # Used to prevent timeouts on cursors
 BATCH_SIZE = 1000
 # Nice to have some versioning
 VERSION = 0
+# How the raw blobs are compressed in new documents ('zlib', 'zstd' or None)
+BLOB_COMPRESSION = 'zlib'
+# Used to turn a radius in meters into radians for $centerSphere
+EARTH_RADIUS = 6378100.0
+# The error code mongo uses for a unique index violation
+DUPLICATE_KEY_ERROR = 11000
+# The largest $in list used when looking scans up by id
+LOOKUP_BATCH_SIZE = 500
+# Number of measurements to buffer before writing to a time-series collection
+TIMESERIES_BATCH_SIZE = 1000
+# Leaves the raw blobs out of a query when they are not needed
+NO_BLOBS_PROJECTION = {'gsm.scan_blob' : False,
+                       'gsm.measurements.measurement_blob' : False}
+# Number of documents the retention jobs touch before pausing
+RETENTION_BATCH_SIZE = 100
+# How long (in sec) the retention jobs sleep between batches so that they
+# leave the disk to survey.py
+RETENTION_PAUSE = 1.0
+# Documents come back undecoded and each field is only decoded when read
+RAW_CODEC_OPTIONS = bson.codec_options.CodecOptions(
+                                document_class=bson.raw_bson.RawBSONDocument)
+
+def to_mongo_id(unique_id):
+    '''Stores a UUID string as 16 bytes. Old style ids are kept as strings.'''
+    try:
+        return bson.binary.Binary(uuid.UUID(unique_id).bytes, bson.binary.UUID_SUBTYPE)
+    except ValueError:
+        return unique_id
+
+def from_mongo_id(unique_id):
+    '''Undoes to_mongo_id()'''
+    # Depending on the pymongo version this comes back as a UUID or as bytes
+    if isinstance(unique_id, uuid.UUID):
+        return str(unique_id)
+    elif isinstance(unique_id, bytes):
+        return str(uuid.UUID(bytes=bytes(unique_id)))
+
+    return unique_id
+
+def measurement_documents(mongo_dict, timeseries=False):
+    '''Splits a scan document into one document per measurement
+
+    Each one points back at its scan with scan_id and carries the scan time
+    and location, so measurements can be queried without the scan. A
+    measurement that was located on its own (see survey.locate_measurements)
+    gets its own time and location instead. The bcch fields are lifted to
+    the top level so that they can be indexed.
+
+    For a time-series collection the time is a real datetime and the
+    sensor_name and arfcn go into the meta field that the buckets are
+    grouped by. Measurements without a GPS time are left out since a
+    time-series collection cannot store them.
+    '''
+    gps_time = mongo_dict['gps_before'].get('time', None)
+    if timeseries:
+        gps_time = utils.parse_gps_time(gps_time)
+        if gps_time is None:
+            return []
+
+    meas_dicts = []
+    for meas in mongo_dict['gsm']['measurements']:
+        meas_time = gps_time
+        location = mongo_dict.get('location', None)
+
+        if 'gps' in meas:
+            meas_gps = scan.Gps_Scan(meas['gps'])
+            own_time = meas['gps'].get('time', None)
+            if timeseries:
+                own_time = utils.parse_gps_time(own_time)
+            if own_time is not None:
+                meas_time = own_time
+
+            lat_lon = meas_gps.get_lat_lon()
+            if lat_lon is not None:
+                location = {'type' : 'Point',
+                            'coordinates' : [lat_lon[1], lat_lon[0]]}
+
+        meas_dict = {'scan_id' : mongo_dict['unique_id'],
+                     'time' : meas_time,
+                     'rx_lev' : meas['rx_lev']}
+
+        if timeseries:
+            meas_dict['meta'] = {'sensor_name' : mongo_dict['sensor_name'],
+                                 'arfcn' : meas['arfcn']}
+        else:
+            meas_dict['sensor_name'] = mongo_dict['sensor_name']
+            meas_dict['arfcn'] = meas['arfcn']
+
+        if location is not None:
+            meas_dict['location'] = location
+
+        if 'bcch' in meas:
+            meas_dict.update(meas['bcch'])
+
+        meas_dicts.append(meas_dict)
+
+    return meas_dicts
 
 class Database():
     ''' This is a helpful class to handle the necessary database operations'''
 
-    def __init__(self, db_name, collection_name, host="localhost", port=27017, authentication=None):
+    # The raw blobs are kept, so a copy into this backend should include them
+    stores_blobs = True
+
+    def __init__(self, db_name, collection_name, host="localhost", port=27017, authentication=None,
+                 blob_compression=BLOB_COMPRESSION, blob_dict=None,
+                 measurement_collection_name=None, timeseries=False):
         '''Establishes the database connection
 
         Args:
@@ -31,6 +138,17 @@ class Database():
                 This specifies the authentication parameters if necessary. If not specified
                 then no authentication is used. All of these arguments must be present in
                 the authenticaiton string.
+            blob_compression (String): How to compress the raw blobs of new documents.
+                Either 'zlib', 'zstd' or None to store them as plain text. Documents
+                are always read correctly whatever this is set to.
+            blob_dict (String): Path to a trained zstd dictionary (optional)
+            measurement_collection_name (String): If given, every measurement is also
+                written as its own document to this collection so that it can be
+                queried by index (see get_measurements).
+            timeseries (bool): Make the measurement collection a MongoDB (5.0+)
+                time-series collection keyed by GPS time and (sensor_name, arfcn).
+                Its writes are buffered and sent TIMESERIES_BATCH_SIZE at a time,
+                so call flush() or close() when done.
         '''
         client = pymongo.MongoClient(host, port)
 
@@ -47,8 +165,255 @@ class Database():
                                         authentication['password'], \
                                         source=authentication['source'])
 
+        self.client = client
         self.collection = client[db_name][collection_name]
 
+        self.measurement_collection = None
+        self.timeseries = timeseries
+        self.measurement_buffer = []
+        if measurement_collection_name is not None:
+            database = client[db_name]
+
+            # A time-series collection has to be created explicitly
+            if timeseries and \
+                    measurement_collection_name not in database.list_collection_names():
+                database.create_collection(measurement_collection_name,
+                                           timeseries={'timeField' : 'time',
+                                                       'metaField' : 'meta',
+                                                       'granularity' : 'seconds'})
+
+            self.measurement_collection = database[measurement_collection_name]
+
+        self.blob_compression = blob_compression
+        self.blob_dict_id = None
+        if blob_dict is not None:
+            self.blob_dict_id = compress.load_dictionary(blob_dict)
+
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        '''Creates the indexes for the usual lookups (does nothing if they exist)'''
+        self.collection.create_index([('unique_id', pymongo.ASCENDING)], unique=True)
+        self.collection.create_index([('sensor_name', pymongo.ASCENDING)])
+        self.collection.create_index([('gps_before.time', pymongo.ASCENDING)])
+        self.collection.create_index([('gsm.freq_low', pymongo.ASCENDING),
+                                      ('gsm.freq_high', pymongo.ASCENDING)])
+        # Scans without a GPS fix have no location and are left out
+        self.collection.create_index([('location', pymongo.GEOSPHERE)])
+
+        if self.measurement_collection is not None:
+            self.measurement_collection.create_index([('scan_id', pymongo.ASCENDING)])
+            self.measurement_collection.create_index([('mcc', pymongo.ASCENDING),
+                                                      ('mnc', pymongo.ASCENDING),
+                                                      ('lac', pymongo.ASCENDING),
+                                                      ('cell_id', pymongo.ASCENDING)])
+            # Time-series collections already keep (meta, time) in order
+            # within their buckets but the index still helps find them
+            arfcn_field = 'meta.arfcn' if self.timeseries else 'arfcn'
+            self.measurement_collection.create_index([(arfcn_field, pymongo.ASCENDING),
+                                                      ('time', pymongo.ASCENDING)])
+
+    def migrate_unique_ids(self):
+        '''Rewrites the old 172 character unique_ids as 16 byte UUIDs
+
+        The new id is derived from the old one (see utils.compact_unique_id)
+        so scans that were already exported keep matching their copies.
+        '''
+        utils.log("Migrating unique ids...")
+
+        # Only the old ids are stored as strings
+        points = self.collection.find({'unique_id' : {'$type' : 'string'}},
+                                      {'unique_id' : True})
+        points.batch_size(BATCH_SIZE)
+
+        n_migrated = 0
+        updates = []
+        for point in points:
+            new_id = to_mongo_id(utils.compact_unique_id(point['unique_id']))
+            updates.append(pymongo.UpdateOne({'_id' : point['_id']},
+                                             {'$set' : {'unique_id' : new_id}}))
+
+            if len(updates) >= BATCH_SIZE:
+                self.collection.bulk_write(updates, ordered=False)
+                n_migrated += len(updates)
+                updates = []
+
+        if len(updates) > 0:
+            self.collection.bulk_write(updates, ordered=False)
+            n_migrated += len(updates)
+
+        utils.log("Migrated {:d} unique ids.".format(n_migrated))
+
+    def backfill_locations(self):
+        '''Adds the GeoJSON location to documents written before it existed'''
+        utils.log("Adding locations to old documents...")
+
+        points = self.collection.find({'location' : {'$exists' : False}},
+                                      {'gps_before' : True, 'gps_after' : True})
+        points.batch_size(BATCH_SIZE)
+
+        n_updated = 0
+        updates = []
+        for point in points:
+            location = scan.Scan(None, scan.Gps_Scan(point['gps_before']),
+                                 scan.Gps_Scan(point['gps_after'])).get_location()
+            if location is None:
+                continue
+
+            geojson = {'type' : 'Point', 'coordinates' : [location[1], location[0]]}
+            updates.append(pymongo.UpdateOne({'_id' : point['_id']},
+                                             {'$set' : {'location' : geojson}}))
+
+            if len(updates) >= BATCH_SIZE:
+                self.collection.bulk_write(updates, ordered=False)
+                n_updated += len(updates)
+                updates = []
+
+        if len(updates) > 0:
+            self.collection.bulk_write(updates, ordered=False)
+            n_updated += len(updates)
+
+        utils.log("Added {:d} locations.".format(n_updated))
+
+    def iter_old_batches(self, days, query, projection, batch_size, pause):
+        '''Yields lists of documents inserted more than days ago, a batch at a time
+
+        The insertion time comes from the ObjectId so no extra index is needed.
+        Each batch is a fresh query starting after the last _id seen, so no
+        cursor is held open while sleeping between batches.
+
+        Args:
+            days (float): Only documents older than this many days
+            query (Dict): Any extra conditions on the documents
+            projection (Dict): The fields to return
+            batch_size (int): Number of documents per batch
+            pause (float): Time (in sec) to sleep after each batch
+        '''
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        id_query = {'$lt' : bson.objectid.ObjectId.from_datetime(cutoff)}
+
+        while True:
+            batch_query = dict(query)
+            batch_query['_id'] = id_query
+
+            points = list(self.collection.find(batch_query, projection)
+                          .sort('_id', pymongo.ASCENDING).limit(batch_size))
+            if len(points) == 0:
+                return
+
+            yield points
+
+            id_query = dict(id_query)
+            id_query['$gt'] = points[-1]['_id']
+            time.sleep(pause)
+
+    def compact_blobs(self, days, strip=False, batch_size=RETENTION_BATCH_SIZE,
+                      pause=RETENTION_PAUSE):
+        '''Shrinks the raw blobs of documents that are more than days old
+
+        The parsed fields are left alone.
+
+        Args:
+            days (float): Only documents older than this many days are compacted
+            strip (bool): If True then the blobs are removed entirely,
+                otherwise uncompressed blobs are compressed
+            batch_size (int): Number of documents per batch
+            pause (float): Time (in sec) to sleep between batches
+
+        Return:
+            (int): The number of documents compacted
+        '''
+        n_compacted = 0
+
+        if strip:
+            utils.log("Stripping blobs older than {} days...".format(days))
+
+            query = {'$or' : [{'gsm.scan_blob' : {'$ne' : None}},
+                              {'gsm.measurements.measurement_blob' : {'$ne' : None}}]}
+            for points in self.iter_old_batches(days, query, {'_id' : True},
+                                                batch_size, pause):
+                # The blob offsets stay behind but there is nothing left for
+                # them to point into, so the measurements read back with no blob
+                self.collection.update_many({'_id' : {'$in' : [point['_id'] for point in points]}},
+                                            {'$set' : {'gsm.scan_blob' : None},
+                                             '$unset' : {'gsm.measurements.$[].measurement_blob' : ''}})
+                n_compacted += len(points)
+        else:
+            method = self.blob_compression or 'zlib'
+            utils.log("Compressing blobs older than {} days...".format(days))
+
+            query = {'gsm.blob_encoding' : {'$exists' : False}}
+            projection = {'gsm.scan_blob' : True, 'gsm.measurements' : True}
+            for points in self.iter_old_batches(days, query, projection,
+                                                batch_size, pause):
+                updates = []
+                for point in points:
+                    gsm = compress.compress_gsm_document(point['gsm'], method,
+                                                         self.blob_dict_id)
+                    update = {'gsm.scan_blob' : gsm.get('scan_blob', None),
+                              'gsm.measurements' : gsm['measurements'],
+                              'gsm.blob_encoding' : gsm['blob_encoding']}
+                    if 'blob_dict' in gsm:
+                        update['gsm.blob_dict'] = gsm['blob_dict']
+
+                    updates.append(pymongo.UpdateOne({'_id' : point['_id']},
+                                                     {'$set' : update}))
+
+                self.collection.bulk_write(updates, ordered=False)
+                n_compacted += len(updates)
+
+        utils.log("Compacted {:d} documents.".format(n_compacted))
+
+        return n_compacted
+
+    def mark_exported(self, uuids):
+        '''Records that these scans have been safely copied elsewhere
+
+        Only exported scans are ever removed by purge_exported().
+
+        Args:
+            uuids (list of String): The unique ids of the exported scans
+        '''
+        uuids = [to_mongo_id(uuid) for uuid in uuids]
+
+        for i in range(0, len(uuids), LOOKUP_BATCH_SIZE):
+            self.collection.update_many({'unique_id' : {'$in' : uuids[i:i + LOOKUP_BATCH_SIZE]}},
+                                        {'$set' : {'exported' : True}})
+
+    def purge_exported(self, days, batch_size=RETENTION_BATCH_SIZE, pause=RETENTION_PAUSE):
+        '''Deletes exported documents that are more than days old
+
+        Documents that were never marked with mark_exported() are kept no
+        matter how old they are.
+
+        Args:
+            days (float): Only documents older than this many days are deleted
+            batch_size (int): Number of documents per batch
+            pause (float): Time (in sec) to sleep between batches
+
+        Return:
+            (int): The number of documents deleted
+        '''
+        utils.log("Deleting exported documents older than {} days...".format(days))
+
+        n_deleted = 0
+        for points in self.iter_old_batches(days, {'exported' : True},
+                                            {'unique_id' : True}, batch_size, pause):
+            self.collection.delete_many({'_id' : {'$in' : [point['_id'] for point in points]}})
+            n_deleted += len(points)
+
+            if self.measurement_collection is not None:
+                scan_ids = [point['unique_id'] for point in points]
+                try:
+                    self.measurement_collection.delete_many({'scan_id' : {'$in' : scan_ids}})
+                except pymongo.errors.OperationFailure as e:
+                    # Time-series collections only allow this from MongoDB 5.1
+                    utils.log("Could not delete measurements: {}".format(e))
+
+        utils.log("Deleted {:d} documents.".format(n_deleted))
+
+        return n_deleted
+
     def insert_sensor_point(self, full_scan, version=VERSION):
         ''' This will insert a scan point + gps into the database
 
@@ -56,34 +421,33 @@ class Database():
             scan (Scan): The object that represents the entire scan
         '''
         # Begin with the scan document
-        mongo_dict = full_scan.document()
+        mongo_dict = self.scan_document(full_scan)
 
-        rand = os.urandom(128)
-        mongo_dict['unique_id'] = base64.b64encode(rand).decode('utf-8')
+        mongo_dict['unique_id'] = to_mongo_id(utils.generate_unique_id())
         mongo_dict['version'] = version
 
         self.insert_mongo_point(mongo_dict)
 
-    def insert_mongo_point(self, mongo_dict):
-        # If the connection has a timeout then just keep trying.
-        # If the database is down there is no point in collecting
-        # data anyway.
-        insertion_successful = False
-        while not insertion_successful:
-            try:
-                # Finally insert the point and set a bool to leave the loop
-                utils.log("Trying to write to the DB...")
-                self.collection.insert_one(mongo_dict)
-                insertion_successful = True
-                utils.log("Done writing to DB.")
-            except Exception as e:
-                exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
-                traceback.print_exception(exceptionType, exceptionValue,
-                                          exceptionTraceback, file=sys.stdout)
-                utils.log("Error writing to DB: {}".format(e))
-                time.sleep(DB_INSERT_TIMEOUT)
+        if self.measurement_collection is not None:
+            self.write_measurements(measurement_documents(mongo_dict, self.timeseries))
+
+    def scan_document(self, full_scan):
+        '''The document for a scan with its blobs compressed if enabled'''
+        mongo_dict = full_scan.document()
+
+        if self.blob_compression is not None:
+            compress.compress_gsm_document(mongo_dict['gsm'], self.blob_compression,
+                                           self.blob_dict_id)
+
+        return mongo_dict
+
+    def insert_mongo_point(self, mongo_dict, collection=None):
+        self.insert_mongo_points([mongo_dict], collection)
+
+    def insert_mongo_points(self, mongo_dicts, collection=None):
+        if collection is None:
+            collection = self.collection
 
-    def insert_mongo_points(self, mongo_dicts):
         # If the connection has a timeout then just keep trying.
         # If the database is down there is no point in collecting
         # data anyway.
@@ -92,38 +456,264 @@ class Database():
             try:
                 # Finally insert the point and set a bool to leave the loop
                 utils.log("Trying to write to the DB...")
-                self.collection.insert_many(mongo_dicts)
+                collection.insert_many(mongo_dicts, ordered=False)
                 insertion_successful = True
                 utils.log("Done writing to DB.")
+            except pymongo.errors.BulkWriteError as e:
+                # A retry after a timeout can find that some of the documents
+                # made it in the first time. Those are fine, anything else is not.
+                write_errors = e.details.get('writeErrors', [])
+                if len(write_errors) > 0 and \
+                        all(error['code'] == DUPLICATE_KEY_ERROR for error in write_errors):
+                    insertion_successful = True
+                    utils.log("Done writing to DB (some documents were already there).")
+                else:
+                    self.log_insert_error(e)
             except Exception as e:
-                exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
-                traceback.print_exception(exceptionType, exceptionValue,
-                                          exceptionTraceback, file=sys.stdout)
-                utils.log("Error writing to DB: {}".format(e))
-                time.sleep(DB_INSERT_TIMEOUT)
+                self.log_insert_error(e)
+
+    def log_insert_error(self, e):
+        # Through the logger so it comes out in order with everything else
+        utils.log("Error writing to DB: {}".format(e), level=logger.ERROR)
+        utils.log(traceback.format_exc(), is_bytes=True, level=logger.ERROR)
+        metrics.increment('db_write_retries_total')
+        time.sleep(DB_INSERT_TIMEOUT)
+
+    def write_batch(self, scan_uuids):
+        '''Inserts a list of (scan, uuid, version) keeping their uuids'''
+        mongo_dicts = []
+        for (full_scan, uuid, version) in scan_uuids:
+            mongo_dict = self.scan_document(full_scan)
+            mongo_dict['unique_id'] = to_mongo_id(uuid)
+            mongo_dict['version'] = version
+            mongo_dicts.append(mongo_dict)
+
+        if len(mongo_dicts) > 0:
+            self.insert_mongo_points(mongo_dicts)
+
+        if self.measurement_collection is not None:
+            meas_dicts = []
+            for mongo_dict in mongo_dicts:
+                meas_dicts += measurement_documents(mongo_dict, self.timeseries)
+
+            self.write_measurements(meas_dicts)
+
+    def write_measurements(self, meas_dicts):
+        '''Writes measurement documents, buffering them for a time-series collection'''
+        if not self.timeseries:
+            if len(meas_dicts) > 0:
+                self.insert_mongo_points(meas_dicts, self.measurement_collection)
+            return
+
+        # Time-series collections are much happier with a few large inserts
+        # than with many small ones since each insert opens or extends buckets
+        self.measurement_buffer += meas_dicts
+        if len(self.measurement_buffer) >= TIMESERIES_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        '''Writes out any buffered measurement documents
+
+        The scans themselves are inserted by write_batch() as it goes.
+        '''
+        if len(self.measurement_buffer) > 0:
+            self.insert_mongo_points(self.measurement_buffer, self.measurement_collection)
+            self.measurement_buffer = []
+
+    def iter_scans(self, since=None, include_blobs=True):
+        '''Yields (scan, uuid, version) for scans taken at or after since
+
+        The documents are decoded lazily, so only the parts that are used
+        ever become python objects.
+
+        Args:
+            since (String): GPS time formatted like GpsScanner.scan() does it.
+                If None then every scan is returned.
+            include_blobs (bool): If False then the raw blobs are never read
+                from the database. The scans will have None for their blobs.
+        '''
+        projection = None if include_blobs else NO_BLOBS_PROJECTION
+
+        return self.get_scans(since=since, projection=projection, lazy=True)
+
+    def get_uuids(self):
+        '''Return all of the uuids of the Scans as a list'''
+        points = self.collection.find({}, {'unique_id' : True, '_id' : False})
+        points.batch_size(BATCH_SIZE)
+
+        return [from_mongo_id(point['unique_id']) for point in points]
+
+    def close(self):
+        self.flush()
+        self.client.close()
+
+    def get_scans(self, uuids=None, since=None, projection=None, lazy=False):
+        '''This returns a iterable object to get all of the scan objects in the db
+
+        Args:
+            uuids (list): Scans with these uuids are skipped
+            since (String): Only scans taken at or after this GPS time
+            projection (Dict): A mongo projection, e.g. NO_BLOBS_PROJECTION
+            lazy (bool): Decode the documents and build the measurements only
+                as they are used (see find_scans)
+        '''
+
+        # The GPS time strings sort the same way as the times themselves
+        query = {}
+        if since is not None:
+            query['gps_before.time'] = {'$gte' : since}
+
+        return self.find_scans(query, uuids, projection, lazy)
 
-    def get_scans(self, uuids=None):
-        '''This returns a iterable object to get all of the scan objects in the db'''
+    def get_scans_near(self, lat, lon, radius):
+        '''Returns the scans taken within radius meters of (lat, lon)
+
+        This is answered from the 2dsphere index on location.
+        '''
+        query = {'location' : {'$geoWithin' :
+                    {'$centerSphere' : [[lon, lat], float(radius) / EARTH_RADIUS]}}}
+
+        return self.find_scans(query)
+
+    def get_scans_within(self, polygon):
+        '''Returns the scans taken inside a polygon
+
+        Args:
+            polygon (list of (lat, lon)): The corners of the polygon. It is
+                closed automatically if the last corner is not the first.
+        '''
+        # GeoJSON wants [lon, lat] and a closed ring
+        ring = [[lon, lat] for (lat, lon) in polygon]
+        if ring[0] != ring[-1]:
+            ring.append(ring[0])
+
+        query = {'location' : {'$geoWithin' :
+                    {'$geometry' : {'type' : 'Polygon', 'coordinates' : [ring]}}}}
+
+        return self.find_scans(query)
+
+    def get_measurements(self, query):
+        '''Yields the measurement documents that match a mongo query
+
+        e.g. {'mcc' : 310, 'mnc' : 260, 'lac' : 1234, 'cell_id' : 5678} or
+        {'arfcn' : 128, 'rx_lev' : {'$gt' : -60}}
+        '''
+        if self.measurement_collection is None:
+            raise Exception("There is no measurement collection")
+
+        points = self.measurement_collection.find(query, {'_id' : False})
+        points.batch_size(BATCH_SIZE)
+
+        for point in points:
+            point['scan_id'] = from_mongo_id(point['scan_id'])
+            yield point
+
+    def get_measurements_between(self, start, end, arfcn=None, sensor_name=None):
+        '''Yields the measurements taken in [start, end) (GPS time strings)
+
+        Args:
+            start (String): GPS time formatted like GpsScanner.scan() does it
+            end (String): GPS time formatted like GpsScanner.scan() does it
+            arfcn (int): Only this channel (optional)
+            sensor_name (String): Only this sensor (optional)
+        '''
+        # In a time-series collection the time is a datetime and the
+        # arfcn and sensor_name live in meta
+        if self.timeseries:
+            query = {'time' : {'$gte' : utils.parse_gps_time(start),
+                               '$lt' : utils.parse_gps_time(end)}}
+            prefix = 'meta.'
+        else:
+            query = {'time' : {'$gte' : start, '$lt' : end}}
+            prefix = ''
+
+        if arfcn is not None:
+            query[prefix + 'arfcn'] = arfcn
+        if sensor_name is not None:
+            query[prefix + 'sensor_name'] = sensor_name
+
+        return self.get_measurements(query)
+
+    def get_scans_for_measurements(self, query):
+        '''Yields each whole (scan, uuid, version) with a measurement matching query'''
+        if self.measurement_collection is None:
+            raise Exception("There is no measurement collection")
+
+        scan_ids = self.measurement_collection.distinct('scan_id', query)
+
+        # Keep the $in lists to a reasonable size
+        for i in range(0, len(scan_ids), LOOKUP_BATCH_SIZE):
+            for result in self.find_scans({'unique_id' :
+                                            {'$in' : scan_ids[i:i + LOOKUP_BATCH_SIZE]}}):
+                yield result
+
+    def build_measurement_collection(self):
+        '''Fills the measurement collection from scans that are already stored'''
+        if self.measurement_collection is None:
+            raise Exception("There is no measurement collection")
+
+        utils.log("Building the measurement collection...")
+
+        # Scans that already have their measurements split out are skipped
+        done = set(self.measurement_collection.distinct('scan_id'))
+
+        points = self.collection.find({}, {'gsm.scan_blob' : False,
+                                           'gsm.measurements.measurement_blob' : False})
+        points.batch_size(BATCH_SIZE)
+
+        n_scans = 0
+        for point in points:
+            if point['unique_id'] in done:
+                continue
+
+            self.write_measurements(measurement_documents(point, self.timeseries))
+            n_scans += 1
+
+        self.flush()
+
+        utils.log("Split the measurements out of {:d} scans.".format(n_scans))
+
+    def find_scans(self, query, uuids=None, projection=None, lazy=False):
+        '''Yields (scan, uuid, version) for every document matching a mongo query
+
+        Args:
+            query (Dict): The mongo query
+            uuids (list): Scans with these uuids are skipped
+            projection (Dict): A mongo projection to apply
+            lazy (bool): If True then the documents are read as RawBSONDocuments,
+                which are only decoded field by field as they are accessed, and
+                each measurement object is only built when it is first used.
+        '''
+        collection = self.collection
+        if lazy:
+            collection = collection.with_options(codec_options=RAW_CODEC_OPTIONS)
 
         # Just start grabbing all of the points
-        points = self.collection.find()
+        points = collection.find(query, projection)
 
         # The points object is a pymongo cursor. However there are timeouts if the
         # cursor reads too many points so we will set it manually
         points.batch_size(BATCH_SIZE)
 
+        # Membership checks against a list are linear
+        if uuids is not None:
+            uuids = set(uuids)
+
         i = 0
         for point in points:
             i += 1
             if i % 1000 == 0:
                 print("Collection point number: ", i)
 
-            if uuids is None or point['unique_id'] not in uuids:
+            uuid = from_mongo_id(point['unique_id'])
+
+            if uuids is None or uuid not in uuids:
                 gps_before = point['gps_before']
                 gps_after = point['gps_after']
                 gsm = point['gsm']
                 sensor_name = point['sensor_name']
-                uuid = point['unique_id']
+                high_quality = point.get('high_quality', True)
                 version = point['version']
 
-                yield (scan.scan_factory(gsm, gps_before, gps_after, sensor_name), uuid, version)
+                yield (scan.scan_factory(gsm, gps_before, gps_after, sensor_name,
+                                         high_quality, lazy), uuid, version)
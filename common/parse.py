@@ -288,6 +288,8 @@ class Telit_Modem_Parser():
 
         for match in meas_iter:
             meas = self.parse_measurement(match.group())
+            # Keep the offsets instead of a second copy of the text
+            meas.set_blob_range(scan_blob, match.start(), match.end())
             scan.gsm_measurements.append(meas)
 
         return scan
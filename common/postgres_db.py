@@ -1,6 +1,7 @@
 import time
 import psycopg2
 
+import common.scan as scan_module
 from common.scan import Gsm_Scan, Gps_Scan, Scan, Gsm_Measurement, Bcch_Measurement
 from common.parse import Telit_Modem_Parser
 import common.utils as utils
@@ -49,6 +50,7 @@ GSM_MEASUREMENT_SCHEMA = '''
                     gsm_scan_id bigint references Gsm_Scan(id),
                     arfcn Integer,
                     rx_lev Integer,
+                    gps_id bigint references Gps_Scan(id),
                     tmp_id bigint UNIQUE
                     '''
 
@@ -120,7 +122,7 @@ GPS_SCAN_INSERT = '''
                         '''
 
 GSM_MEASUREMENT_INSERT = '''
-                            Insert INTO GSM_Measurement(gsm_scan_id, arfcn, rx_lev, tmp_id)
+                            Insert INTO GSM_Measurement(gsm_scan_id, arfcn, rx_lev, gps_id, tmp_id)
                             VALUES
                          '''
 BCCH_MEASUREMENT_INSERT = '''
@@ -141,7 +143,23 @@ CHANNEL_LIST_INSERT = '''Insert INTO Channel_List(bcch_measurement_id, channel)
                         VALUES
                         '''
 
+# Used by the named cursor when streaming scans back out
+BATCH_SIZE = 1000
+
+# The columns of Gps_Scan and Bcch_Measurement in the order they are read back
+GPS_COLUMNS = ['mode', 'time', 'ept', 'lat', 'lon', 'alt', 'epx', 'epy', 'epv',
+               'track', 'speed', 'climb', 'epd', 'eps', 'epc']
+
+BCCH_COLUMNS = ['bsic', 'ber', 'mcc', 'mnc', 'lac', 'cell_id', 'cell_status',
+                'num_arfcn', 'num_channels', 'pbcch', 'nom', 'rac', 'spgc', 'pat',
+                'nco', 't3168', 't3192', 'drxmax', 'ctrl_ack', 'bscvmax', 'alpha',
+                'pc_meas_ch', 'mstxpwr', 'rxaccmin', 'croffset', 'penaltyt', 't3212',
+                'crh']
+
 class Database():
+    # Only the parsed fields are exported, never the raw blobs
+    stores_blobs = False
+
     def __init__(self, dbname, user, password, host, port):
         '''Creates the database object and initializes the connection
 
@@ -206,6 +224,10 @@ class Database():
         cur.execute(self.create_table_cmd("Channel_List", CHANNEL_LIST_SCHEMA))
         cur.execute(self.create_table_cmd("Arfcn_List", ARFCN_LIST_SCHEMA))
 
+        # Tables made before measurements had their own GPS point
+        cur.execute('''ALTER TABLE Gsm_Measurement
+                       ADD COLUMN IF NOT EXISTS gps_id bigint references Gps_Scan(id);''')
+
         self.con.commit()
 
     # We have created temporary columns for the insertion and this is to remove them
@@ -263,6 +285,23 @@ class Database():
 
         return uuids
 
+    def migrate_unique_ids(self):
+        '''Rewrites the old 172 character uuids in the same way mongo_db does'''
+        utils.log("Migrating unique ids...")
+        cur = self.con.cursor()
+
+        # The new ids are all 36 characters long
+        cur.execute('''Select S.id, S.uuid
+                        From Scan S
+                        Where length(S.uuid) <> 36
+                    ''')
+
+        updates = [(utils.compact_unique_id(uuid), scan_id) for (scan_id, uuid) in cur.fetchall()]
+        cur.executemany('''Update Scan Set uuid = %s Where id = %s''', updates)
+
+        self.con.commit()
+        utils.log("Migrated {:d} unique ids.".format(len(updates)))
+
     def insert_scans(self, scan_uuids):
         '''This parses each of the scans and inserts them into the db'''
         utils.log("Inserting Scans into the database...")
@@ -341,8 +380,14 @@ class Database():
             bcch_measurement_tmp_id_low = bcch_measurement_tmp_id
 
             for meas in gsm_scan.measurement_cursor():
+                # Where the measurement itself was taken, if it was located
+                gps_id = "NULL"
+                if meas.get_gps() is not None:
+                    cur.execute(GPS_SCAN_INSERT, generate_gps_tuple(meas.get_gps()))
+                    gps_id = cur.fetchone()[0]
+
                 gsm_measurement_row = (gsm_scan_id, meas.get_arfcn(), \
-                                        meas.get_rx_lev(), gsm_measurement_tmp_id)
+                                        meas.get_rx_lev(), gps_id, gsm_measurement_tmp_id)
                 # Update the gsm_measurement_row
                 gsm_measurement_rows.append(gsm_measurement_row)
 
@@ -445,7 +490,8 @@ class Database():
                 gsm_measurement_query += ','.join([str(g) for g in gsm_measurement_rows])
                 gsm_measurement_query += ";"
 
-                cur.execute(gsm_measurement_query)
+                # Same as for the bcch measurements below
+                cur.execute(gsm_measurement_query.replace("'NULL'", "NULL"))
 
                 # Only if there is a bcch_measurement do we need to insert
                 # into the bcch_measurement table
@@ -537,6 +583,123 @@ class Database():
 
         utils.log("Done inserting Scans...")
 
+    def write_batch(self, scan_uuids):
+        '''Inserts a list of (scan, uuid, version)'''
+        self.insert_scans(scan_uuids)
+
+    def iter_scans(self, since=None, include_blobs=True):
+        '''Yields (scan, uuid, version) for scans taken at or after since
+
+        The raw blobs are never exported to Postgres so the returned scans
+        only carry the parsed fields.
+
+        Args:
+            since (String): GPS time formatted like GpsScanner.scan() does it.
+                If None then every scan is returned.
+            include_blobs (bool): Unused, there are no blobs to include
+        '''
+        # A named cursor streams the rows from the server instead of
+        # pulling the entire table into memory
+        scan_cur = self.con.cursor(name="iter_scans")
+        scan_cur.itersize = BATCH_SIZE
+
+        query = '''Select S.gsm_id, S.gps_before_id, S.gps_after_id, S.sensor_name,
+                          S.uuid, S.version, S.high_quality
+                   From Scan S, Gps_Scan G
+                   Where S.gps_before_id = G.id'''
+        if since is not None:
+            scan_cur.execute(query + ''' and G.time >= %s Order By S.id''', (since,))
+        else:
+            scan_cur.execute(query + ''' Order By S.id''')
+
+        # The child rows need their own cursor since the named one is in use
+        cur = self.con.cursor()
+        for (gsm_id, gps_before_id, gps_after_id, sensor_name,
+                uuid, version, high_quality) in scan_cur:
+
+            gsm = self.get_gsm_document(cur, gsm_id)
+            gps_before = self.get_gps_document(cur, gps_before_id)
+            gps_after = self.get_gps_document(cur, gps_after_id)
+
+            yield (scan_module.scan_factory(gsm, gps_before, gps_after, sensor_name,
+                                            high_quality), uuid, version)
+
+        scan_cur.close()
+
+    def get_gps_document(self, cur, gps_id):
+        cur.execute('''Select ''' + ','.join(GPS_COLUMNS) + '''
+                       From Gps_Scan G
+                       Where G.id = %s''', (gps_id,))
+        row = cur.fetchone()
+
+        gps_data = {}
+        for (field, value) in zip(GPS_COLUMNS, row):
+            if value is None:
+                continue
+            # Put the time back in the same format that the sensor uses
+            if field == 'time':
+                value = value.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+            gps_data[field] = value
+
+        return gps_data
+
+    def get_gsm_document(self, cur, gsm_id):
+        '''Rebuilds the dictionary produced by Gsm_Scan.document()'''
+        cur.execute('''Select G.freq_low, G.freq_high, G.error, G.jammed
+                       From Gsm_Scan G
+                       Where G.id = %s''', (gsm_id,))
+        (freq_low, freq_high, error, jammed) = cur.fetchone()
+
+        gsm = {'scan_blob' : None, 'error' : error, 'jammed' : jammed}
+        if freq_low is not None and freq_high is not None:
+            gsm['freq_low'] = freq_low
+            gsm['freq_high'] = freq_high
+
+        cur.execute('''Select GM.arfcn, GM.rx_lev, GM.gps_id, BM.id, ''' + \
+                            ','.join(['BM.' + field for field in BCCH_COLUMNS]) + '''
+                       From Gsm_Measurement GM Left Join Bcch_Measurement BM
+                            On BM.gsm_measurement_id = GM.id
+                       Where GM.gsm_scan_id = %s
+                       Order By GM.id''', (gsm_id,))
+        rows = cur.fetchall()
+
+        measurements = []
+        for row in rows:
+            raw_meas = {'arfcn' : row[0], 'rx_lev' : row[1], 'measurement_blob' : None}
+
+            gps_id = row[2]
+            if gps_id is not None:
+                raw_meas['gps'] = self.get_gps_document(cur, gps_id)
+
+            bcch_id = row[3]
+            if bcch_id is not None:
+                bcch = dict(zip(BCCH_COLUMNS, row[4:]))
+
+                cur.execute('''Select A.arfcn From Arfcn_List A
+                               Where A.bcch_measurement_id = %s
+                               Order By A.id''', (bcch_id,))
+                bcch['arfcns'] = [r[0] for r in cur.fetchall()]
+
+                cur.execute('''Select C.channel From Channel_List C
+                               Where C.bcch_measurement_id = %s
+                               Order By C.id''', (bcch_id,))
+                bcch['channels'] = [r[0] for r in cur.fetchall()]
+
+                raw_meas['bcch'] = bcch
+
+            measurements.append(raw_meas)
+
+        gsm['measurements'] = measurements
+
+        return gsm
+
+    def flush(self):
+        # Every scan is committed as it is inserted
+        pass
+
+    def close(self):
+        self.con.close()
+
     def create_table_cmd(self, tablename, schema_str):
         s = "CREATE TABLE if not EXISTS"
         s += " " + tablename + "\n"
@@ -0,0 +1,123 @@
+'''Profiling a running sensor on demand, from signals.
+
+    kill -USR1 <pid>    profile the next PROFILE_SCANS scans with cProfile
+                        (a second USR1 stops early)
+    kill -USR2 <pid>    log the stack of every thread
+
+The signal handlers only set a flag (or queue the stacks on the logger),
+so nothing is slowed down until a profile is asked for. They never write
+or flush anything themselves: the signal can arrive while the main
+thread holds the logger's lock, and waiting on it there would hang.
+
+The profile is written to PROFILE_DIR as survey-<time>.prof, which
+pstats or snakeviz can read, and the top functions by cumulative time
+are logged. cProfile only sees the thread that runs the scans, i.e. not
+the GpsScanner thread. Its stack is in the USR2 dump.
+'''
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import signal
+import sys
+import threading
+import traceback
+
+import common.utils as utils
+import common.logger as logger
+
+# How many scans a profile covers
+PROFILE_SCANS = 20
+# Where the profiles are written
+PROFILE_DIR = '.'
+# How many functions are logged when a profile is written
+PROFILE_TOP = 25
+
+def format_stacks():
+    '''The current stack of every thread, with the thread names'''
+    names = {thread.ident : thread.name for thread in threading.enumerate()}
+
+    lines = []
+    for (ident, frame) in sys._current_frames().items():
+        lines.append("Thread {} ({:d}):\n".format(names.get(ident, "unknown"), ident))
+        lines += traceback.format_stack(frame)
+        lines.append("\n")
+
+    return ''.join(lines)
+
+def dump_stacks(out=None):
+    '''Writes the current stack of every thread (not from a signal handler)'''
+    if out is None:
+        out = sys.stderr
+
+    # Anything already logged should come before the stacks
+    logger.flush()
+    out.write(format_stacks())
+    out.flush()
+
+def log_stacks(signum=None, frame=None):
+    '''Queues the stack of every thread on the logger (safe in a signal handler)'''
+    # Below ERROR so the writer thread is not woken up, which takes a lock
+    logger.warning(format_stacks(), raw=True)
+
+class ScanProfiler():
+    ''' Runs the scans under cProfile when asked to by a signal.'''
+
+    def __init__(self, n_scans=PROFILE_SCANS, directory=PROFILE_DIR):
+        self.n_scans = n_scans
+        self.directory = directory
+
+        # Set by the signal handler, acted on at the next scan
+        self.toggled = False
+        self.profile = None
+        self.n_left = 0
+
+    def install(self):
+        '''Installs the USR1 and USR2 handlers (only from the main thread)'''
+        signal.signal(signal.SIGUSR1, self.toggle)
+        signal.signal(signal.SIGUSR2, log_stacks)
+
+    def toggle(self, signum=None, frame=None):
+        # Doing any real work in a signal handler is asking for trouble
+        self.toggled = True
+
+    def call(self, func, *args, **kwargs):
+        '''Calls func, under the profiler if one has been asked for'''
+        if self.toggled:
+            self.toggled = False
+            if self.profile is None:
+                self.start()
+            else:
+                self.stop()
+
+        if self.profile is None:
+            return func(*args, **kwargs)
+
+        try:
+            return self.profile.runcall(func, *args, **kwargs)
+        finally:
+            self.n_left -= 1
+            if self.n_left <= 0:
+                self.stop()
+
+    def start(self):
+        utils.log("Profiling the next {:d} scans...".format(self.n_scans))
+        self.profile = cProfile.Profile()
+        self.n_left = self.n_scans
+
+    def stop(self):
+        '''Writes out the profile so far'''
+        profile = self.profile
+        self.profile = None
+
+        path = os.path.join(self.directory,
+                            'survey-{:%Y%m%dT%H%M%S}.prof'.format(datetime.datetime.now()))
+        profile.dump_stats(path)
+
+        summary = io.StringIO()
+        stats = pstats.Stats(profile, stream=summary)
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+
+        utils.log("Wrote the profile to " + path)
+        utils.log(summary.getvalue(), is_bytes=True)
@@ -1,4 +1,6 @@
-import copy
+import struct
+
+import common.compress as compress
 # We only want certain fields in the gps_data. This is a way
 # to explicitly specify what datafields we want.
 GPS_FIELDS = ['mode',
@@ -17,7 +19,7 @@ GPS_FIELDS = ['mode',
               'eps',
               'epc']
 
-def scan_factory(gsm, gps_before, gps_after, sensor_name=None, high_quality=True):
+def scan_factory(gsm, gps_before, gps_after, sensor_name=None, high_quality=True, lazy=False):
     '''This takes python dictionaries with scan data and makes a Scan obj
 
     Args:
@@ -26,12 +28,20 @@ def scan_factory(gsm, gps_before, gps_after, sensor_name=None, high_quality=True
         gsm_after (Dict): Contains the Gps_Scan Data
         sensor_name (String): The identifier of the sensor that took
             the measurements.
+        lazy (bool): Only build each measurement object when it is first
+            used. This goes well with bson RawBSONDocuments, which are
+            themselves only decoded when they are read.
     '''
     gpsb = Gps_Scan(gps_before)
     gpsa = Gps_Scan(gps_after)
 
-    # Make a basic gsm_scan with the blob and freqency ranges
-    gsm_scan = Gsm_Scan(gsm['scan_blob'])
+    # The blobs may have been stored compressed. This does nothing for
+    # documents that were not.
+    gsm = compress.decompress_gsm_document(gsm)
+
+    # Make a basic gsm_scan with the blob and freqency ranges.
+    # The blob may have been left out of the query on purpose.
+    gsm_scan = Gsm_Scan(gsm.get('scan_blob', None))
 
     # Now set frequency range, error, and jammed
     gsm_scan.set_error(gsm['error'])
@@ -44,38 +54,55 @@ def scan_factory(gsm, gps_before, gps_after, sensor_name=None, high_quality=True
     if 'antenna' in gsm:
         gsm_scan.set_antenna(gsm['antenna'])
 
-    # Now specify the measurement params
-    for raw_meas in gsm['measurements']:
-        # Make either a Bcch_Measurement or Gsm_Measurement
-        if 'bcch' in raw_meas:
-            meas = Bcch_Measurement(raw_meas['measurement_blob'])
+    if lazy:
+        gsm_scan.set_raw_measurements(gsm['measurements'])
+    else:
+        for raw_meas in gsm['measurements']:
+            gsm_scan.add_measurement(measurement_factory(raw_meas, gsm_scan.blob))
 
-            raw_bcch = raw_meas['bcch']
+    return Scan(gsm_scan, gpsb, gpsa, sensor_name, high_quality)
 
-            # Now add all of the extra bcch fields
-            meas.set_arfcn_lst(raw_bcch['arfcns'], raw_bcch['num_arfcn'])
-            meas.set_channel_lst(raw_bcch['channels'], raw_bcch['num_channels'])
+# These are stored separately from the rest of the bcch data
+BCCH_LIST_FIELDS = ['arfcns', 'num_arfcn', 'channels', 'num_channels']
 
-            bcch_cpy = copy.deepcopy(raw_bcch)
+def measurement_factory(raw_meas, scan_blob):
+    '''This makes a Gsm_Measurement or Bcch_Measurement from its dictionary
 
-            # We want to remove the mandatory bcch fields
-            del bcch_cpy['arfcns']
-            del bcch_cpy['num_arfcn']
-            del bcch_cpy['channels']
-            del bcch_cpy['num_channels']
+    Args:
+        raw_meas (Dict): Contains the measurement data
+        scan_blob (String): The blob of the scan the measurement is from
+    '''
+    # Make either a Bcch_Measurement or Gsm_Measurement
+    if 'bcch' in raw_meas:
+        meas = Bcch_Measurement(raw_meas.get('measurement_blob', None))
 
-            meas.set_bcch_data(bcch_cpy)
-        else:
-            meas = Gsm_Measurement(raw_meas['measurement_blob'])
+        raw_bcch = raw_meas['bcch']
 
-        # Specify the arfcn and rx_lev
-        meas.set_arfcn(raw_meas['arfcn'])
-        meas.set_rx_lev(raw_meas['rx_lev'])
+        # Now add all of the extra bcch fields
+        meas.set_arfcn_lst(raw_bcch['arfcns'], raw_bcch['num_arfcn'])
+        meas.set_channel_lst(raw_bcch['channels'], raw_bcch['num_channels'])
 
-        # Finally add in the measurement
-        gsm_scan.add_measurement(meas)
+        # The remaining values are all ints, floats, strings or None so a
+        # shallow copy without the mandatory fields is all we need
+        meas.set_bcch_data({key: value for (key, value) in raw_bcch.items() \
+                                            if key not in BCCH_LIST_FIELDS})
+    else:
+        meas = Gsm_Measurement(raw_meas.get('measurement_blob', None))
 
-    return Scan(gsm_scan, gpsb, gpsa, sensor_name, high_quality)
+    # Newer documents only store where the measurement is in the scan
+    # blob. Older ones have a copy of the text in measurement_blob.
+    if 'blob_start' in raw_meas:
+        meas.set_blob_range(scan_blob, raw_meas['blob_start'], raw_meas['blob_end'])
+
+    # Specify the arfcn and rx_lev
+    meas.set_arfcn(raw_meas['arfcn'])
+    meas.set_rx_lev(raw_meas['rx_lev'])
+
+    # Only measurements that were located on their own have this
+    if 'gps' in raw_meas:
+        meas.set_gps(raw_meas['gps'])
+
+    return meas
 
 class Scan():
     '''This is the combination of 2 GPS points and a gsm mesurement'''
@@ -98,8 +125,43 @@ class Scan():
         doc['sensor_name'] = self.sensor_name
         doc['high_quality'] = self.high_quality
 
+        # A GeoJSON point so that Mongo can index where the scan was taken
+        location = self.get_location()
+        if location is not None:
+            doc['location'] = {'type' : 'Point',
+                               'coordinates' : [location[1], location[0]]}
+
         return doc
 
+    def get_location(self):
+        '''Where the scan was taken as (lat, lon), or None if there was no fix
+
+        This is the midpoint of the before and after GPS points when both
+        have a fix, otherwise whichever one does.
+        '''
+        before = self.gps_before.get_lat_lon()
+        after = self.gps_after.get_lat_lon()
+
+        if before is None:
+            return after
+        if after is None:
+            return before
+
+        lat = (before[0] + after[0]) / 2
+        # Take the short way around if the scan crossed the antimeridian
+        lon_after = after[1]
+        if lon_after - before[1] > 180:
+            lon_after -= 360
+        elif before[1] - lon_after > 180:
+            lon_after += 360
+        lon = (before[1] + lon_after) / 2
+        if lon < -180:
+            lon += 360
+        elif lon > 180:
+            lon -= 360
+
+        return (lat, lon)
+
     def get_gsm(self):
         return self.gsm
 
@@ -141,6 +203,18 @@ class Gps_Scan():
         except:
             return None
 
+    def get_lat_lon(self):
+        '''Returns (lat, lon) if this point has a fix, otherwise None'''
+        mode = self.gps_data.get('mode', None)
+        lat = self.gps_data.get('lat', None)
+        lon = self.gps_data.get('lon', None)
+
+        # Mode 2 is a 2D fix and mode 3 a 3D fix
+        if mode is None or int(mode) < 2 or lat is None or lon is None:
+            return None
+
+        return (float(lat), float(lon))
+
     def get_mode(self):
         try:
             mode = self.gps_data.get('mode', None)
@@ -168,6 +242,8 @@ class Gsm_Scan():
         self.freq_high = freq_high
         self.error = 0
         self.gsm_measurements = []
+        # Measurement documents that have not been made into objects yet
+        self.raw_measurements = None
         self.jammed = 0
 
     def set_freq_range(self, freq_low, freq_high):
@@ -191,10 +267,28 @@ class Gsm_Scan():
 
     def add_measurement(self, measurement):
         self.gsm_measurements.append(measurement)
+        if self.raw_measurements is not None:
+            self.raw_measurements.append(None)
+
+    def set_raw_measurements(self, raw_measurements):
+        '''Keeps the measurement documents to be turned into objects on use'''
+        self.raw_measurements = list(raw_measurements)
+        self.gsm_measurements = [None] * len(self.raw_measurements)
+
+    def get_measurement(self, i):
+        measurement = self.gsm_measurements[i]
+
+        # Build the object the first time it is asked for
+        if measurement is None:
+            measurement = measurement_factory(self.raw_measurements[i], self.blob)
+            self.gsm_measurements[i] = measurement
+            self.raw_measurements[i] = None
+
+        return measurement
 
     def measurement_cursor(self):
-        for measurement in self.gsm_measurements:
-            yield measurement
+        for i in range(len(self.gsm_measurements)):
+            yield self.get_measurement(i)
 
     # A nice printable string of the scan
     def __str__(self):
@@ -206,7 +300,7 @@ class Gsm_Scan():
             s += "===========================================\n"
             s += "Measurement " + str(i+1) + ":\n"
             s += "===========================================\n"
-            s += str(self.gsm_measurements[i]) + "\n"
+            s += str(self.get_measurement(i)) + "\n"
             i = i + 1
 
         return s
@@ -234,7 +328,7 @@ class Gsm_Scan():
 
         measurements = []
 
-        for measurement in self.gsm_measurements:
+        for measurement in self.measurement_cursor():
             measurements.append(measurement.document())
 
         doc['measurements'] = measurements
@@ -245,7 +339,39 @@ class Gsm_Measurement():
     def __init__(self, gsm_blob):
         self.arfcn = None
         self.rx_lev = None
-        self.blob = gsm_blob
+
+        # The raw text of a measurement is always a slice of the scan blob
+        # so rather than keeping a copy we normally just keep the range.
+        # If there is no range then raw_blob is the measurement text itself.
+        self.raw_blob = gsm_blob
+        self.blob_range = None
+
+        # Where the sensor was when the modem reported this measurement
+        # (see GpsScanner.interpolate()), or None to go by the scan's GPS
+        self.gps = None
+
+    @property
+    def blob(self):
+        if self.blob_range is None or self.raw_blob is None:
+            return self.raw_blob
+
+        # Only slice out the text when somebody actually asks for it
+        (start, end) = self.blob_range
+        return self.raw_blob[start:end]
+
+    def set_blob_range(self, scan_blob, start, end):
+        '''Points the measurement at scan_blob[start:end]'''
+        self.raw_blob = scan_blob
+        self.blob_range = (start, end)
+
+    def get_blob_range(self):
+        return self.blob_range
+
+    def set_gps(self, gps_data):
+        self.gps = gps_data
+
+    def get_gps(self):
+        return self.gps
 
     def set_arfcn(self, arfcn):
         self.arfcn = arfcn
@@ -275,10 +401,20 @@ class Gsm_Measurement():
 
         doc['arfcn'] = int(self.arfcn)
         doc['rx_lev'] = int(self.rx_lev)
-        doc['measurement_blob'] = self.blob
+        self.add_blob_document(doc)
+        if self.gps is not None:
+            doc['gps'] = self.gps
 
         return doc
 
+    def add_blob_document(self, doc):
+        '''Stores the offsets into the scan blob, or the blob if there are none'''
+        if self.blob_range is not None:
+            doc['blob_start'] = self.blob_range[0]
+            doc['blob_end'] = self.blob_range[1]
+        else:
+            doc['measurement_blob'] = self.raw_blob
+
 
 class Bcch_Measurement(Gsm_Measurement):
     def __init__(self, gsm_blob):
@@ -336,7 +472,9 @@ class Bcch_Measurement(Gsm_Measurement):
         # Add the mandatory fields
         doc['arfcn'] = int(self.arfcn)
         doc['rx_lev'] = int(self.rx_lev)
-        doc['measurement_blob'] = self.blob
+        self.add_blob_document(doc)
+        if self.gps is not None:
+            doc['gps'] = self.gps
 
         # Add the bcch fields to this
         bcch = {}
@@ -381,3 +519,367 @@ class Bcch_Measurement(Gsm_Measurement):
 
         return doc
 
+
+# The optional bcch fields in the order they are packed by encode()
+BCCH_FIELDS = ['bsic', 'ber', 'mcc', 'mnc', 'lac', 'cell_id', 'cell_status',
+               'pbcch', 'nom', 'rac', 'spgc', 'pat', 'nco', 't3168', 't3192',
+               'drxmax', 'ctrl_ack', 'bscvmax', 'alpha', 'pc_meas_ch', 'mstxpwr',
+               'rxaccmin', 'croffset', 'penaltyt', 't3212', 'crh']
+
+# Bump this whenever the binary layout below changes. decode() refuses
+# anything it does not understand instead of guessing.
+ENCODING_VERSION = 2
+# The older versions decode() still reads. Version 1 is version 2 with no
+# measurement GPS.
+DECODABLE_VERSIONS = [1, 2]
+
+# Scan level flags
+FLAG_ERROR = 0x01
+FLAG_JAMMED = 0x02
+FLAG_HIGH_QUALITY = 0x04
+FLAG_FREQ_RANGE = 0x08
+FLAG_SENSOR_NAME = 0x10
+FLAG_SCAN_BLOB = 0x20
+FLAG_BLOB_COMPRESSED = 0x40
+
+# Measurement level flags
+MEAS_BCCH = 0x01
+MEAS_BLOB_OFFSET = 0x02  # The blob is a slice of the scan blob
+MEAS_BLOB_INLINE = 0x04  # The blob is stored as is
+MEAS_GPS = 0x08          # The measurement has its own GPS point
+
+DOUBLE = struct.Struct('<d')
+
+def write_varint(buf, n):
+    '''Appends a non-negative int to buf using 7 bits per byte'''
+    while n > 0x7f:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def read_varint(data, pos):
+    '''Reads a varint from data at pos and returns (value, new_pos)'''
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return (n, pos)
+        shift += 7
+
+def write_sint(buf, n):
+    '''Appends a signed int (zigzag encoded so small negatives stay small)'''
+    write_varint(buf, (n << 1) if n >= 0 else ((-n) << 1) - 1)
+
+def read_sint(data, pos):
+    (n, pos) = read_varint(data, pos)
+    return ((n >> 1) ^ -(n & 1), pos)
+
+def write_str(buf, s):
+    raw = s.encode('utf-8')
+    write_varint(buf, len(raw))
+    buf += raw
+
+def read_str(data, pos):
+    (length, pos) = read_varint(data, pos)
+    end = pos + length
+    return (bytes(data[pos:end]).decode('utf-8'), end)
+
+def write_gps(buf, gps_data):
+    # A bitmask of which GPS_FIELDS are present comes first
+    mask = 0
+    for (i, field) in enumerate(GPS_FIELDS):
+        if gps_data.get(field, None) is not None:
+            mask |= 1 << i
+    write_varint(buf, mask)
+
+    for (i, field) in enumerate(GPS_FIELDS):
+        if mask & (1 << i):
+            value = gps_data[field]
+            if field == 'mode':
+                write_varint(buf, int(value))
+            elif field == 'time':
+                write_str(buf, value)
+            else:
+                buf += DOUBLE.pack(value)
+
+def read_gps(data, pos):
+    (mask, pos) = read_varint(data, pos)
+
+    gps_data = {}
+    for (i, field) in enumerate(GPS_FIELDS):
+        if mask & (1 << i):
+            if field == 'mode':
+                (gps_data[field], pos) = read_varint(data, pos)
+            elif field == 'time':
+                (gps_data[field], pos) = read_str(data, pos)
+            else:
+                gps_data[field] = DOUBLE.unpack_from(data, pos)[0]
+                pos += DOUBLE.size
+
+    return (Gps_Scan(gps_data), pos)
+
+def write_bcch(buf, meas):
+    (arfcns, num_arfcn) = meas.get_arfcn_lst()
+    (channels, num_channels) = meas.get_channel_lst()
+    data = meas.get_data()
+
+    write_varint(buf, int(num_arfcn))
+    write_varint(buf, int(num_channels))
+
+    write_varint(buf, len(arfcns))
+    for arfcn in arfcns:
+        write_varint(buf, int(arfcn))
+    write_varint(buf, len(channels))
+    for channel in channels:
+        write_varint(buf, int(channel))
+
+    for key in data:
+        if key not in BCCH_FIELDS:
+            raise Exception("Unknown bcch field cannot be encoded: " + key)
+
+    # One mask for the fields that exist and one for those that are None
+    present = 0
+    null = 0
+    for (i, field) in enumerate(BCCH_FIELDS):
+        if field in data:
+            present |= 1 << i
+            if data[field] is None:
+                null |= 1 << i
+    write_varint(buf, present)
+    write_varint(buf, null)
+
+    for (i, field) in enumerate(BCCH_FIELDS):
+        if (present & (1 << i)) and not (null & (1 << i)):
+            if field == 'cell_status':
+                write_str(buf, data[field])
+            elif field == 'ber':
+                buf += DOUBLE.pack(float(data[field]))
+            else:
+                write_sint(buf, int(data[field]))
+
+def read_bcch(data, pos, meas):
+    (num_arfcn, pos) = read_varint(data, pos)
+    (num_channels, pos) = read_varint(data, pos)
+
+    (n, pos) = read_varint(data, pos)
+    arfcns = []
+    for _ in range(n):
+        (arfcn, pos) = read_varint(data, pos)
+        arfcns.append(arfcn)
+
+    (n, pos) = read_varint(data, pos)
+    channels = []
+    for _ in range(n):
+        (channel, pos) = read_varint(data, pos)
+        channels.append(channel)
+
+    meas.set_arfcn_lst(arfcns, num_arfcn)
+    meas.set_channel_lst(channels, num_channels)
+
+    (present, pos) = read_varint(data, pos)
+    (null, pos) = read_varint(data, pos)
+
+    bcch_data = {}
+    for (i, field) in enumerate(BCCH_FIELDS):
+        if not present & (1 << i):
+            continue
+        if null & (1 << i):
+            bcch_data[field] = None
+        elif field == 'cell_status':
+            (bcch_data[field], pos) = read_str(data, pos)
+        elif field == 'ber':
+            bcch_data[field] = DOUBLE.unpack_from(data, pos)[0]
+            pos += DOUBLE.size
+        else:
+            (bcch_data[field], pos) = read_sint(data, pos)
+
+    meas.set_bcch_data(bcch_data)
+
+    return pos
+
+def encode(full_scan, compression='zlib', dict_id=None):
+    '''Packs a Scan into a compact, versioned byte string
+
+    The layout is a version byte, a flags byte and then the fields packed
+    as varints (ints), zigzag varints (signed ints), little endian doubles
+    (floats) and length prefixed utf-8 (strings). Measurement blobs are
+    stored as offsets into the scan blob so the raw modem text is only
+    stored once, and then compressed.
+
+    Args:
+        full_scan (Scan): The scan to encode
+        compression (String): 'zlib', 'zstd' or None (see common.compress)
+        dict_id (int): A loaded zstd dictionary to compress with (optional)
+
+    Return:
+        (bytes): The encoded scan. Use decode() to get the Scan back.
+    '''
+    gsm = full_scan.get_gsm()
+    (freq_low, freq_high) = gsm.get_freq_range()
+    sensor_name = full_scan.get_sensor_name()
+    scan_blob = gsm.blob
+
+    flags = 0
+    if gsm.get_error():
+        flags |= FLAG_ERROR
+    if gsm.get_jammed():
+        flags |= FLAG_JAMMED
+    if full_scan.get_high_quality():
+        flags |= FLAG_HIGH_QUALITY
+    if freq_low is not None and freq_high is not None:
+        flags |= FLAG_FREQ_RANGE
+    if sensor_name is not None:
+        flags |= FLAG_SENSOR_NAME
+    if scan_blob is not None:
+        flags |= FLAG_SCAN_BLOB
+        if compression is not None:
+            flags |= FLAG_BLOB_COMPRESSED
+
+    buf = bytearray((ENCODING_VERSION, flags))
+
+    if flags & FLAG_FREQ_RANGE:
+        write_varint(buf, int(freq_low))
+        write_varint(buf, int(freq_high))
+    if flags & FLAG_SENSOR_NAME:
+        write_str(buf, sensor_name)
+    if flags & FLAG_BLOB_COMPRESSED:
+        write_str(buf, compression)
+        write_varint(buf, dict_id if dict_id is not None else 0)
+        compressed = compress.compress(scan_blob, compression, dict_id)
+        write_varint(buf, len(compressed))
+        buf += compressed
+    elif flags & FLAG_SCAN_BLOB:
+        write_str(buf, scan_blob)
+
+    write_gps(buf, full_scan.get_gps_before().get_gps_data())
+    write_gps(buf, full_scan.get_gps_after().get_gps_data())
+
+    write_varint(buf, len(gsm.gsm_measurements))
+
+    # Measurements come in order so we search for each blob after the last
+    search_from = 0
+    for meas in gsm.measurement_cursor():
+        meas_flags = 0
+        if isinstance(meas, Bcch_Measurement):
+            meas_flags |= MEAS_BCCH
+        if meas.get_gps() is not None:
+            meas_flags |= MEAS_GPS
+
+        blob_range = meas.get_blob_range()
+        meas_blob = None
+        if blob_range is not None and meas.raw_blob is scan_blob:
+            meas_flags |= MEAS_BLOB_OFFSET
+        elif meas.blob is not None:
+            meas_blob = meas.blob
+
+            # Older measurements carry a copy of the text so look for it
+            offset = -1
+            if scan_blob is not None:
+                offset = scan_blob.find(meas_blob, search_from)
+                if offset == -1:
+                    offset = scan_blob.find(meas_blob)
+            if offset != -1:
+                meas_flags |= MEAS_BLOB_OFFSET
+                blob_range = (offset, offset + len(meas_blob))
+            else:
+                meas_flags |= MEAS_BLOB_INLINE
+
+        buf.append(meas_flags)
+        write_varint(buf, int(meas.get_arfcn()))
+        write_sint(buf, int(meas.get_rx_lev()))
+
+        if meas_flags & MEAS_BLOB_OFFSET:
+            # The offsets are in characters of the (str) scan blob
+            write_varint(buf, blob_range[0])
+            write_varint(buf, blob_range[1] - blob_range[0])
+            search_from = blob_range[1]
+        elif meas_flags & MEAS_BLOB_INLINE:
+            write_str(buf, meas_blob)
+
+        if meas_flags & MEAS_BCCH:
+            write_bcch(buf, meas)
+        if meas_flags & MEAS_GPS:
+            write_gps(buf, meas.get_gps())
+
+    return bytes(buf)
+
+def decode(data):
+    '''Unpacks a byte string made by encode() back into a Scan
+
+    Args:
+        data (bytes): The encoded scan
+
+    Return:
+        (Scan): The decoded scan
+    '''
+    if len(data) < 2 or data[0] not in DECODABLE_VERSIONS:
+        raise Exception("Unsupported scan encoding version")
+
+    flags = data[1]
+    pos = 2
+
+    (freq_low, freq_high) = (None, None)
+    if flags & FLAG_FREQ_RANGE:
+        (freq_low, pos) = read_varint(data, pos)
+        (freq_high, pos) = read_varint(data, pos)
+
+    sensor_name = None
+    if flags & FLAG_SENSOR_NAME:
+        (sensor_name, pos) = read_str(data, pos)
+
+    scan_blob = None
+    if flags & FLAG_BLOB_COMPRESSED:
+        (compression, pos) = read_str(data, pos)
+        (dict_id, pos) = read_varint(data, pos)
+        (length, pos) = read_varint(data, pos)
+        scan_blob = compress.decompress(bytes(data[pos:pos + length]), compression,
+                                        dict_id if dict_id != 0 else None)
+        pos += length
+    elif flags & FLAG_SCAN_BLOB:
+        (scan_blob, pos) = read_str(data, pos)
+
+    (gpsb, pos) = read_gps(data, pos)
+    (gpsa, pos) = read_gps(data, pos)
+
+    gsm_scan = Gsm_Scan(scan_blob, freq_low, freq_high)
+    gsm_scan.set_error(bool(flags & FLAG_ERROR))
+    gsm_scan.set_jammed(bool(flags & FLAG_JAMMED))
+
+    (n_meas, pos) = read_varint(data, pos)
+    for _ in range(n_meas):
+        meas_flags = data[pos]
+        pos += 1
+
+        (arfcn, pos) = read_varint(data, pos)
+        (rx_lev, pos) = read_sint(data, pos)
+
+        meas_blob = None
+        blob_range = None
+        if meas_flags & MEAS_BLOB_OFFSET:
+            (offset, pos) = read_varint(data, pos)
+            (length, pos) = read_varint(data, pos)
+            blob_range = (offset, offset + length)
+        elif meas_flags & MEAS_BLOB_INLINE:
+            (meas_blob, pos) = read_str(data, pos)
+
+        if meas_flags & MEAS_BCCH:
+            meas = Bcch_Measurement(meas_blob)
+            pos = read_bcch(data, pos, meas)
+        else:
+            meas = Gsm_Measurement(meas_blob)
+
+        if meas_flags & MEAS_GPS:
+            (meas_gps, pos) = read_gps(data, pos)
+            meas.set_gps(meas_gps.get_gps_data())
+
+        if blob_range is not None:
+            meas.set_blob_range(scan_blob, blob_range[0], blob_range[1])
+
+        meas.set_arfcn(arfcn)
+        meas.set_rx_lev(rx_lev)
+        gsm_scan.add_measurement(meas)
+
+    return Scan(gsm_scan, gpsb, gpsa, sensor_name, bool(flags & FLAG_HIGH_QUALITY))
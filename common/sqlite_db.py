@@ -0,0 +1,516 @@
+import sqlite3
+import time
+
+import common.utils as utils
+import common.scan as scan
+
+# Nice to have some versioning (kept in step with mongo_db)
+VERSION = 0
+# Number of scans to hold in an open transaction before committing. Each
+# commit is a write to the SD card so we want to do it as rarely as we can.
+COMMIT_BATCH = 10
+# Never hold uncommitted scans for longer than this (in seconds) so that
+# a power cut only loses a little bit of data.
+COMMIT_INTERVAL = 30
+
+# The schema mirrors the Postgres tables in postgres_db. The only additions
+# are the raw blobs, which are needed to rebuild the Scan objects, and the
+# primary keys are plain rowids because sqlite hands them out for free.
+# Measurements normally only keep their offsets into the scan blob,
+# measurement_blob is just for the ones that have no offsets. gps_id is
+# where the measurement itself was taken, if it was located on its own.
+SCAN_SCHEMA = '''
+                id integer primary key,
+                gsm_id integer references Gsm_Scan(id),
+                gps_before_id integer references Gps_Scan(id),
+                gps_after_id integer references Gps_Scan(id),
+                sensor_name text,
+                uuid text unique,
+                version integer,
+                high_quality integer
+                '''
+
+GSM_SCAN_SCHEMA = '''
+                    id integer primary key,
+                    freq_low integer,
+                    freq_high integer,
+                    error integer,
+                    jammed integer,
+                    scan_blob text
+                    '''
+
+GPS_SCAN_SCHEMA = '''
+                    id integer primary key,
+                    mode integer,
+                    time text,
+                    ept real,
+                    lat real,
+                    lon real,
+                    alt real,
+                    epx real,
+                    epy real,
+                    cpv real,
+                    track real,
+                    speed real,
+                    climb real,
+                    epd real,
+                    eps real,
+                    epc real
+                    '''
+
+GSM_MEASUREMENT_SCHEMA = '''
+                    id integer primary key,
+                    gsm_scan_id integer references Gsm_Scan(id),
+                    arfcn integer,
+                    rx_lev integer,
+                    blob_start integer,
+                    blob_end integer,
+                    measurement_blob text,
+                    gps_id integer references Gps_Scan(id)
+                    '''
+
+# Columns added since the first release, which init_tables() adds to older
+# database files: table -> [(column, type)]
+ADDED_COLUMNS = {'Gsm_Measurement' : [('gps_id', 'integer references Gps_Scan(id)')]}
+
+# These are the optional bcch fields. They are kept in a list since the
+# insert and the select both need them in the same order.
+BCCH_FIELDS = ['bsic', 'ber', 'mcc', 'mnc', 'lac', 'cell_id', 'cell_status',
+               'pbcch', 'nom', 'rac', 'spgc', 'pat', 'nco', 't3168', 't3192',
+               'drxmax', 'ctrl_ack', 'bscvmax', 'alpha', 'pc_meas_ch', 'mstxpwr',
+               'rxaccmin', 'croffset', 'penaltyt', 't3212', 'crh']
+
+BCCH_MEASUREMENT_SCHEMA = '''
+                    id integer primary key,
+                    gsm_measurement_id integer references Gsm_Measurement(id),
+                    num_arfcn integer,
+                    num_channels integer,
+                    bsic integer,
+                    ber real,
+                    mcc integer,
+                    mnc integer,
+                    lac integer,
+                    cell_id integer,
+                    cell_status text,
+                    pbcch integer,
+                    nom integer,
+                    rac integer,
+                    spgc integer,
+                    pat integer,
+                    nco integer,
+                    t3168 integer,
+                    t3192 integer,
+                    drxmax integer,
+                    ctrl_ack integer,
+                    bscvmax integer,
+                    alpha integer,
+                    pc_meas_ch integer,
+                    mstxpwr integer,
+                    rxaccmin integer,
+                    croffset integer,
+                    penaltyt integer,
+                    t3212 integer,
+                    crh integer
+                    '''
+
+CHANNEL_LIST_SCHEMA = '''
+                    id integer primary key,
+                    bcch_measurement_id integer references Bcch_Measurement(id),
+                    channel integer
+                    '''
+
+ARFCN_LIST_SCHEMA = '''
+                    id integer primary key,
+                    bcch_measurement_id integer references Bcch_Measurement(id),
+                    arfcn integer
+                    '''
+
+SCAN_INSERT = '''
+                Insert INTO Scan(gsm_id, gps_before_id, gps_after_id, sensor_name,
+                                uuid, version, high_quality)
+                VALUES(?,?,?,?,?,?,?);
+              '''
+
+GSM_SCAN_INSERT = '''
+                    Insert INTO Gsm_Scan(freq_low, freq_high, error, jammed,
+                                         scan_blob)
+                    VALUES(?,?,?,?,?);
+                  '''
+
+GPS_SCAN_INSERT = '''
+                    Insert INTO Gps_Scan(''' + ','.join(scan.GPS_FIELDS) + ''')
+                    VALUES(''' + ','.join(['?'] * len(scan.GPS_FIELDS)) + ''');
+                  '''
+
+GSM_MEASUREMENT_INSERT = '''
+                    Insert INTO Gsm_Measurement(gsm_scan_id, arfcn, rx_lev,
+                                                blob_start, blob_end,
+                                                measurement_blob, gps_id)
+                    VALUES(?,?,?,?,?,?,?);
+                  '''
+
+BCCH_MEASUREMENT_INSERT = '''
+                    Insert INTO Bcch_Measurement(gsm_measurement_id, num_arfcn,
+                                                 num_channels, ''' + ','.join(BCCH_FIELDS) + ''')
+                    VALUES(?,?,?,''' + ','.join(['?'] * len(BCCH_FIELDS)) + ''');
+                  '''
+
+ARFCN_LIST_INSERT = '''Insert INTO Arfcn_List(bcch_measurement_id, arfcn)
+                       VALUES(?,?);
+                    '''
+
+CHANNEL_LIST_INSERT = '''Insert INTO Channel_List(bcch_measurement_id, channel)
+                         VALUES(?,?);
+                      '''
+
+class Database():
+    ''' An embedded replacement for mongo_db.Database on small sensors'''
+
+    # The raw blobs are kept, so a copy into this backend should include them
+    stores_blobs = True
+
+    def __init__(self, db_path, commit_batch=COMMIT_BATCH, commit_interval=COMMIT_INTERVAL):
+        '''Opens (and if necessary creates) the sqlite database file
+
+        Args:
+            db_path (String): A path to the sqlite database file
+            commit_batch (int): Number of scans to group into one transaction
+            commit_interval (int): Longest time (in sec) a scan can sit uncommitted
+        '''
+        # We manage the transactions ourselves so that scans can be batched
+        self.con = sqlite3.connect(db_path, isolation_level=None)
+
+        # WAL mode turns each commit into a sequential append instead of
+        # rewriting pages in place, which is much kinder to SD cards.
+        # synchronous=NORMAL is safe with WAL (only the last commits can be
+        # lost on a power cut, the database itself is never corrupted).
+        self.con.execute("PRAGMA journal_mode=WAL;")
+        self.con.execute("PRAGMA synchronous=NORMAL;")
+        self.con.execute("PRAGMA foreign_keys=ON;")
+
+        self.commit_batch = commit_batch
+        self.commit_interval = commit_interval
+        self.pending = 0
+        # The uuids of the scans in the open transaction
+        self.pending_ids = []
+        self.last_commit = time.time()
+
+        self.init_tables()
+
+    def init_tables(self):
+        cur = self.con.cursor()
+
+        # The order matters because of the foreign keys
+        cur.execute(self.create_table_cmd("Gsm_Scan", GSM_SCAN_SCHEMA))
+        cur.execute(self.create_table_cmd("Gps_Scan", GPS_SCAN_SCHEMA))
+        cur.execute(self.create_table_cmd("Scan", SCAN_SCHEMA))
+        cur.execute(self.create_table_cmd("Gsm_Measurement", GSM_MEASUREMENT_SCHEMA))
+        cur.execute(self.create_table_cmd("Bcch_Measurement", BCCH_MEASUREMENT_SCHEMA))
+        cur.execute(self.create_table_cmd("Channel_List", CHANNEL_LIST_SCHEMA))
+        cur.execute(self.create_table_cmd("Arfcn_List", ARFCN_LIST_SCHEMA))
+
+        # CREATE TABLE leaves the tables of an older file as they were
+        for (tablename, columns) in ADDED_COLUMNS.items():
+            cur.execute("PRAGMA table_info(" + tablename + ");")
+            existing = [row[1] for row in cur.fetchall()]
+            for (colname, coltype) in columns:
+                if colname not in existing:
+                    cur.execute("ALTER TABLE " + tablename + " ADD COLUMN " + \
+                                    colname + " " + coltype + ";")
+
+        # Without these every lookup of a child row is a full table scan
+        cur.execute("CREATE INDEX if not EXISTS gsm_measurement_scan_idx "
+                    "on Gsm_Measurement (gsm_scan_id);")
+        cur.execute("CREATE INDEX if not EXISTS bcch_measurement_meas_idx "
+                    "on Bcch_Measurement (gsm_measurement_id);")
+        cur.execute("CREATE INDEX if not EXISTS channel_list_bcch_idx "
+                    "on Channel_List (bcch_measurement_id);")
+        cur.execute("CREATE INDEX if not EXISTS arfcn_list_bcch_idx "
+                    "on Arfcn_List (bcch_measurement_id);")
+
+    def insert_sensor_point(self, full_scan, version=VERSION):
+        ''' This will insert a scan point + gps into the database
+
+        Args:
+            scan (Scan): The object that represents the entire scan
+        '''
+        self.write_batch([(full_scan, utils.generate_unique_id(), version)])
+
+    def insert_scans(self, scan_uuids):
+        '''Inserts a list of (scan, uuid, version) in a single transaction'''
+        self.write_batch(scan_uuids)
+        self.commit()
+
+    def write_batch(self, scan_uuids):
+        '''Adds a list of (scan, uuid, version) to the open transaction
+
+        The transaction is only committed once commit_batch scans have
+        built up (or commit_interval seconds have passed). Until then the
+        scans are not on disk (see pending_uuids()), so a crash loses up to
+        commit_batch scans or commit_interval seconds of them. flush() and
+        close() commit whatever is left.
+        '''
+        utils.log("Trying to write to the DB...")
+        self.begin()
+        for (full_scan, uuid, version) in scan_uuids:
+            self.insert_scan(full_scan, uuid, version)
+        self.pending += len(scan_uuids)
+        self.pending_ids += [uuid for (_, uuid, _) in scan_uuids]
+
+        if self.pending >= self.commit_batch or \
+                time.time() - self.last_commit >= self.commit_interval:
+            self.commit()
+        utils.log("Done writing to DB.")
+
+    def iter_scans(self, since=None, include_blobs=True):
+        '''Yields (scan, uuid, version) for scans taken at or after since
+
+        Args:
+            since (String): GPS time formatted like GpsScanner.scan() does it.
+                If None then every scan is returned.
+            include_blobs (bool): If False then the raw blobs are not read
+        '''
+        return self.get_scans(since=since, include_blobs=include_blobs)
+
+    def begin(self):
+        if not self.con.in_transaction:
+            self.con.execute("BEGIN;")
+
+    def commit(self):
+        if self.con.in_transaction:
+            self.con.execute("COMMIT;")
+        self.pending = 0
+        self.pending_ids = []
+        self.last_commit = time.time()
+
+    def flush(self):
+        '''Commits the open transaction so the scans in it are on disk'''
+        self.commit()
+
+    def pending_uuids(self):
+        '''The uuids of the scans in the open transaction'''
+        return list(self.pending_ids)
+
+    def close(self):
+        # Make sure nothing that is still batched gets lost
+        self.commit()
+        self.con.close()
+
+    def insert_scan(self, full_scan, uuid, version):
+        '''Writes the rows for one scan. The caller handles the transaction.'''
+        cur = self.con.cursor()
+
+        gsm_scan = full_scan.get_gsm()
+        gsm_doc = gsm_scan.document()
+
+        cur.execute(GSM_SCAN_INSERT, (gsm_doc.get('freq_low', None),
+                                      gsm_doc.get('freq_high', None),
+                                      gsm_doc['error'],
+                                      gsm_doc['jammed'],
+                                      gsm_doc['scan_blob'],))
+        gsm_scan_id = cur.lastrowid
+
+        gps_before_data = full_scan.get_gps_before().get_gps_data()
+        cur.execute(GPS_SCAN_INSERT, self.generate_gps_tuple(gps_before_data))
+        gps_before_id = cur.lastrowid
+
+        gps_after_data = full_scan.get_gps_after().get_gps_data()
+        cur.execute(GPS_SCAN_INSERT, self.generate_gps_tuple(gps_after_data))
+        gps_after_id = cur.lastrowid
+
+        cur.execute(SCAN_INSERT, (gsm_scan_id, gps_before_id, gps_after_id,
+                                  full_scan.get_sensor_name(), uuid, version,
+                                  full_scan.get_high_quality(),))
+
+        # The measurement documents already have all of the fields converted
+        # to the proper types so we just use those
+        for meas_doc in gsm_doc['measurements']:
+            gps_id = None
+            if 'gps' in meas_doc:
+                cur.execute(GPS_SCAN_INSERT, self.generate_gps_tuple(meas_doc['gps']))
+                gps_id = cur.lastrowid
+
+            cur.execute(GSM_MEASUREMENT_INSERT, (gsm_scan_id, meas_doc['arfcn'],
+                                                 meas_doc['rx_lev'],
+                                                 meas_doc.get('blob_start', None),
+                                                 meas_doc.get('blob_end', None),
+                                                 meas_doc.get('measurement_blob', None),
+                                                 gps_id,))
+            gsm_measurement_id = cur.lastrowid
+
+            if 'bcch' not in meas_doc:
+                continue
+
+            bcch = meas_doc['bcch']
+            bcch_row = [gsm_measurement_id, bcch['num_arfcn'], bcch['num_channels']]
+            bcch_row += [bcch.get(field, None) for field in BCCH_FIELDS]
+            cur.execute(BCCH_MEASUREMENT_INSERT, bcch_row)
+            bcch_measurement_id = cur.lastrowid
+
+            cur.executemany(ARFCN_LIST_INSERT,
+                            [(bcch_measurement_id, a) for a in bcch['arfcns']])
+            cur.executemany(CHANNEL_LIST_INSERT,
+                            [(bcch_measurement_id, c) for c in bcch['channels']])
+
+    def generate_gps_tuple(self, gps_data):
+        return tuple(gps_data.get(field, None) for field in scan.GPS_FIELDS)
+
+    def get_uuids(self):
+        '''Return all of the uuids of the Scans as a list'''
+        cur = self.con.cursor()
+        cur.execute('''Select S.uuid From Scan S''')
+
+        return [row[0] for row in cur.fetchall()]
+
+    def migrate_unique_ids(self):
+        '''Rewrites the old 172 character uuids in the same way mongo_db does'''
+        utils.log("Migrating unique ids...")
+        cur = self.con.cursor()
+
+        # The new ids are all 36 characters long
+        cur.execute('''Select S.id, S.uuid From Scan S Where length(S.uuid) <> 36''')
+        updates = [(utils.compact_unique_id(uuid), scan_id) for (scan_id, uuid) in cur.fetchall()]
+
+        self.begin()
+        cur.executemany('''Update Scan Set uuid = ? Where id = ?''', updates)
+        self.commit()
+
+        utils.log("Migrated {:d} unique ids.".format(len(updates)))
+
+    def get_scans(self, uuids=None, since=None, include_blobs=True):
+        '''This returns a iterable object to get all of the scan objects in the db'''
+        # Anything batched up should be visible to the reader
+        self.commit()
+
+        if uuids is not None:
+            uuids = set(uuids)
+
+        # A separate cursor is used for the child rows so the outer
+        # iteration is not disturbed
+        scan_cur = self.con.cursor()
+        query = '''Select S.gsm_id, S.gps_before_id, S.gps_after_id,
+                          S.sensor_name, S.uuid, S.version, S.high_quality
+                   From Scan S, Gps_Scan G
+                   Where S.gps_before_id = G.id'''
+        params = ()
+        if since is not None:
+            query += ''' and G.time >= ?'''
+            params = (since,)
+        scan_cur.execute(query + ''' Order By S.id''', params)
+
+        for (gsm_id, gps_before_id, gps_after_id, sensor_name,
+                uuid, version, high_quality) in scan_cur:
+
+            if uuids is not None and uuid in uuids:
+                continue
+
+            gsm = self.get_gsm_document(gsm_id, include_blobs)
+            gps_before = self.get_gps_document(gps_before_id)
+            gps_after = self.get_gps_document(gps_after_id)
+
+            yield (scan.scan_factory(gsm, gps_before, gps_after, sensor_name,
+                                     bool(high_quality)), uuid, version)
+
+    def get_gps_document(self, gps_id):
+        cur = self.con.cursor()
+        cur.execute('''Select ''' + ','.join(scan.GPS_FIELDS) + '''
+                       From Gps_Scan G
+                       Where G.id = ?''', (gps_id,))
+        row = cur.fetchone()
+
+        # Gps_Scan only keeps the fields that were actually present, so
+        # the NULL columns are dropped again here
+        return {field: value for (field, value) in zip(scan.GPS_FIELDS, row) \
+                                                        if value is not None}
+
+    def get_gsm_document(self, gsm_id, include_blobs=True):
+        '''Rebuilds the dictionary produced by Gsm_Scan.document()
+
+        Args:
+            gsm_id (int): The id of the Gsm_Scan row
+            include_blobs (bool): If False then the blob columns are never
+                read and the document has None for the blobs
+        '''
+        # Selecting NULL keeps the row shape the same while leaving the
+        # (large) blob columns on disk
+        scan_blob_column = 'G.scan_blob' if include_blobs else 'NULL'
+        measurement_blob_column = 'GM.measurement_blob' if include_blobs else 'NULL'
+
+        cur = self.con.cursor()
+        cur.execute('''Select G.freq_low, G.freq_high, G.error, G.jammed,
+                              ''' + scan_blob_column + '''
+                       From Gsm_Scan G
+                       Where G.id = ?''', (gsm_id,))
+        (freq_low, freq_high, error, jammed, scan_blob) = cur.fetchone()
+
+        gsm = {'scan_blob' : scan_blob,
+               'error' : bool(error),
+               'jammed' : bool(jammed)}
+
+        if freq_low is not None and freq_high is not None:
+            gsm['freq_low'] = freq_low
+            gsm['freq_high'] = freq_high
+
+        measurements = []
+        cur.execute('''Select GM.id, GM.arfcn, GM.rx_lev, GM.blob_start,
+                              GM.blob_end, ''' + measurement_blob_column + ''', GM.gps_id
+                       From Gsm_Measurement GM
+                       Where GM.gsm_scan_id = ?
+                       Order By GM.id''', (gsm_id,))
+
+        for (meas_id, arfcn, rx_lev, blob_start, blob_end, measurement_blob, gps_id) \
+                in cur.fetchall():
+            raw_meas = {'arfcn' : arfcn, 'rx_lev' : rx_lev}
+
+            if blob_start is not None:
+                raw_meas['blob_start'] = blob_start
+                raw_meas['blob_end'] = blob_end
+            else:
+                raw_meas['measurement_blob'] = measurement_blob
+
+            if gps_id is not None:
+                raw_meas['gps'] = self.get_gps_document(gps_id)
+
+            bcch = self.get_bcch_document(meas_id)
+            if bcch is not None:
+                raw_meas['bcch'] = bcch
+
+            measurements.append(raw_meas)
+
+        gsm['measurements'] = measurements
+
+        return gsm
+
+    def get_bcch_document(self, gsm_measurement_id):
+        cur = self.con.cursor()
+        cur.execute('''Select BM.id, BM.num_arfcn, BM.num_channels, ''' + \
+                            ','.join(['BM.' + field for field in BCCH_FIELDS]) + '''
+                       From Bcch_Measurement BM
+                       Where BM.gsm_measurement_id = ?''', (gsm_measurement_id,))
+        row = cur.fetchone()
+
+        if row is None:
+            return None
+
+        bcch = dict(zip(BCCH_FIELDS, row[3:]))
+        bcch['num_arfcn'] = row[1]
+        bcch['num_channels'] = row[2]
+
+        cur.execute('''Select A.arfcn From Arfcn_List A
+                       Where A.bcch_measurement_id = ?
+                       Order By A.id''', (row[0],))
+        bcch['arfcns'] = [r[0] for r in cur.fetchall()]
+
+        cur.execute('''Select C.channel From Channel_List C
+                       Where C.bcch_measurement_id = ?
+                       Order By C.id''', (row[0],))
+        bcch['channels'] = [r[0] for r in cur.fetchall()]
+
+        return bcch
+
+    def create_table_cmd(self, tablename, schema_str):
+        s = "CREATE TABLE if not EXISTS"
+        s += " " + tablename + "\n"
+        s += "(" + schema_str + ");"
+
+        return s
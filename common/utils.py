@@ -1,8 +1,9 @@
-import time
-import sys
+import uuid
 import datetime
 
-def log(message, is_bytes = False, gps_data = None):
+import common.logger as logger
+
+def log(message, is_bytes = False, gps_data = None, level = logger.INFO):
     '''This takes a string to be logged.
     
     This will include hte timestamp and the message and will log it.
@@ -10,40 +11,22 @@ def log(message, is_bytes = False, gps_data = None):
     strings and gps_data. In the case where is_bytes is true, then
     gps_data will be ignored.
 
+    The message is only queued here. It is formatted and written out by
+    common.logger's background thread.
+
     Args:
         message (string): The message, as a string, to be logged.
         is_bytes (bool): It should be printed like a byte string 
         gps_data (dict): Additional data that needs to be formatted and printed.
+        level (int): How important it is (see common.logger)
     
     '''
     if is_bytes:
-        print(message)
-        sys.stdout.flush()
-        return
-
-    if gps_data is not None:
-
-        message = message + ":\n"
-        message += "  ept - estimated time stamp error: " + str(gps_data.get('ept', None)) + "\n"
-        message += "  lat - latitude: " + str(gps_data.get('lat', None)) + "\n"
-        message += "  lon - longitude: " + str(gps_data.get('lon', None)) + "\n"
-        message += "  alt - altitude: " + str(gps_data.get('alt', None)) + "\n"
-        message += "  epx - estimated error in longitude (m): " + str(gps_data.get('epx', None)) + "\n"
-        message += "  epy - estimated error in latitude (m): " + str(gps_data.get('epy', None)) + "\n"
-        message += "  epv - estimated vertical error (m): " + str(gps_data.get('epv', None)) + "\n"
-        message += "  track - course over ground (deg from true N): " + str(gps_data.get('track', None)) + "\n"
-        message += "  speed - speed over ground (m/s): " + str(gps_data.get('speed', None)) + "\n"
-        message += "  climb - climb (+) or sink (-) (m/s): " + str(gps_data.get('climb', None)) + "\n"
-        message += "  epd - direction error (deg): " + str(gps_data.get('epd', None)) + "\n"
-        message += "  eps - speed error (m/s): " + str(gps_data.get('eps', None)) + "\n"
-        message += "  epc - climb/sink error (m/s): " + str(gps_data.get('epc', None)) + "\n"
-        message += "  mode (what kind of fix): " + str(gps_data.get('mode', None)) + "\n"
-        message += "  time: " + str(gps_data.get('time', None))
-
-    ts = time.time()
-    timestamp = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
-    print(str(timestamp) + ": " + message)
-    sys.stdout.flush()
+        logger.log(level, message, raw=True)
+    elif gps_data is not None:
+        logger.log(level, message, gps_data=gps_data)
+    else:
+        logger.log(level, message)
 
 def log_gps_time(time, mode):
     '''This will log the time that is given as a string (assumed GPS time)
@@ -51,17 +34,28 @@ def log_gps_time(time, mode):
     Args:
         time (string): The time to be logged
     '''
-    if mode is None:
-        print("GPS MODE: None")
-    else:
-        print("GPS MODE: " + mode)
+    logger.info("GPS MODE: {}", mode, raw=True)
+    logger.info("GPS TIME: {}", time, raw=True)
 
-    if time is None:
-        print("GPS TIME: None")
-    else:
-        print("GPS TIME: " + time)
+def parse_gps_time(gps_time):
+    '''Turns a GPS time string (as GpsScanner.scan() formats it) into a datetime
+
+    Args:
+        gps_time (string): e.g. "2017-03-04 12:01:02.000"
+
+    Return:
+        datetime: The time (UTC), or None if it could not be parsed
+    '''
+    if gps_time is None:
+        return None
+
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(gps_time, fmt)
+        except ValueError:
+            pass
 
-    sys.stdout.flush()
+    return None
 
 def get_sensor_name():
     '''Useful if you have multiple sensors and want to distinguish them
@@ -72,3 +66,38 @@ def get_sensor_name():
     '''
 
     return "seaglass-0"
+
+# Older scans were given 172 character ids. These are mapped into this
+# namespace so that they get the same new id wherever they are migrated.
+LEGACY_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "https://seaglass.cs.washington.edu")
+
+def generate_unique_id():
+    '''Makes the random identifier that is stored with every scan.
+
+    The id is a random (version 4) UUID. It is passed around as its
+    canonical string and stored as its 16 raw bytes where the database
+    allows it.
+
+    Return:
+        string: The unique id
+    '''
+    return str(uuid.uuid4())
+
+def compact_unique_id(unique_id):
+    '''Maps an id of any age onto the UUID form that generate_unique_id makes.
+
+    Ids that are already UUIDs are returned unchanged. The old base64 ids
+    are turned into a name based (version 5) UUID, so the same old id
+    always maps to the same new one. This lets Mongo, Postgres and the
+    other backends be migrated separately and still agree.
+
+    Args:
+        unique_id (string): The id to convert
+
+    Return:
+        string: The UUID form of the id
+    '''
+    try:
+        return str(uuid.UUID(unique_id))
+    except ValueError:
+        return str(uuid.uuid5(LEGACY_ID_NAMESPACE, unique_id))
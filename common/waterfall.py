@@ -0,0 +1,216 @@
+import bisect
+import calendar
+import mmap
+import os
+import struct
+import time
+
+# numpy is optional. It is only needed for as_array().
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import common.utils as utils
+
+# Every waterfall file starts with this so we know how to read it
+WATERFALL_MAGIC = b'SGWFALL\x01'
+# magic, number of columns, number of rows in use
+HEADER = struct.Struct('<8sIQ')
+# Rows are padded out to this so the data is aligned
+HEADER_SIZE = 64
+# One column for each ARFCN
+NUM_ARFCNS = 1024
+# The ARFCN was not part of the scan that made this row
+NOT_SCANNED = -128
+# The ARFCN was scanned but the modem did not report it
+NOT_HEARD = -127
+# The file grows by this many rows at a time
+GROW_ROWS = 4096
+# The time of each row is kept in a second file with this suffix
+TIME_SUFFIX = '.time'
+TIME = struct.Struct('<d')
+ROW = struct.Struct('{:d}b'.format(NUM_ARFCNS))
+
+def clamp_rx_lev(rx_lev):
+    '''Fits an rx_lev into an int8 without hitting the sentinels'''
+    return max(NOT_HEARD + 1, min(127, rx_lev))
+
+def scan_timestamp(full_scan):
+    '''The GPS time of a scan in seconds since the epoch, or now if it has none'''
+    gps_time = utils.parse_gps_time(full_scan.get_gps_before().get_time())
+    if gps_time is None:
+        return time.time()
+
+    # The GPS times are UTC
+    return calendar.timegm(gps_time.timetuple()) + gps_time.microsecond / 1e6
+
+class Waterfall():
+    ''' A memory-mapped spectrum waterfall.
+
+    Each row holds an int8 rx_lev for each of the NUM_ARFCNS ARFCNs, with
+    NOT_SCANNED for ARFCNs outside the scan that made the row and NOT_HEARD
+    for ones inside it that the modem did not report. A second file keeps
+    the time of each row as a double. Both are plain fixed width arrays so
+    any row, column or time range is just a slice of the mapped file.
+    '''
+
+    def __init__(self, path, readonly=False):
+        '''Maps the waterfall files (they are created if needed)
+
+        Args:
+            path (String): The path to the waterfall file. The time index is
+                kept next to it with TIME_SUFFIX on the end.
+            readonly (bool): Open for reading only, e.g. while survey.py is
+                still appending to it. Call refresh() to see the new rows.
+        '''
+        self.path = path
+        self.readonly = readonly
+
+        if not readonly and not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(WATERFALL_MAGIC, NUM_ARFCNS, 0).ljust(HEADER_SIZE, b'\0'))
+            open(path + TIME_SUFFIX, 'wb').close()
+
+        mode = 'rb' if readonly else 'r+b'
+        self.data_file = open(path, mode)
+        self.time_file = open(path + TIME_SUFFIX, mode)
+
+        self.map()
+
+        (magic, columns, self.n_rows) = HEADER.unpack_from(self.data, 0)
+        if magic != WATERFALL_MAGIC or columns != NUM_ARFCNS:
+            self.close()
+            raise Exception("Not a waterfall file: " + path)
+
+    def map(self):
+        '''Maps both files at their current size'''
+        access = mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE
+        self.data = mmap.mmap(self.data_file.fileno(), 0, access=access)
+
+        # mmap can not map an empty file
+        self.time_map = None
+        self.times = memoryview(b'').cast('d')
+        if os.fstat(self.time_file.fileno()).st_size > 0:
+            self.time_map = mmap.mmap(self.time_file.fileno(), 0, access=access)
+            self.times = memoryview(self.time_map).cast('d')
+
+        self.capacity = (len(self.data) - HEADER_SIZE) // NUM_ARFCNS
+
+    def unmap(self):
+        # The view has to go before the mapping under it can be closed
+        self.times.release()
+        if self.time_map is not None:
+            self.time_map.close()
+        self.data.close()
+
+    def refresh(self):
+        '''Picks up rows appended since the files were opened'''
+        # Map the files again as they may have grown
+        self.unmap()
+        self.map()
+
+        (_, _, self.n_rows) = HEADER.unpack_from(self.data, 0)
+
+    def grow(self):
+        '''Makes room for another GROW_ROWS rows'''
+        self.unmap()
+
+        capacity = self.capacity + GROW_ROWS
+        self.data_file.truncate(HEADER_SIZE + capacity * NUM_ARFCNS)
+        self.time_file.truncate(capacity * TIME.size)
+
+        self.map()
+
+    def append(self, timestamp, row):
+        '''Adds a row to the end of the waterfall
+
+        Args:
+            timestamp (float): Seconds since the epoch
+            row (bytes): NUM_ARFCNS int8 values
+        '''
+        if len(row) != NUM_ARFCNS:
+            raise Exception("A waterfall row needs {:d} columns".format(NUM_ARFCNS))
+
+        if self.n_rows >= self.capacity:
+            self.grow()
+
+        offset = HEADER_SIZE + self.n_rows * NUM_ARFCNS
+        self.data[offset:offset + NUM_ARFCNS] = row
+        self.times[self.n_rows] = timestamp
+
+        # The row count goes last so a reader never sees a half written row
+        self.n_rows += 1
+        HEADER.pack_into(self.data, 0, WATERFALL_MAGIC, NUM_ARFCNS, self.n_rows)
+
+    def append_scan(self, full_scan):
+        '''Adds a row for a scan'''
+        row = bytearray(struct.pack('b', NOT_SCANNED) * NUM_ARFCNS)
+
+        (freq_low, freq_high) = full_scan.get_gsm().get_freq_range()
+        if freq_low is not None and freq_high is not None:
+            row[freq_low:freq_high + 1] = struct.pack('b', NOT_HEARD) * (freq_high + 1 - freq_low)
+
+        # memoryview lets us write signed values straight into the row
+        columns = memoryview(row).cast('b')
+        for measurement in full_scan.get_gsm().measurement_cursor():
+            arfcn = int(measurement.get_arfcn())
+            rx_lev = clamp_rx_lev(int(measurement.get_rx_lev()))
+
+            # Keep the strongest if an ARFCN is reported more than once
+            if 0 <= arfcn < NUM_ARFCNS and rx_lev > columns[arfcn]:
+                columns[arfcn] = rx_lev
+        columns.release()
+
+        self.append(scan_timestamp(full_scan), row)
+
+    def get_row(self, i):
+        '''The rx_levs of row i as a list of ints, indexed by ARFCN'''
+        offset = HEADER_SIZE + i * NUM_ARFCNS
+        return list(ROW.unpack_from(self.data, offset))
+
+    def get_column(self, arfcn, start=0, end=None):
+        '''The history of one ARFCN over rows start to end as a list of ints'''
+        if end is None or end > self.n_rows:
+            end = self.n_rows
+
+        # A strided slice of the mapping picks the column out of each row
+        offset = HEADER_SIZE + arfcn
+        column = self.data[offset + start * NUM_ARFCNS:offset + end * NUM_ARFCNS:NUM_ARFCNS]
+        return list(struct.unpack('{:d}b'.format(len(column)), column))
+
+    def get_time(self, i):
+        return self.times[i]
+
+    def find_rows(self, start_time, end_time):
+        '''The range of rows with start_time <= time < end_time
+
+        The rows are assumed to be in time order, which they are when they
+        are appended as the scans come in.
+
+        Return:
+            (int, int): The first row and one past the last row
+        '''
+        times = self.times[:self.n_rows]
+        return (bisect.bisect_left(times, start_time), bisect.bisect_left(times, end_time))
+
+    def as_array(self):
+        '''The whole waterfall as a (rows x NUM_ARFCNS) numpy array
+
+        This is a view of the mapped file so nothing is copied. It has to be
+        deleted before any more rows can be appended.
+        '''
+        if numpy is None:
+            raise Exception("The numpy package is needed for as_array()")
+
+        return numpy.frombuffer(self.data, dtype=numpy.int8, count=self.n_rows * NUM_ARFCNS,
+                                offset=HEADER_SIZE).reshape((self.n_rows, NUM_ARFCNS))
+
+    def close(self):
+        if not self.readonly:
+            self.data.flush()
+            if self.time_map is not None:
+                self.time_map.flush()
+        self.unmap()
+        self.data_file.close()
+        self.time_file.close()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+import sys
+
+import common.utils as utils
+import common.storage as storage
+import common.columnar as columnar
+
+def main(source_url, path, output_format='parquet', since=None):
+    '''Exports the scans in a storage backend as Parquet or Arrow files
+
+    Args:
+        source_url (String): Storage URL to read from (see common.storage)
+        path (String): The output directory
+        output_format (String): 'parquet' or 'arrow'
+        since (String): Only export scans taken at or after this GPS time
+    '''
+    source = storage.open_backend(source_url)
+
+    columnar.export(source, path, output_format, since)
+
+    source.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or len(sys.argv) > 5:
+        utils.log("Usage: ./export.py <source_url> <output_dir> [parquet|arrow [<since>]]")
+        sys.exit(-1)
+
+    output_format = sys.argv[3] if len(sys.argv) > 3 else 'parquet'
+    since = sys.argv[4] if len(sys.argv) > 4 else None
+
+    main(sys.argv[1], sys.argv[2], output_format, since)
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+import sys
+
+import common.utils as utils
+import common.storage as storage
+
+def main(urls):
+    '''Converts the old style unique ids in each backend to 16 byte UUIDs
+
+    The same old id always becomes the same new id, so the backends can be
+    migrated in any order (or not at all) and still match up.
+    '''
+    for url in urls:
+        backend = storage.open_backend(url)
+
+        utils.log("Migrating " + url)
+        backend.migrate_unique_ids()
+
+        backend.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        utils.log("Usage: ./migrate_unique_ids.py <storage_url> [<storage_url> ...]")
+        sys.exit(-1)
+
+    main(sys.argv[1:])
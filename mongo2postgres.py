@@ -7,15 +7,16 @@ import os
 
 import postgres_config
 import common.utils as utils
-import common.mongo_db as mongo_db
-import common.postgres_db as postgres_db
+import common.storage as storage
 import common.scan as scan
 
 INSERT_NUM = 100
+SOURCE_URL = "mongodb://localhost:27017/SensorDB/Scan"
+
+def open_postgres_config():
+    '''Opens the postgres database described in postgres_config'''
+    import common.postgres_db as postgres_db
 
-def main():
-    mdb = mongo_db.Database("SensorDB", "Scan")
-    
     pdb = postgres_db.Database(postgres_config.database, \
                                 postgres_config.username, \
                                 postgres_config.password, \
@@ -33,26 +34,37 @@ def main():
     utils.log("Initializing tables...")
     pdb.init_tables()
 
-    # Grab the uuids that exist
-    uuids = pdb.get_uuids()
+    return pdb
+
+def main(source_url=SOURCE_URL, sink_url=None):
+    '''Copies all of the new scans from the source to the sink
 
-    # Read in each of the scan objects
-    scan_uuid_lst = []
-    i = 0
-    for (full_scan, uuid, version) in mdb.get_scans(uuids=uuids):
-        i = i + 1
-        if i % 100 == 0:
-            pprint("Scan number: {:d}".format(i))
+    Args:
+        source_url (String): Storage URL to read from (see common.storage)
+        sink_url (String): Storage URL to write to. If None then the postgres
+            database in postgres_config is used.
+    '''
+    source = storage.open_backend(source_url)
 
-        # Actually append the scan to the full scan list
-        scan_uuid_lst.append((full_scan, uuid, version,))
+    if sink_url is None:
+        sink = open_postgres_config()
+    else:
+        sink = storage.open_backend(sink_url)
 
-        if len(scan_uuid_lst) >= INSERT_NUM:
-            pdb.insert_scans(scan_uuid_lst)
-            scan_uuid_lst = []
+    # Marking the exported scans lets retention.py delete them from the
+    # sensor once they are old enough
+    storage.stream(source, sink, batch_size=INSERT_NUM,
+                   mark_exported=hasattr(source, 'mark_exported'))
 
-    if len(scan_uuid_lst) > 0:
-        pdb.insert_scans(scan_uuid_lst)
+    source.close()
+    sink.close()
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 3:
+        utils.log("Usage: ./mongo2postgres.py [<source_url> [<sink_url>]]")
+        sys.exit(-1)
+
+    source_url = sys.argv[1] if len(sys.argv) > 1 else SOURCE_URL
+    sink_url = sys.argv[2] if len(sys.argv) > 2 else None
+
+    main(source_url, sink_url)
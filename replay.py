@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+
+import survey
+import sensor.gps as gps
+import common.capture as capture
+import common.storage as storage
+import common.utils as utils
+
+from common.scan import Gps_Scan, Scan
+from common.parse import Telit_Modem_Parser
+
+# By default the scans are thrown away after they are stored, which is
+# what you want when measuring throughput
+STORAGE_URL = "sqlite://:memory:"
+# 1 replays with the original timing, 2 twice as fast and so on.
+# 0 replays as fast as possible.
+SPEED = 0
+
+def replay(modem_log_path, gps_log_path, database, speed=SPEED):
+    '''Runs recorded modem and GPS data through the parser and into storage
+
+    This builds the scans just like survey.scan() does, so it exercises
+    the same parsing and storage code. With a GPS log the measurements are
+    located on their own too, if the modem log has the read times.
+
+    Args:
+        modem_log_path (String): The modem log (see common.capture)
+        gps_log_path (String): The GPS log, i.e. `gpspipe -w` output (optional)
+        database: The storage backend to write to
+        speed (float): How fast to replay (see SPEED)
+
+    Return:
+        (dict): Counts and timings for the replay
+    '''
+    gps_log = None
+    if gps_log_path is not None:
+        gps_log = capture.GpsLog(gps_log_path, gps.GPS_FRESH)
+
+    stats = {'scans' : 0, 'measurements' : 0, 'parse_sec' : 0.0, 'store_sec' : 0.0}
+
+    first_record = None
+    start = time.time()
+    for record in capture.read_modem_log(modem_log_path):
+        if first_record is None:
+            first_record = record['start']
+
+        # Wait until the record is due
+        if speed > 0:
+            due = start + (record['start'] - first_record) / speed
+            time.sleep(max(0, due - time.time()))
+
+        gps_before = {}
+        gps_after = {}
+        if gps_log is not None:
+            gps_before = gps.format_gps_data(gps_log.get(record['start']))
+            gps_after = gps.format_gps_data(gps_log.get(record['end']))
+
+        parse_start = time.time()
+        parser = Telit_Modem_Parser()
+        gsm_scan = parser.parse_scan(record['data_blob'])
+        gsm_scan.set_freq_range(record['freq_low'], record['freq_high'])
+
+        if gps_log is not None:
+            survey.locate_measurements(gsm_scan, record.get('read_times', None),
+                                       lambda t: gps.interpolate_track(*gps_log.get_track(t), t))
+
+        full_scan = Scan(gsm_scan, Gps_Scan(gps_before), Gps_Scan(gps_after),
+                         record.get('sensor_name', utils.get_sensor_name()))
+        store_start = time.time()
+
+        storage.write_sensor_point(database, full_scan)
+        store_end = time.time()
+
+        stats['scans'] += 1
+        stats['measurements'] += len(gsm_scan.gsm_measurements)
+        stats['parse_sec'] += store_start - parse_start
+        stats['store_sec'] += store_end - store_start
+
+    stats['elapsed_sec'] = time.time() - start
+
+    return stats
+
+def main(modem_log_path, gps_log_path=None, storage_url=STORAGE_URL, speed=SPEED):
+    database = storage.open_backend(storage_url)
+
+    stats = replay(modem_log_path, gps_log_path, database, speed)
+
+    # Anything batched has to be written out to count
+    close_start = time.time()
+    database.close()
+    stats['store_sec'] += time.time() - close_start
+    stats['elapsed_sec'] += time.time() - close_start
+
+    n_scans = max(stats['scans'], 1)
+    utils.log("Replayed {:d} scans ({:d} measurements) in {:.1f} sec".format( \
+                        stats['scans'], stats['measurements'], stats['elapsed_sec']))
+    utils.log("{:.1f} scans/sec, {:.2f} ms/scan parsing, {:.2f} ms/scan storing".format( \
+                        stats['scans'] / max(stats['elapsed_sec'], 1e-9),
+                        1000 * stats['parse_sec'] / n_scans,
+                        1000 * stats['store_sec'] / n_scans))
+
+    return stats
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or len(sys.argv) > 5:
+        utils.log("Usage: ./replay.py <modem_log> [<gps_log> [<storage_url> [<speed>]]]")
+        sys.exit(-1)
+
+    modem_log_path = sys.argv[1]
+    gps_log_path = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] != '-' else None
+    storage_url = sys.argv[3] if len(sys.argv) > 3 else STORAGE_URL
+    speed = float(sys.argv[4]) if len(sys.argv) > 4 else SPEED
+
+    main(modem_log_path, gps_log_path, storage_url, speed)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+import common.utils as utils
+import common.storage as storage
+
+STORAGE_URL = "mongodb://localhost:27017/SensorDB/Scan"
+# Blobs older than this many days are compacted
+BLOB_DAYS = 30
+# Exported documents older than this many days are deleted
+PURGE_DAYS = 365
+# Remove the old blobs entirely instead of compressing them
+STRIP_BLOBS = False
+# Run at a low priority so survey.py always comes first
+NICENESS = 10
+
+def main(storage_url=STORAGE_URL, blob_days=BLOB_DAYS, purge_days=PURGE_DAYS,
+         strip_blobs=STRIP_BLOBS):
+    '''Compacts the old raw blobs and deletes old scans that have been exported
+
+    The parsed fields are always kept until the scan itself is deleted, and
+    a scan is only deleted once mongo2postgres.py has marked it exported.
+
+    Args:
+        storage_url (String): The mongo storage URL (see common.storage)
+        blob_days (float): Age in days after which blobs are compacted
+        purge_days (float): Age in days after which exported scans are deleted
+        strip_blobs (bool): Strip the blobs rather than compress them
+    '''
+    os.nice(NICENESS)
+
+    database = storage.open_backend(storage_url)
+    if not hasattr(database, 'compact_blobs'):
+        raise Exception("Retention is only supported for mongo: " + storage_url)
+
+    database.compact_blobs(blob_days, strip_blobs)
+    database.purge_exported(purge_days)
+
+    database.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 5:
+        utils.log("Usage: ./retention.py [<storage_url> [<blob_days> [<purge_days> [strip]]]]")
+        sys.exit(-1)
+
+    storage_url = sys.argv[1] if len(sys.argv) > 1 else STORAGE_URL
+    blob_days = float(sys.argv[2]) if len(sys.argv) > 2 else BLOB_DAYS
+    purge_days = float(sys.argv[3]) if len(sys.argv) > 3 else PURGE_DAYS
+    strip_blobs = len(sys.argv) > 4 and sys.argv[4] == 'strip'
+
+    main(storage_url, blob_days, purge_days, strip_blobs)
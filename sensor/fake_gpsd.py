@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+'''A stand-in for gpsd that serves made up (or recorded) fixes over TCP.
+
+FakeGpsd speaks enough of the gpsd JSON protocol for GpsScanner: it sends
+VERSION when a client connects, answers ?WATCH with DEVICES and WATCH and
+then streams TPV reports (and SKY reports now and then). It does not need
+a gpsd binary or a pty, so the client socket path can be load tested
+anywhere:
+
+    server = FakeGpsd(rate=10)
+    scanner = gps.GpsScanner(port=server.port)
+
+The stream can drop reports at random, send them in bursts or go quiet
+for a while, to exercise the staleness logic. Run it on its own with
+
+    python3 -m sensor.fake_gpsd [<port> [<rate> [<gps_log>]]]
+'''
+import json
+import math
+import random
+import socketserver
+import sys
+import threading
+import time
+
+import common.utils as utils
+import common.capture as capture
+import common.clock as clock_module
+
+# Where a synthesized track starts (lat, lon)
+START_POSITION = (47.6553, -122.3035)
+# How fast (m/s) and which way (deg from true N) a synthesized track moves
+SPEED = 10.0
+TRACK = 45.0
+# Meters in a degree of latitude
+METERS_PER_DEGREE = 111320.0
+DEVICE = '/dev/ttyFAKE0'
+
+class SynthesizedTrack():
+    ''' A fix moving in a straight line at a constant speed.'''
+
+    def __init__(self, position=START_POSITION, speed=SPEED, track=TRACK,
+                 clock=clock_module.REAL_CLOCK):
+        self.position = position
+        self.speed = speed
+        self.track = track
+        self.start = clock.time()
+
+    def tpv(self, timestamp):
+        '''The TPV report for a time (seconds since the epoch)'''
+        distance = self.speed * (timestamp - self.start)
+        lat = self.position[0] + distance * math.cos(math.radians(self.track)) / METERS_PER_DEGREE
+        lon = self.position[1] + distance * math.sin(math.radians(self.track)) / \
+                                    (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+
+        return {'class' : 'TPV', 'device' : DEVICE, 'mode' : 3,
+                'time' : capture.gpsd_time(timestamp), 'ept' : 0.005,
+                'lat' : lat, 'lon' : lon, 'alt' : 30.0,
+                'epx' : 5.0, 'epy' : 5.0, 'epv' : 10.0,
+                'track' : self.track, 'speed' : self.speed, 'climb' : 0.0,
+                'eps' : 10.0}
+
+class RecordedTrack():
+    ''' Loops over the TPV reports of a GPS log, restamped with the current time.'''
+
+    def __init__(self, path):
+        self.reports = [report for (_, report) in capture.read_tpv_log(path)]
+        if len(self.reports) == 0:
+            raise Exception("There are no TPV reports in " + path)
+        self.n = 0
+
+    def tpv(self, timestamp):
+        report = dict(self.reports[self.n % len(self.reports)])
+        report['time'] = capture.gpsd_time(timestamp)
+        self.n += 1
+
+        return report
+
+class FakeGpsdHandler(socketserver.BaseRequestHandler):
+    ''' Talks to one client.'''
+
+    def send(self, report):
+        # gpsd ends every report with \r\n, which the client checks for
+        self.request.sendall(bytes(json.dumps(report) + "\r\n", 'UTF-8'))
+
+    def handle(self):
+        config = self.server.config
+        clock = config['clock']
+
+        self.send({'class' : 'VERSION', 'release' : 'fake', 'rev' : 'fake',
+                   'proto_major' : 3, 'proto_minor' : 11})
+
+        # Nothing is streamed until the client asks for it
+        buf = b''
+        while b'?WATCH' not in buf:
+            data = self.request.recv(1024)
+            if len(data) == 0:
+                return
+            buf += data
+
+        self.send({'class' : 'DEVICES', 'devices' : [{'class' : 'DEVICE', 'path' : DEVICE,
+                                                      'driver' : 'fake', 'activated' : capture.gpsd_time(clock.time()),
+                                                      'native' : 0, 'bps' : 9600,
+                                                      'parity' : 'N', 'stopbits' : 1,
+                                                      'cycle' : 1.0 / config['rate']}]})
+        self.send({'class' : 'WATCH', 'enable' : True, 'json' : True})
+
+        rnd = random.Random(config['seed'])
+        start = clock.time()
+        next_report = start
+        next_sky = start
+        pending = []
+
+        try:
+            while not self.server.stopped:
+                now = clock.time()
+                if now < next_report:
+                    clock.sleep(next_report - now)
+                    now = clock.time()
+                next_report += 1.0 / config['rate']
+
+                # Nothing at all is sent during an outage
+                elapsed = now - start
+                if any(outage_start <= elapsed < outage_end \
+                        for (outage_start, outage_end) in config['outages']):
+                    continue
+
+                if rnd.random() >= config['drop_rate']:
+                    pending.append(config['track'].tpv(now))
+
+                if config['sky_interval'] is not None and now >= next_sky:
+                    pending.append({'class' : 'SKY', 'device' : DEVICE, 'time' : capture.gpsd_time(now),
+                                    'hdop' : 0.9, 'satellites' : [{'PRN' : 1, 'el' : 45, 'az' : 90,
+                                                                   'ss' : 40, 'used' : True}]})
+                    next_sky = now + config['sky_interval']
+
+                # In burst mode the reports are held back and sent all at once
+                if len(pending) >= config['burst']:
+                    for report in pending:
+                        self.send(report)
+                    pending = []
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away
+            pass
+        finally:
+            # Virtual time should not wait for a client that is gone
+            clock.unregister()
+
+class FakeGpsd(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    ''' The server. It runs in its own thread as soon as it is made.'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, rate=1.0, sky_interval=5.0,
+                 drop_rate=0.0, burst=1, outages=None, track=None, seed=None,
+                 clock=clock_module.REAL_CLOCK):
+        '''Starts serving
+
+        Args:
+            host (String): The address to listen on
+            port (int): The port to listen on (0 picks a free one, see self.port)
+            rate (float): TPV reports per second, e.g. 10 for a 10 Hz receiver
+            sky_interval (float): Seconds between SKY reports (None for none)
+            drop_rate (float): Chance that a TPV report is left out
+            burst (int): Reports are held back and sent this many at a time
+            outages (list): (start, end) seconds after the client starts
+                watching during which nothing is sent
+            track: Where the fixes come from. SynthesizedTrack() by default
+                or RecordedTrack(gps_log) to replay a log.
+            seed (int): Seed for the dropped reports so runs can be repeated
+            clock (Clock): What the reports are timed by (see common.clock)
+        '''
+        socketserver.TCPServer.__init__(self, (host, port), FakeGpsdHandler)
+
+        self.port = self.server_address[1]
+        self.config = {'rate' : rate,
+                       'sky_interval' : sky_interval,
+                       'drop_rate' : drop_rate,
+                       'burst' : burst,
+                       'outages' : outages if outages is not None else [],
+                       'track' : track if track is not None else SynthesizedTrack(clock=clock),
+                       'seed' : seed,
+                       'clock' : clock}
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.shutdown()
+        self.server_close()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 4:
+        utils.log("Usage: python3 -m sensor.fake_gpsd [<port> [<rate> [<gps_log>]]]")
+        sys.exit(-1)
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 2947
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    track = RecordedTrack(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    server = FakeGpsd(port=port, rate=rate, track=track)
+    utils.log("Fake gpsd on port {:d}".format(server.port))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+'''A stand-in for the Telit GT864 on a pseudo-terminal.
+
+FakeModem opens a pty and answers the AT commands GsmScanner sends on the
+slave side, so the whole scan path can be run with no modem attached:
+
+    modem = FakeModem(synthesize_measurements())
+    scanner = gsm.GsmScanner(modem.tty)
+
+The survey output comes from recorded modem logs (see common.capture) or
+is synthesized. Per-ARFCN delays, garbage bytes, JAMMED reports, ERROR
+replies and timeouts can be switched on at random rates or queued up for
+the next survey with fail_next().
+
+Run it on its own with
+
+    python3 -m sensor.fake_gsm [<modem_log>]
+
+and point survey.py at the tty it prints.
+'''
+import os
+import pty
+import random
+import re
+import select
+import sys
+import threading
+import time
+import tty
+
+import common.utils as utils
+import common.capture as capture
+import common.clock as clock_module
+from common.parse import Telit_Modem_Parser
+
+# The full range of ARFCNs for at#csurv with no range
+ARFCN_RANGE = (0, 1023)
+# How long the reader waits for a command before checking if it should stop
+POLL_TIMEOUT = 0.1
+# The ways a survey can go wrong (see fail_next())
+FAILURES = ['garbage', 'jammed', 'error', 'timeout']
+# Bytes that are not valid UTF-8, like the ones the real modem sometimes sends
+GARBAGE = b'\xff\xfe\xc3\x28\xa0\xa1'
+
+SURVEY_START = "Network survey started ...\r\n\r\n"
+SURVEY_END = "\r\nNetwork survey ended\r\n\r\nOK\r\n"
+JAMMED = "\r\n#JDR: JAMMED\r\n"
+OK = "\r\nOK\r\n"
+ERROR = "\r\nERROR\r\n"
+CEER = "\r\n+CEER: No cause information available\r\n\r\nOK\r\n"
+
+# The templates used by synthesize_measurements()
+BCCH_TEMPLATE = "arfcn: {arfcn} bsic: {bsic} rxLev: {rx_lev} ber: 0.00 mcc: 310 mnc: 260 " \
+                "lac: {lac} cellId: {cell_id} cellStatus: CELL_SUITABLE numArfcn: 3 " \
+                "arfcn: {n1} {n2} {n3} numChannels: 2 array: {n1} {n2} pbcch: 0 nom: 1 " \
+                "rac: 0 spgc: 0 pat: 0 nco: 0 t3168: 0 t3192: 0 drxmax: 0 ctrlAck: 0 " \
+                "bsCVmax: 0 alpha: 0 pcMeasCh: 0 mstxpwr: 5 rxaccmin: 0 croffset: 0 " \
+                "penaltyt: 0 t3212: 0  CRH: 4\r\n\r\n\r\n"
+NON_BCCH_TEMPLATE = "arfcn: {arfcn} rxLev: {rx_lev}\r\n\r\n\r\n"
+
+def measurements_from_log(path):
+    '''Collects the measurement text for each ARFCN from a recorded modem log
+
+    Args:
+        path (String): A modem log (see common.capture)
+
+    Return:
+        (dict): ARFCN -> list of the measurement texts recorded for it
+    '''
+    measurements = {}
+
+    parser = Telit_Modem_Parser()
+    for record in capture.read_modem_log(path):
+        gsm_scan = parser.parse_scan(record['data_blob'])
+
+        for measurement in gsm_scan.gsm_measurements:
+            measurements.setdefault(int(measurement.arfcn), []).append(measurement.blob)
+
+    return measurements
+
+def synthesize_measurements(n_arfcns=150, bcch_fraction=0.2, seed=0):
+    '''Makes up measurement text for a random set of ARFCNs
+
+    Args:
+        n_arfcns (int): How many ARFCNs have something on them
+        bcch_fraction (float): The fraction of those that are full bcch reports
+        seed (int): Seed for the random numbers so runs can be repeated
+
+    Return:
+        (dict): ARFCN -> list of measurement texts
+    '''
+    rnd = random.Random(seed)
+
+    measurements = {}
+    for arfcn in rnd.sample(range(ARFCN_RANGE[0], ARFCN_RANGE[1] + 1), n_arfcns):
+        if rnd.random() < bcch_fraction:
+            template = BCCH_TEMPLATE
+        else:
+            template = NON_BCCH_TEMPLATE
+
+        # The parser drops repeated channels, which would not match numChannels
+        (n1, n2, n3) = rnd.sample(range(ARFCN_RANGE[0], ARFCN_RANGE[1] + 1), 3)
+
+        measurements[arfcn] = [template.format(arfcn=arfcn,
+                                               rx_lev=rnd.randint(-110, -47),
+                                               bsic=rnd.randint(0, 63),
+                                               lac=rnd.randint(1, 65535),
+                                               cell_id=rnd.randint(1, 65535),
+                                               n1=n1, n2=n2, n3=n3)]
+
+    return measurements
+
+class FakeModem(threading.Thread):
+    ''' Answers AT commands on a pty like a Telit GT864 would.'''
+
+    def __init__(self, measurements, arfcn_delay=0.0, garbage_rate=0.0, jam_rate=0.0,
+                 error_rate=0.0, timeout_rate=0.0, seed=None, clock=clock_module.REAL_CLOCK):
+        '''Opens the pty and starts answering commands
+
+        Args:
+            measurements (dict): ARFCN -> list of measurement texts, e.g. from
+                measurements_from_log() or synthesize_measurements(). When
+                an ARFCN has several they are used in turn.
+            arfcn_delay (float or dict): Time (in sec) it takes to survey
+                each ARFCN, or a dict of ARFCN -> time for uneven delays
+            garbage_rate (float): Chance of invalid UTF-8 in a survey
+            jam_rate (float): Chance of a JAMMED report in a survey
+            error_rate (float): Chance of a survey replying ERROR
+            timeout_rate (float): Chance of a survey never finishing
+            seed (int): Seed for the random failures so runs can be repeated
+            clock (Clock): What the delays sleep on (see common.clock)
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.measurements = measurements
+        self.arfcn_delay = arfcn_delay
+        self.rates = {'garbage' : garbage_rate,
+                      'jammed' : jam_rate,
+                      'error' : error_rate,
+                      'timeout' : timeout_rate}
+        self.random = random.Random(seed)
+        self.clock = clock
+
+        # Failures queued with fail_next()
+        self.lock = threading.Lock()
+        self.queued_failures = []
+
+        # Which of the texts for each ARFCN is next
+        self.next_text = {}
+        # Counts of the commands seen, handy for checking a test
+        self.commands = {}
+
+        (self.master, self.slave) = pty.openpty()
+        # No echo or line editing, the modem does its own echo
+        tty.setraw(self.slave)
+        self.tty = os.ttyname(self.slave)
+
+        self.running = True
+        self.start()
+
+    def fail_next(self, *failures):
+        '''Makes the next survey fail in these ways (see FAILURES)'''
+        for failure in failures:
+            if failure not in FAILURES:
+                raise Exception("Unknown modem failure: " + str(failure))
+
+        with self.lock:
+            self.queued_failures += failures
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+        os.close(self.master)
+        os.close(self.slave)
+
+    def run(self):
+        buf = b''
+        while self.running:
+            (readable, _, _) = select.select([self.master], [], [], POLL_TIMEOUT)
+            if len(readable) == 0:
+                continue
+
+            buf += os.read(self.master, 1024)
+
+            # The commands end with \r\n (or just \r from a terminal)
+            while b'\r' in buf or b'\n' in buf:
+                (line, buf) = re.split(rb'[\r\n]', buf, maxsplit=1)
+                command = line.decode('ascii', 'replace').strip()
+
+                if command != '':
+                    # Virtual time waits for the reply
+                    with self.clock.busy():
+                        self.handle(command)
+
+    def write(self, text):
+        if isinstance(text, str):
+            text = text.encode('UTF-8')
+        os.write(self.master, text)
+
+    def handle(self, command):
+        '''Replies to one AT command'''
+        lowered = command.lower()
+        self.commands[lowered] = self.commands.get(lowered, 0) + 1
+
+        # The modem echoes the command back first
+        self.write(command + "\r\r\n")
+
+        survey = re.match(r'at#csurvc?(=(\d+),(\d+))?$', lowered)
+        if survey is not None:
+            if survey.group(1) is not None:
+                self.survey(int(survey.group(2)), int(survey.group(3)))
+            else:
+                self.survey(ARFCN_RANGE[0], ARFCN_RANGE[1])
+        elif re.match(r'at#csurvext=\d+$', lowered) or re.match(r'at#jdr=\d+$', lowered) \
+                or lowered == 'at':
+            self.write(OK)
+        elif lowered == 'at+ceer':
+            self.write(CEER)
+        else:
+            self.write(ERROR)
+
+    def get_failures(self):
+        '''The failures for the next survey, queued ones first'''
+        with self.lock:
+            failures = set(self.queued_failures)
+            self.queued_failures = []
+
+        for (failure, rate) in self.rates.items():
+            if rate > 0 and self.random.random() < rate:
+                failures.add(failure)
+
+        return failures
+
+    def get_delay(self, arfcn):
+        if isinstance(self.arfcn_delay, dict):
+            return self.arfcn_delay.get(arfcn, 0.0)
+        return self.arfcn_delay
+
+    def survey(self, freq_low, freq_high):
+        '''Writes out a network survey of the ARFCNs from freq_low to freq_high'''
+        failures = self.get_failures()
+
+        if 'error' in failures:
+            self.write(ERROR)
+            return
+
+        self.write(SURVEY_START)
+
+        arfcns = [arfcn for arfcn in sorted(self.measurements) if freq_low <= arfcn <= freq_high]
+
+        # Put the failures somewhere in the middle of the output
+        garbage_at = self.random.randint(0, len(arfcns)) if 'garbage' in failures else None
+        jammed_at = self.random.randint(0, len(arfcns)) if 'jammed' in failures else None
+
+        # The modem takes time for every ARFCN, not just the ones it hears,
+        # so this is the next ARFCN that has not been waited for
+        surveyed = freq_low
+
+        for (i, arfcn) in enumerate(arfcns):
+            if i == garbage_at:
+                self.write(GARBAGE)
+            if i == jammed_at:
+                self.write(JAMMED)
+
+            # The ones it did not hear since the last record, then this one
+            self.clock.sleep(sum(self.get_delay(silent) for silent in range(surveyed, arfcn + 1)))
+            surveyed = arfcn + 1
+
+            texts = self.measurements[arfcn]
+            n = self.next_text.get(arfcn, 0)
+            self.write(texts[n % len(texts)])
+            self.next_text[arfcn] = n + 1
+
+            # A timeout stops part way through and never says OK
+            if 'timeout' in failures and i >= len(arfcns) // 2:
+                return
+
+        # ...and the ones after the last it heard
+        self.clock.sleep(sum(self.get_delay(silent) for silent in range(surveyed, freq_high + 1)))
+
+        if garbage_at == len(arfcns):
+            self.write(GARBAGE)
+        if jammed_at == len(arfcns):
+            self.write(JAMMED)
+
+        if 'timeout' in failures:
+            return
+
+        self.write(SURVEY_END)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        utils.log("Usage: python3 -m sensor.fake_gsm [<modem_log>]")
+        sys.exit(-1)
+
+    if len(sys.argv) == 2:
+        measurements = measurements_from_log(sys.argv[1])
+    else:
+        measurements = synthesize_measurements()
+
+    modem = FakeModem(measurements)
+    utils.log("Fake modem on " + modem.tty)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        modem.stop()
@@ -1,23 +1,158 @@
 import common.lib.gps_python3 as gps
+import common.clock as clock_module
+import common.capture as capture
 import threading
-import time
+import bisect
+import collections
 import copy
 
 # This is the longest amount of time that we will accept a GPS value.
 # If they are any older then we will ignore them.
 # This time is in seconds.
 GPS_FRESH = 2
+# How long (in sec) the reader waits on gpsd at a time
+READ_TIMEOUT = 0.5
+# Most bytes taken off the socket at once
+READ_SIZE = 4096
+# A line from gpsd longer than this is garbage and is thrown away
+MAX_LINE_LENGTH = 65536
+# How many of the latest fixes are kept for interpolate(), e.g. 1 min at
+# 10 Hz. That is more than the longest modem command (MODEM_TIMELIMIT).
+TRACK_SIZE = 1200
+# Fixes further apart than this (in sec) are not interpolated between
+MAX_INTERPOLATION_GAP = 5
+# The fields interpolate() fills in
+INTERPOLATED_FIELDS = ['lat', 'lon', 'alt']
+# Where gpsd is listening
+GPSD_HOST = "127.0.0.1"
+GPSD_PORT = 2947
+
+def interpolate_lon(lon_a, lon_b, fraction):
+    '''Goes fraction of the way from lon_a to lon_b, the short way around'''
+    if lon_b - lon_a > 180:
+        lon_b -= 360
+    elif lon_a - lon_b > 180:
+        lon_b += 360
+
+    lon = lon_a + (lon_b - lon_a) * fraction
+    if lon < -180:
+        lon += 360
+    elif lon > 180:
+        lon -= 360
+
+    return lon
+
+def interpolate_reports(before, after, fraction):
+    '''A TPV report fraction of the way from one report to another
+
+    Only the time and the INTERPOLATED_FIELDS are interpolated. The mode
+    is the worse of the two and everything else is left out.
+    '''
+    report = {'class' : 'TPV', 'mode' : min(before['mode'], after['mode'])}
+
+    for field in INTERPOLATED_FIELDS:
+        if before.get(field, None) is not None and after.get(field, None) is not None:
+            if field == 'lon':
+                report[field] = interpolate_lon(before[field], after[field], fraction)
+            else:
+                report[field] = before[field] + (after[field] - before[field]) * fraction
+
+    time_before = capture.tpv_timestamp(before)
+    time_after = capture.tpv_timestamp(after)
+    if time_before is not None and time_after is not None:
+        report['time'] = capture.gpsd_time(time_before + (time_after - time_before) * fraction)
+
+    return report
+
+def interpolate_track(times, track, t):
+    '''Where the sensor was at time t, going by a track of fixes
+
+    The position is interpolated between the fixes just before and just
+    after t. If there is only one of them (or they are more than
+    MAX_INTERPOLATION_GAP apart) the nearer one is used, as long as it is
+    within GPS_FRESH of t.
+
+    Args:
+        times (sequence): When each fix was taken, in order
+        track (sequence): The TPV reports with a position, one for each time
+        t (float): The time, on the same clock as times
+
+    Return:
+        (dict): A TPV report (see interpolate_reports()) or None if there
+            was no fix near t
+    '''
+    i = bisect.bisect_right(times, t)
+    before = None
+    after = None
+    if i > 0:
+        before = (times[i - 1], track[i - 1])
+    if i < len(times):
+        after = (times[i], track[i])
+
+    if before is not None and after is not None and \
+            after[0] - before[0] <= MAX_INTERPOLATION_GAP:
+        fraction = 0.0
+        if after[0] > before[0]:
+            fraction = (t - before[0]) / (after[0] - before[0])
+        return interpolate_reports(before[1], after[1], fraction)
+
+    nearest = None
+    for fix in [before, after]:
+        if fix is not None and abs(t - fix[0]) <= GPS_FRESH:
+            if nearest is None or abs(t - fix[0]) < abs(t - nearest[0]):
+                nearest = fix
+
+    if nearest is None:
+        return None
+
+    return interpolate_reports(nearest[1], nearest[1], 0.0)
+
+def format_gps_data(gps_data):
+    '''Turns a gpsd TPV report into the dict that Gps_Scan expects
+
+    Args:
+        gps_data (dict): The TPV report or None if there is none
+
+    Return:
+        (dict): A copy with the time formatted nicely (empty if there was no report)
+    '''
+    # There is nothing to parse so just return
+    if gps_data == None:
+        # We want to create an empty dict so that the insert will work correctly
+        return {}
+
+    gps_data = dict(gps_data)
+    if 'time' in gps_data:
+        gps_data['time'] = gps_data['time'].replace('T', ' ')[:-1]
+
+    return gps_data
 
 # This class is required to pull from gpsd
 class GpsScanner(threading.Thread):
 
-    def __init__(self):
+    def __init__(self, host=GPSD_HOST, port=GPSD_PORT, clock=clock_module.REAL_CLOCK):
+        '''Connects to gpsd and starts collecting fixes
+
+        Args:
+            host (String): The host gpsd is running on
+            port (int): The port gpsd is listening on
+            clock (Clock): What the fix ages are measured on (see common.clock)
+        '''
         # Initialize the thread
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name='GpsScanner')
+        # Don't keep the program alive once everything else has stopped
+        self.daemon = True
+
+        self.clock = clock
 
         # This is the object that will be collecting the gps data
-        self.session = gps.GPS(verbose=False)
+        self.session = gps.GPS(host=host, port=port, verbose=False)
         self.session.stream(gps.WATCH_ENABLE)
+        # The reports are read straight off the socket (see drain()) so a
+        # read never blocks on half of a line
+        self.session.sock.setblocking(False)
+        # The start of a line whose end has not come in yet
+        self.partial_line = b''
 
         # We need this for synchronization
         # Just a standard re-entrant lock
@@ -26,17 +161,31 @@ class GpsScanner(threading.Thread):
         # Initialize the current value to None
         self.set_cur_value(None)
 
+        # The latest fixes with a position, and when each came in (on
+        # self.clock.monotonic()). They come in order so the times can be
+        # searched with bisect.
+        self.track_times = collections.deque(maxlen=TRACK_SIZE)
+        self.track = collections.deque(maxlen=TRACK_SIZE)
+
         # Begin the collection thread
         self.start()
 
-    def set_cur_value(self, val):
+    def set_cur_value(self, val, received=None):
+        '''Sets the latest fix
+
+        Args:
+            val (dict): The TPV report (None for none)
+            received (float): When it came in, on self.clock.monotonic()
+        '''
         self.lock.acquire()
         self.value = val
+        self.received = received
         self.lock.release()
 
     def get_cur_value(self):
+        '''The latest TPV report, or None if it is older than GPS_FRESH'''
         self.lock.acquire()
-        if self.value is not None:
+        if self.value is not None and self.clock.monotonic() - self.received <= GPS_FRESH:
             val = copy.deepcopy(self.value)
         else:
             val = None
@@ -44,61 +193,111 @@ class GpsScanner(threading.Thread):
 
         return val
 
+    def get_age(self):
+        '''How long ago (in sec) the latest TPV report came in, or None'''
+        self.lock.acquire()
+        age = None
+        if self.received is not None:
+            age = self.clock.monotonic() - self.received
+        self.lock.release()
+
+        return age
+
     # Keep pulling from gpsd so the socket doesn't fill
     def run(self):
 
-        n_since_tpv = 0
+        while True:
+            # Block until gpsd sends something. The age check in
+            # get_cur_value() takes care of a gpsd that has gone quiet.
+            if not self.session.waiting(timeout=READ_TIMEOUT):
+                continue
+
+            # Virtual time should not move on while the reports are read
+            with self.clock.busy():
+                if not self.drain():
+                    # gpsd closed the connection. Don't spin on the dead
+                    # socket, the fix will go stale on its own.
+                    self.clock.sleep(READ_TIMEOUT)
+
+    def drain(self):
+        '''Reads every report that has come in, keeping the newest TPV
+
+        The socket is non-blocking, so this only takes what is already
+        there. session.read() would wait for the rest of a line that has
+        only partly come in, and do it inside clock.busy(). Part of a line
+        is kept in self.partial_line until the rest of it comes in.
 
+        Return:
+            (bool): False if the connection to gpsd was lost
+        '''
         while True:
             try:
-                # Update the current value
-                next_val = self.session.next()
-
-                # We are only interested in TPV measurements
-                # There is some chance that we will get back some weird data
-                # So the first two checks make this more roboust
-                if next_val is None or           \
-                      'class' not in next_val or    \
-                      next_val['class'] != 'TPV':
-
-                    bad_read = True
-                    n_since_tpv = n_since_tpv + 1
-
-                else:
-                    bad_read = False
-                    n_since_tpv = 0
-
-                # The read is bad and now the data is old so make it None
-                # If the data is bad but not enough loops for tpv then don't
-                # update anything
-                if bad_read and n_since_tpv >= 4:
-                   self.set_cur_value(None)
-                elif not bad_read:
-                    # The value is good so update it
-                    self.set_cur_value(next_val)
-
-                # This means that we have 4 chances to get a TPV value before we declare that
-                # it is too old
-                time.sleep(float(GPS_FRESH) / 4)
-
-            # Occasionally if you pull too quickly (i.e., before the GPS has any info)
-            # then the gps library will throw an exception (which we want to ignore)
-            except StopIteration:
-                pass
+                data = self.session.sock.recv(READ_SIZE)
+            except (BlockingIOError, InterruptedError):
+                # Nothing more for now
+                return True
+            except OSError:
+                return False
+
+            # An empty read means gpsd closed the connection
+            if len(data) == 0:
+                return False
+
+            lines = (self.partial_line + data).split(b'\n')
+            # The last one is empty or has no end yet
+            self.partial_line = lines.pop()
+            if len(self.partial_line) > MAX_LINE_LENGTH:
+                self.partial_line = b''
+
+            for line in lines:
+                self.handle_line(line)
+
+    def handle_line(self, line):
+        '''Keeps the report in a line from gpsd if it is a TPV'''
+        line = line.decode('UTF-8', 'replace').strip()
+
+        # We are only interested in TPV measurements
+        # There is some chance that we will get back some weird data
+        # So these checks make this more roboust
+        if not line.startswith('{'):
+            return
+
+        try:
+            self.session.unpack(line)
+        except gps.JsonError:
+            return
+
+        report = self.session.data
+        if 'class' in report and report['class'] == 'TPV':
+            received = self.clock.monotonic()
+            self.set_cur_value(report, received)
+
+            if capture.has_position(report):
+                self.lock.acquire()
+                self.track_times.append(received)
+                self.track.append(report)
+                self.lock.release()
+
+    def interpolate(self, t):
+        '''Where the sensor was at time t (see interpolate_track())
+
+        Args:
+            t (float): The time on self.clock.monotonic(), e.g. when some
+                modem output was read
+
+        Return:
+            (dict): A TPV report (see interpolate_reports()) or None if there
+                was no fix near t
+        '''
+        self.lock.acquire()
+        report = interpolate_track(self.track_times, self.track, t)
+        self.lock.release()
+
+        return report
 
     # This should return the most recent datapoint, with time formatted nicely.
     def scan(self):
         # raw gps data
-        gps_data = self.get_cur_value()
-
-        # There is nothing to parse so just return
-        if gps_data == None:
-            # We want to create an empty dict so that the insert will work correctly
-            gps_data = {}
-    
-        if 'time' in gps_data:
-            gps_data['time'] = gps_data['time'].replace('T', ' ')[:-1]
-    
-        return gps_data
+        return format_gps_data(self.get_cur_value())
 
 
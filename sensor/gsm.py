@@ -1,6 +1,8 @@
 import serial
 import common.utils as utils
-import time
+import common.logger as logger
+import common.clock as clock_module
+import common.metrics as metrics
 
 MODEM_BAUD = 115200
 MODEM_TIMEOUT = 1
@@ -39,7 +41,15 @@ FREQUENCY_SPLIT =   [ (0, 127),
 # This class is required to pull data from the modem
 class GsmScanner():
 
-    def __init__(self, modem_tty):
+    def __init__(self, modem_tty, clock=clock_module.REAL_CLOCK):
+        '''Opens the modem and sets it up for surveys
+
+        Args:
+            modem_tty (String): Path to the modem serial device
+            clock (Clock): What to sleep on (see common.clock)
+        '''
+        self.clock = clock
+
         # initialize the modem object that will be used to communicate
         # with the modem
         self.modem = serial.Serial(modem_tty, MODEM_BAUD, timeout=MODEM_TIMEOUT)
@@ -47,6 +57,11 @@ class GsmScanner():
         # Use this to keep track of the current split that we are measuring
         self.split_index = 0
 
+        # (length of the reply so far, self.clock.monotonic()) for each read
+        # of the last AT command that got something. This says when each
+        # part of the reply came in.
+        self.read_times = []
+
         # Put the mode in an extended scan mode (number 3)
         res = self.run_at_command('surv_setting', 3)
 
@@ -65,12 +80,15 @@ class GsmScanner():
 
         freq_split = FREQUENCY_SPLIT[self.split_index]
 
-        utils.log("Reading modem scan data on arfcn range: (" + str(freq_split[0]) + \
-                                                    ", " + str(freq_split[1]) + ")")
+        logger.info("Reading modem scan data on arfcn range: ({:d}, {:d})", *freq_split)
 
         # Grab the data blob from the modem
-        modem_data['data_blob'] = self.run_at_command('surv_channel_range', \
-                                        freq_split[0] , freq_split[1])
+        with metrics.timer('gsm_command_seconds', split='{:d}-{:d}'.format(*freq_split)):
+            modem_data['data_blob'] = self.run_at_command('surv_channel_range', \
+                                            freq_split[0] , freq_split[1])
+        # When each part of the blob came in, so the measurements in it can
+        # be located on their own (see GpsScanner.interpolate())
+        modem_data['read_times'] = self.read_times
         # Now record the last split that was used
         modem_data['freq_low'] = freq_split[0]
         modem_data['freq_high'] = freq_split[1]
@@ -90,10 +108,13 @@ class GsmScanner():
 
         res = ""
         modem_time = 0
+        n_polls = 0
+        self.read_times = []
 
         # This loop will run until either the modem timelimit has expired or
         # we have seen an 'OK' or 'ERROR' in the message from the modem
         while modem_time < MODEM_TIMELIMIT:
+            n_polls += 1
             waitbytes = self.modem.inWaiting()
             # The modem returns bytes so we need to make it a str
             in_bytes = self.modem.read(waitbytes)
@@ -102,6 +123,8 @@ class GsmScanner():
             # decodable. We just log the error and continue.
             try:
                 res += in_bytes.decode('UTF-8')
+                if len(in_bytes) > 0:
+                    self.read_times.append((len(res), self.clock.monotonic()))
             except Exception as e:
                 # The data we are looking at is probably bad. In this case
                 # it makes sense to clear the modem read buffer and just
@@ -112,6 +135,7 @@ class GsmScanner():
                 # First we want to print whatever we have seen if anything
                 # in the res string (this should be good data)
                 utils.log("Crash in Decoding!")
+                metrics.increment('gsm_decode_errors_total')
 
                 utils.log("Clearing Bad Modem Data...")
                 # Clear the buffer for MODEM_TIMELIMIT 
@@ -125,12 +149,16 @@ class GsmScanner():
                     cleared_bytes += self.modem.read(cleared_waitbytes)
 
                     # Sleep to let the modem return more data
-                    time.sleep(MODEM_READ_PAUSE)
+                    self.clock.sleep(MODEM_READ_PAUSE)
                     clear_time += MODEM_READ_PAUSE
 
+                # The next scan tries again on the cleared modem
+                metrics.increment('gsm_retries_total')
+
                 # Don't store any data. Just return with a trivial error
                 # string
                 res = "Crash in decoding: ERROR"
+                self.read_times = []
                 return res
 
             # We have read all of the data
@@ -138,7 +166,7 @@ class GsmScanner():
                 break
 
             # This is so we don't pull constantly
-            time.sleep(MODEM_READ_PAUSE)
+            self.clock.sleep(MODEM_READ_PAUSE)
             # Increment the amount of time down in the read
             # This should be dominated by the pause time (so it is
             # a good approximation)
@@ -148,6 +176,9 @@ class GsmScanner():
         # read early because we hit the modem time-limit
         if modem_time >= MODEM_TIMELIMIT:
             utils.log("Modem time went over")
+            metrics.increment('gsm_timeouts_total')
+
+        metrics.observe('gsm_read_polls', n_polls, metrics.COUNT_BUCKETS, command=command)
 
         return res
 
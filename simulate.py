@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+'''Runs the survey loop against the fake modem and fake gpsd on virtual time.
+
+Everything sleeps on a common.clock.VirtualClock, so the waits for the
+modem, the GPS and the pauses between scans cost nothing and hours of
+survey take as long as the parsing and storage work does. This is the
+way to look for slow leaks and for things that only go wrong after a
+few thousand scans.
+'''
+import resource
+import sys
+import time
+
+import survey
+import sensor.fake_gpsd as fake_gpsd
+import sensor.fake_gsm as fake_gsm
+import common.clock as clock_module
+import common.storage as storage
+import common.utils as utils
+
+# How long (virtual hours) to survey for
+HOURS = 1.0
+# By default the scans are thrown away after they are stored
+STORAGE_URL = "sqlite://:memory:"
+# How long (virtual sec) the fake modem takes for each ARFCN it surveys
+ARFCN_DELAY = 0.05
+# TPV reports per second from the fake gpsd
+GPS_RATE = 1.0
+
+def simulate(hours=HOURS, storage_url=STORAGE_URL, measurements=None, seed=0,
+             iterations=None, on_scan=None):
+    '''Runs survey.scan() until the virtual clock has moved on by hours
+
+    Args:
+        hours (float): How long (virtual hours) to survey for. None to go
+            by iterations alone.
+        storage_url (String): Where the scans are written (see common.storage)
+        measurements (dict): What the fake modem reports (see
+            sensor.fake_gsm). Synthesized by default.
+        seed (int): Seed for the synthesized data so runs can be repeated
+        iterations (int): Stop after this many scans instead (if it comes first)
+        on_scan (function): Called with the number of scans done after each one
+
+    Return:
+        (dict): Counts and timings for the run
+    '''
+    if measurements is None:
+        measurements = fake_gsm.synthesize_measurements(seed=seed)
+
+    clock = clock_module.VirtualClock()
+    # This thread takes part from the start, so no time passes while it
+    # sets everything up
+    clock.register()
+    clock.start()
+
+    gpsd = fake_gpsd.FakeGpsd(port=0, rate=GPS_RATE, seed=seed, clock=clock)
+    modem = fake_gsm.FakeModem(measurements, arfcn_delay=ARFCN_DELAY, seed=seed, clock=clock)
+
+    database = storage.open_backend(storage_url)
+    gps_scanner = survey.gps.GpsScanner(port=gpsd.port, clock=clock)
+    gsm_scanner = survey.gsm.GsmScanner(modem.tty, clock=clock)
+
+    stats = {'scans' : 0}
+
+    start = time.time()
+    end_time = clock.time() + hours * 3600 if hours is not None else None
+    while end_time is None or clock.time() < end_time:
+        if iterations is not None and stats['scans'] >= iterations:
+            break
+
+        survey.scan(database, gps_scanner, gsm_scanner, clock=clock)
+        stats['scans'] += 1
+
+        if on_scan is not None:
+            on_scan(stats['scans'])
+
+        clock.sleep(survey.SCAN_PAUSE)
+
+    database.close()
+    stats['elapsed_sec'] = time.time() - start
+    stats['virtual_hours'] = clock.monotonic() / 3600
+
+    clock.unregister()
+    gsm_scanner.close()
+    modem.stop()
+    gpsd.stop()
+    clock.stop()
+
+    # ru_maxrss is in KB on Linux
+    stats['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    return stats
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3:
+        utils.log("Usage: ./simulate.py [<hours> [<storage_url>]]")
+        sys.exit(-1)
+
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else HOURS
+    storage_url = sys.argv[2] if len(sys.argv) > 2 else STORAGE_URL
+
+    stats = simulate(hours, storage_url)
+
+    utils.log("Simulated {:.2f} hours ({:d} scans) in {:.1f} sec, max RSS {:.1f} MB".format( \
+                        stats['virtual_hours'], stats['scans'], stats['elapsed_sec'],
+                        stats['max_rss_mb']))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+'''Soak tests the survey loop for memory leaks.
+
+Usage: ./soak.py [<iterations> [<max_growth_mb> [<snapshot_every>]]]
+
+The survey runs against the fake modem and fake gpsd on virtual time (see
+simulate.py) with tracemalloc on. After WARMUP scans a baseline is taken,
+and every snapshot_every scans after that the allocation sites that have
+grown the most since the baseline are logged along with the RSS. The run
+fails (exit status 1) if the RSS has grown by more than max_growth_mb
+since the baseline.
+
+The scans go to a SQLite file in a temporary directory. An in-memory
+database would grow with every scan and hide any real leak.
+'''
+import linecache
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+import simulate
+import common.utils as utils
+
+ITERATIONS = 5000
+# How much (in MB) the RSS may grow after the warmup
+MAX_GROWTH_MB = 20.0
+# How many scans between snapshots
+SNAPSHOT_EVERY = 500
+# Scans before the baseline is taken, so caches and buffers can fill up
+WARMUP = 200
+# How many allocation sites are logged at each snapshot
+TOP_SITES = 10
+# How many frames tracemalloc keeps for each allocation
+TRACE_FRAMES = 5
+
+def rss_mb():
+    '''The current resident set size in MB, less what tracemalloc itself uses'''
+    try:
+        # The second field is the resident pages
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, IndexError, ValueError):
+        # Not Linux, so make do with the peak (in KB on Linux)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    # The traces grow with every allocation site seen, which is not a leak
+    return (rss - tracemalloc.get_tracemalloc_memory()) / (1024.0 * 1024.0)
+
+def take_snapshot():
+    # Leave out tracemalloc's own bookkeeping
+    return tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, linecache.__file__)])
+
+class Soak():
+    ''' Keeps the baseline and checks the growth every SNAPSHOT_EVERY scans.'''
+
+    def __init__(self, max_growth_mb=MAX_GROWTH_MB, snapshot_every=SNAPSHOT_EVERY,
+                 warmup=WARMUP):
+        self.max_growth_mb = max_growth_mb
+        self.snapshot_every = snapshot_every
+        self.warmup = warmup
+
+        self.baseline = None
+        self.baseline_rss = None
+        self.max_growth = 0.0
+        # (scans, rss growth, traced growth) at each snapshot
+        self.history = []
+
+    def on_scan(self, n_scans):
+        if n_scans == self.warmup:
+            self.baseline = take_snapshot()
+            self.baseline_rss = rss_mb()
+            utils.log("Soak baseline after {:d} scans: RSS {:.1f} MB".format(n_scans,
+                                                                             self.baseline_rss))
+        elif self.baseline is not None and (n_scans - self.warmup) % self.snapshot_every == 0:
+            self.report(n_scans)
+
+    def report(self, n_scans):
+        snapshot = take_snapshot()
+        growth = rss_mb() - self.baseline_rss
+        self.max_growth = max(self.max_growth, growth)
+
+        stats = snapshot.compare_to(self.baseline, 'traceback')
+        traced = sum(stat.size_diff for stat in stats) / (1024.0 * 1024.0)
+        self.history.append((n_scans, growth, traced))
+
+        utils.log("Soak at {:d} scans: RSS {:+.2f} MB, traced {:+.2f} MB since the baseline".format( \
+                        n_scans, growth, traced))
+
+        # The sites that have grown the most, with where they were called from
+        lines = []
+        for stat in sorted(stats, key=lambda stat: stat.size_diff, reverse=True)[:TOP_SITES]:
+            if stat.size_diff <= 0:
+                break
+            lines.append("  {:+.1f} KiB in {:+d} blocks".format(stat.size_diff / 1024.0,
+                                                               stat.count_diff))
+            lines += ["    " + line for line in stat.traceback.format()]
+        if len(lines) > 0:
+            utils.log("\n".join(lines), is_bytes=True)
+
+    def passed(self):
+        return self.max_growth <= self.max_growth_mb
+
+def main(iterations=ITERATIONS, max_growth_mb=MAX_GROWTH_MB, snapshot_every=SNAPSHOT_EVERY):
+    if iterations <= WARMUP:
+        raise Exception("A soak needs more than the {:d} warmup scans".format(WARMUP))
+
+    directory = tempfile.mkdtemp(prefix='soak-')
+    storage_url = 'sqlite://' + os.path.join(directory, 'soak.db')
+
+    tracemalloc.start(TRACE_FRAMES)
+
+    soak = Soak(max_growth_mb, snapshot_every)
+    try:
+        stats = simulate.simulate(None, storage_url, iterations=iterations, on_scan=soak.on_scan)
+    finally:
+        shutil.rmtree(directory)
+
+    # The last stretch may not have ended on a snapshot
+    if (stats['scans'] - WARMUP) % snapshot_every != 0:
+        soak.report(stats['scans'])
+
+    tracemalloc.stop()
+
+    utils.log("Soaked {:d} scans ({:.1f} virtual hours) in {:.1f} sec".format( \
+                        stats['scans'], stats['virtual_hours'], stats['elapsed_sec']))
+    for (n_scans, growth, traced) in soak.history:
+        utils.log("  {:6d} scans: RSS {:+.2f} MB, traced {:+.2f} MB".format(n_scans, growth, traced))
+
+    if not soak.passed():
+        utils.log("FAILED: RSS grew by {:.2f} MB (the limit is {:.2f} MB)".format(soak.max_growth,
+                                                                                 max_growth_mb))
+        return False
+
+    utils.log("PASSED: RSS grew by at most {:.2f} MB".format(soak.max_growth))
+    return True
+
+if __name__ == '__main__':
+    if len(sys.argv) > 4:
+        utils.log("Usage: ./soak.py [<iterations> [<max_growth_mb> [<snapshot_every>]]]")
+        sys.exit(-1)
+
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS
+    max_growth_mb = float(sys.argv[2]) if len(sys.argv) > 2 else MAX_GROWTH_MB
+    snapshot_every = int(sys.argv[3]) if len(sys.argv) > 3 else SNAPSHOT_EVERY
+
+    sys.exit(0 if main(iterations, max_growth_mb, snapshot_every) else 1)
@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
+import bisect
 import traceback
 import sys
-import time
 
 import sensor.gps as gps
 import sensor.gsm as gsm
-import common.mongo_db as db
+import common.storage as storage
 import common.utils as utils
+import common.waterfall as waterfall
+import common.capture as capture
+import common.clock as clock_module
+import common.metrics as metrics
+import common.logger as logger
+import common.profiling as profiling
 
 from common.scan import Gps_Scan, Gsm_Scan, Scan
 from common.parse import Telit_Modem_Parser
@@ -14,29 +20,77 @@ from common.parse import Telit_Modem_Parser
 SCAN_PAUSE = 1              # How long of a pause between scans (in sec)
 DB_NAME = "SensorDB"
 COLLECTION_NAME = "Scan"
+# By default the scans go to the local MongoDB
+STORAGE_URL = "mongodb://localhost:27017/{}/{}".format(DB_NAME, COLLECTION_NAME)
+# Where the spectrum waterfall is kept (None to not keep one)
+WATERFALL_PATH = None
+# Where the raw modem output is recorded for replay.py (None to not record it)
+MODEM_LOG_PATH = None
+# The port the Prometheus metrics are served on (None to not serve them)
+METRICS_PORT = None
+# Where the metrics are written as JSON every so often (None to not write them)
+STATS_PATH = None
+
+def locate_measurements(gsm_scan, read_times, interpolate):
+    '''Gives each measurement the position of the sensor when the modem sent it
+
+    A modem command can run for tens of seconds while the sensor moves, so
+    this is much closer than the scan's before and after GPS points.
+
+    Args:
+        gsm_scan (Gsm_Scan): The parsed scan
+        read_times (list): (length of the reply so far, time) for each read
+            of the modem (see GsmScanner.read_times)
+        interpolate (function): Gives the TPV report at a time on the clock
+            of read_times, e.g. GpsScanner.interpolate
+    '''
+    if not read_times:
+        return
+
+    lengths = [length for (length, _) in read_times]
+
+    for measurement in gsm_scan.gsm_measurements:
+        blob_range = measurement.get_blob_range()
+        if blob_range is None:
+            continue
+
+        # The first read that had all of the measurement's text in it
+        i = bisect.bisect_left(lengths, blob_range[1])
+        if i == len(read_times):
+            continue
+
+        report = interpolate(read_times[i][1])
+        if report is not None:
+            measurement.set_gps(Gps_Scan(gps.format_gps_data(report)).document())
 
 # This will initialize the tables if needed
-def initialize(modem_tty):
+def initialize(modem_tty, storage_url=STORAGE_URL, clock=clock_module.REAL_CLOCK):
     '''This initializes all of the objects that are necessary.
 
     This includes: 1) Database, 2) gps objects, and 3) gsm objs
 
+    Args:
+        modem_tty (String): Path to the modem serial device
+        storage_url (String): Where the scans are written (see common.storage)
+        clock (Clock): What the scanners sleep on (see common.clock)
+
     Return:
         (Database, GpsScanner, GsmScanner): This tuple contains the database
         connection and both of the scan objects that will be used to run a scan.
     '''
     # Initialize the GpsScanner
-    gps_scanner = gps.GpsScanner()
+    gps_scanner = gps.GpsScanner(clock=clock)
     # Initialize the GsmScanner
-    gsm_scanner = gsm.GsmScanner(modem_tty)
+    gsm_scanner = gsm.GsmScanner(modem_tty, clock=clock)
     # Sets up the database connection
-    # This will look for a connection locally with no
+    # By default this will look for a connection locally with no
     # authentication
-    database = db.Database(DB_NAME, COLLECTION_NAME)
+    database = storage.open_backend(storage_url)
 
     return (database, gps_scanner, gsm_scanner)
 
-def scan(database, gps_scanner, gsm_scanner):
+def scan(database, gps_scanner, gsm_scanner, spectrum=None, modem_log=None,
+         clock=clock_module.REAL_CLOCK):
     '''This runs one iteration of a scan.
 
     Currently, one scan iteration is a gps scan followed by a
@@ -49,40 +103,81 @@ def scan(database, gps_scanner, gsm_scanner):
             connection.
         gsm_scanner (GsmScanner): This is the object that manages
             the gsm connection.
+        spectrum (Waterfall): If given, a row is added for the scan
+        modem_log (file): If given, the raw modem output is recorded to it
+        clock (Clock): Where the modem log times come from
     
     '''
     # Get data from GPS and modem
     utils.log("Collecting GPS and modem data...")
 
-    gps_before = Gps_Scan(gps_scanner.scan())
+    with metrics.timer('gps_scan_seconds'):
+        gps_before = Gps_Scan(gps_scanner.scan())
     utils.log_gps_time(gps_before.get_time(), gps_before.get_mode())
 
     # Grap the gsm scan data and then parse it into as Scan object
+    gsm_start = clock.time()
     raw_gsm_data = gsm_scanner.scan()
+
+    if modem_log is not None:
+        gsm_end = clock.time()
+        # The read times are on clock.monotonic(), the log has the wall clock
+        offset = gsm_end - clock.monotonic()
+        read_times = [(length, t + offset) for (length, t) in raw_gsm_data['read_times']]
+        capture.write_modem_record(modem_log, raw_gsm_data, gsm_start, gsm_end, read_times)
     
     # Create a parser and parse the blob to make a Gsm_Scan
-    parser = Telit_Modem_Parser()
-    gsm_scan = parser.parse_scan(raw_gsm_data['data_blob'])
-    # Now add the frequency range to the gsm_scan obj
-    gsm_scan.set_freq_range(raw_gsm_data['freq_low'], raw_gsm_data['freq_high'])
+    with metrics.timer('parse_seconds'):
+        parser = Telit_Modem_Parser()
+        gsm_scan = parser.parse_scan(raw_gsm_data['data_blob'])
+        # Now add the frequency range to the gsm_scan obj
+        gsm_scan.set_freq_range(raw_gsm_data['freq_low'], raw_gsm_data['freq_high'])
+    metrics.observe('measurements_per_scan', len(gsm_scan.gsm_measurements), metrics.COUNT_BUCKETS)
+
+    with metrics.timer('gps_scan_seconds'):
+        gps_after = Gps_Scan(gps_scanner.scan())
 
-    gps_after = Gps_Scan(gps_scanner.scan())
+    # This is after gps_after so the fixes after the last measurement are in
+    locate_measurements(gsm_scan, raw_gsm_data.get('read_times', None), gps_scanner.interpolate)
 
     # Now gather the data into a scan object
     scan = Scan(gsm_scan, gps_before, gps_after, utils.get_sensor_name())
     utils.log("Done collecting GPS and modem data.")
 
     # Actually insert the database points
-    database.insert_sensor_point(scan)
+    with metrics.timer('db_write_seconds'):
+        storage.write_sensor_point(database, scan)
 
-def scan_loop(modem_tty):
+    if spectrum is not None:
+        spectrum.append_scan(scan)
+
+def scan_loop(modem_tty, storage_url=STORAGE_URL, waterfall_path=WATERFALL_PATH,
+              clock=clock_module.REAL_CLOCK):
     '''This endlessly loops taking gps and gsm scans and writing them to a db
     
     This function never terminates until the program stops or
     there is an error.
     '''
     # This will create tables if needed
-    (database, gps_scanner, gsm_scanner) = initialize(modem_tty)
+    (database, gps_scanner, gsm_scanner) = initialize(modem_tty, storage_url, clock)
+
+    spectrum = None
+    if waterfall_path is not None:
+        spectrum = waterfall.Waterfall(waterfall_path)
+
+    modem_log = None
+    if MODEM_LOG_PATH is not None:
+        modem_log = open(MODEM_LOG_PATH, 'a')
+
+    if METRICS_PORT is not None:
+        metrics.serve(METRICS_PORT)
+    stats_writer = None
+    if STATS_PATH is not None:
+        stats_writer = metrics.StatsWriter(STATS_PATH)
+
+    # kill -USR1 profiles the next few scans, kill -USR2 dumps the stacks
+    profiler = profiling.ScanProfiler()
+    profiler.install()
 
     i = 0
     while True:
@@ -92,12 +187,17 @@ def scan_loop(modem_tty):
         utils.log("Begin Scan: {:d}".format(i))
 
         try:
-            scan(database, gps_scanner, gsm_scanner)
+            with metrics.timer('scan_seconds'):
+                profiler.call(scan, database, gps_scanner, gsm_scanner, spectrum, modem_log, clock)
+            metrics.increment('scans_total')
         except Exception as e:
+            metrics.increment('scan_errors_total')
             utils.log("Exception in Scan...")
-            utils.log(str(e))
+            utils.log(str(e), level=logger.ERROR)
 
-            # Grab the exception and then print it.
+            # Grab the exception and then print it. What was logged
+            # before it has to come out first.
+            logger.flush()
             exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
             traceback.print_exception(exceptionType, exceptionValue, exceptionTraceback, file=sys.stdout)
 
@@ -106,16 +206,24 @@ def scan_loop(modem_tty):
             gsm_scanner.close()
             utils.log("Closed modem.")
 
+            # Some backends batch their writes so flush what is left
+            database.close()
+            if spectrum is not None:
+                spectrum.close()
+            # Keep the numbers from the run that failed
+            if stats_writer is not None:
+                stats_writer.stop()
+
             utils.log("End Scan: {:d}".format(i))
 
             sys.exit(-1)
 
         # Sleep between scans
-        time.sleep(SCAN_PAUSE)
+        clock.sleep(SCAN_PAUSE)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        utils.log("Usage: ./survey <modem_tty>")
+    if len(sys.argv) not in [2, 3, 4]:
+        utils.log("Usage: ./survey <modem_tty> [<storage_url> [<waterfall_path>]]")
         sys.exit(-1)
 
     utils.log("#########################")
@@ -123,5 +231,7 @@ if __name__ == "__main__":
     utils.log("#########################")
     
     modem_tty = sys.argv[1]
+    storage_url = sys.argv[2] if len(sys.argv) >= 3 else STORAGE_URL
+    waterfall_path = sys.argv[3] if len(sys.argv) == 4 else WATERFALL_PATH
 
-    scan_loop(modem_tty)
+    scan_loop(modem_tty, storage_url, waterfall_path)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import sys
+
+import common.utils as utils
+import common.storage as storage
+import common.compress as compress
+
+# Number of scan blobs to train the dictionary on
+SAMPLE_NUM = 5000
+
+def main(source_url, dict_path=compress.DICT_PATH, sample_num=SAMPLE_NUM):
+    '''Trains a zstd dictionary on the raw blobs of the scans in source_url'''
+    source = storage.open_backend(source_url)
+
+    blobs = []
+    for (full_scan, uuid, version) in source.iter_scans():
+        blob = full_scan.get_gsm().blob
+        if blob is not None:
+            blobs.append(blob)
+
+        if len(blobs) >= sample_num:
+            break
+
+    source.close()
+
+    utils.log("Training dictionary on {:d} blobs...".format(len(blobs)))
+    zdict = compress.train_dictionary(blobs)
+
+    with open(dict_path, 'wb') as f:
+        f.write(zdict)
+
+    utils.log("Wrote dictionary to " + dict_path)
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [2, 3]:
+        utils.log("Usage: ./train_blob_dictionary.py <source_url> [<dict_path>]")
+        sys.exit(-1)
+
+    main(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else compress.DICT_PATH)